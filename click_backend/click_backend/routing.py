@@ -1,12 +1,20 @@
+# Sets up Django before anything importing the models
+from .asgi import application as django_asgi_app
+
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 import messenger.routing
+from messenger.middleware import TokenAuthMiddleware
 
 
 application = ProtocolTypeRouter({
+    # The REST API, async views don't hold a thread while waiting on I/O
+    'http': django_asgi_app,
     'websocket': AuthMiddlewareStack(
-        URLRouter(
-            messenger.routing.websocket_urlpatterns
+        TokenAuthMiddleware(
+            URLRouter(
+                messenger.routing.websocket_urlpatterns
+            )
         )
     ),
 })
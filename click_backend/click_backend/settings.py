@@ -12,6 +12,9 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
+
+from corsheaders.defaults import default_headers
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -53,6 +56,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    'restapi.routers.ReplicaRoutingMiddleware',
 ]
 
 ROOT_URLCONF = 'click_backend.urls'
@@ -83,9 +87,32 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, "db.sqlite3"),
-    }
+        'CONN_MAX_AGE': 60,
+        'OPTIONS': {
+            # Seconds a connection waits for a lock before failing
+            'timeout': 20,
+        },
+        # Applied to every new connection, see restapi.signals
+        'PRAGMAS': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+        },
+    },
 }
 
+# Aliases of DATABASES serving the reads of safe requests. For local
+# testing, add file replicas and refresh them with `manage.py sync_replicas`:
+#
+# DATABASES['replica1'] = {
+#     'ENGINE': 'django.db.backends.sqlite3',
+#     'NAME': os.path.join(BASE_DIR, "db.replica1.sqlite3"),
+#     'TEST': {'MIRROR': 'default'},
+# }
+DATABASE_REPLICAS = []
+DATABASE_ROUTERS = ['restapi.routers.PrimaryReplicaRouter']
+# Seconds a user's reads stay on the primary after they write
+REPLICA_PIN_SECONDS = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -120,6 +147,51 @@ USE_TZ = True
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 MEDIA_URL = "/media/"
 
+# Thumbnail sizes generated for uploaded profile images, in pixels, the size
+# the images themselves are scaled down to, and the number of worker
+# processes doing it (0 processes them inline)
+PROFILE_IMAGE_SIZES = (48, 96)
+PROFILE_IMAGE_MAX_SIZE = 300
+PROFILE_IMAGE_WORKERS = 2
+
+# Served from MEDIA_URL with these Cache-Control max-ages, in seconds. Files
+# named after their content hash never change, the others may be replaced.
+MEDIA_CACHE_MAX_AGE = {
+    'IMMUTABLE': 60 * 60 * 24 * 365,
+    'DEFAULT': 60 * 60,
+}
+# When a front proxy serves the files, only this header is returned, with
+# MEDIA_SENDFILE_PREFIX + the file path: "X-Accel-Redirect" with an internal
+# location for nginx, or "X-Sendfile" with MEDIA_ROOT + "/" for Apache
+MEDIA_SENDFILE_HEADER = None
+MEDIA_SENDFILE_PREFIX = "/protected-media/"
+
+# Messages older than AGE_DAYS are moved by `manage.py archive_messages` to
+# gzip'd JSONL segment files of at most SEGMENT_MESSAGES messages per chat.
+# Each process keeps the last CACHED_SEGMENTS segments read in memory.
+MESSAGE_ARCHIVE = {
+    'ROOT': os.path.join(BASE_DIR, "archive"),
+    'AGE_DAYS': 180,
+    'SEGMENT_MESSAGES': 500,
+    'CACHED_SEGMENTS': 32,
+}
+
+# Deleted users and orphaned chats are purged BATCH_SIZE rows at a time,
+# PAUSE seconds apart so that other writers get the SQLite write lock in
+# between. Jobs run in a thread of the process deleting the user when
+# IN_PROCESS is set, and in `manage.py purge_deleted`, which also deletes
+# friend requests older than STALE_REQUEST_DAYS. A job that hasn't made
+# progress for STALE_JOB_SECONDS is taken over by the next worker.
+PURGE = {
+    'BATCH_SIZE': 500,
+    'PAUSE': 0.01,
+    'IN_PROCESS': True,
+    'STALE_REQUEST_DAYS': 90,
+    'STALE_JOB_SECONDS': 300,
+    # Sync tokens older than the tombstones get a full sync
+    'TOMBSTONE_DAYS': 30,
+}
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/4.1/howto/static-files/
 
@@ -133,21 +205,108 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 AUTH_USER_MODEL = 'restapi.User'
 
 REST_FRAMEWORK = {
-    'DEFAULT_AUTHENTICATION_CLASSES': ('knox.auth.TokenAuthentication', ),
+    'DEFAULT_AUTHENTICATION_CLASSES': (
+        'restapi.authentication.CachedTokenAuthentication',
+    ),
+}
+
+# Shared by the worker processes of the host, kept out of the source tree
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), "click_backend_cache"),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+
+# Per-user cache of GET responses, invalidated by model signals. TIMEOUT
+# in seconds bounds staleness from changes made outside of the ORM. The
+# ALIAS cache must be shared by the worker processes; a LocMemCache is only
+# fine with a single worker and makes the checks warn.
+RESPONSE_CACHE = {
+    'ENABLED': True,
+    'ALIAS': 'default',
+    'TIMEOUT': 300,
+}
+
+# Cache of verified auth tokens in the ALIAS cache, which must be shared
+# by the worker processes, TTL in seconds (0 disables it)
+TOKEN_CACHE = {
+    'ALIAS': 'default',
+    'TTL': 60,
 }
 
 ASGI_APPLICATION = "click_backend.routing.application"
+# Shared by all ASGI worker processes of the host through a SQLite broker
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'BACKEND': 'messenger.layers.SQLiteChannelLayer',
+        'CONFIG': {
+            'path': os.path.join(BASE_DIR, "channels.sqlite3"),
+            'expiry': 60,
+            'capacity': 100,
+        },
+    },
+}
+
+# Batching of chat messages persisted by the websocket consumer
+MESSENGER_WRITE_BEHIND = {
+    'MAX_QUEUE_SIZE': 10000,
+    'FLUSH_BATCH_SIZE': 200,
+    'FLUSH_INTERVAL_MS': 50,
+    'RETRIES': 3,
+    'RETRY_DELAY_MS': 100,
+    'METRICS_INTERVAL_S': 60,
+}
+
+# Background failures and metrics of the messenger and restapi apps
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'messenger': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'restapi': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
     },
 }
 
+# Per-connection websocket send queue: at most one frame of MAX_BATCH
+# messages every SEND_INTERVAL_MS, and what arrives faster is queued. When
+# MAX_SIZE frames are queued OVERFLOW applies, 'drop_oldest' or 'disconnect'
+MESSENGER_SEND_QUEUE = {
+    'MAX_SIZE': 100,
+    'MAX_BATCH': 50,
+    'SEND_INTERVAL_MS': 50,
+    'OVERFLOW': 'drop_oldest',
+}
+
 CORS_ALLOWED_ORIGINS = [
     "http://127.0.0.1:3000",
     "http://localhost:3000",
 ]
 
+# Let browser clients revalidate polled reads themselves
+CORS_ALLOW_HEADERS = list(default_headers) + [
+    'if-modified-since',
+    'if-none-match',
+]
+CORS_EXPOSE_HEADERS = [
+    'ETag',
+    'Last-Modified',
+]
+
 CORS_ALLOW_METHODS = [
     'DELETE',
     'GET',
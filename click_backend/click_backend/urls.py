@@ -16,9 +16,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from restapi import user_urls, chat_urls
+from restapi.views.media_views import serveMedia
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('users/', include(user_urls)),
     path('chat/', include(chat_urls)),
+    path('media/<path:path>', serveMedia, name="media"),
 ]
@@ -0,0 +1,242 @@
+import asyncio
+import atexit
+import logging
+import time
+import weakref
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import OperationalError
+
+from restapi.models import Chat, Message
+from restapi.utils.utils import bulk_save_messages
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "MAX_QUEUE_SIZE": 10000,
+    "FLUSH_BATCH_SIZE": 200,
+    "FLUSH_INTERVAL_MS": 50,
+    "RETRIES": 3,
+    "RETRY_DELAY_MS": 100,
+    "METRICS_INTERVAL_S": 60,
+}
+
+
+def save_messages(batch):
+    '''
+    Persist a batch of queued messages, dropping those whose chat is gone
+    '''
+    chat_ids = set(
+        Chat.objects.filter(
+            id__in={item["chat_id"] for item in batch}
+        ).values_list("id", flat=True)
+    )
+    messages = [
+        Message(**item) for item in batch if item["chat_id"] in chat_ids
+    ]
+    if messages:
+        bulk_save_messages(messages)
+    return len(batch) - len(messages)
+
+
+class MessageBuffer:
+    '''
+    Bounded write-behind queue batching messages received over websockets
+    into bulk inserts. Queued messages are written when FLUSH_BATCH_SIZE of
+    them are waiting or FLUSH_INTERVAL_MS after the first one was queued.
+
+    A batch failing because the database is unavailable, e.g. locked, is
+    retried RETRIES times, waiting RETRY_DELAY_MS and twice as long after
+    every attempt, then dropped. A batch failing on a bad message is saved
+    message by message, only dropping the bad ones. The metrics are logged
+    every METRICS_INTERVAL_S seconds while messages are written.
+    '''
+
+    def __init__(self, max_queue_size, flush_batch_size, flush_interval_ms,
+                 retries=0, retry_delay_ms=0, metrics_interval_s=None):
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self.flush_batch_size = flush_batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.retries = retries
+        self.retry_delay = retry_delay_ms / 1000
+        self.metrics_interval = metrics_interval_s
+        self.last_report = time.monotonic()
+        # Set while messages are queued, and once they are due
+        self.pending = asyncio.Event()
+        self.due = asyncio.Event()
+        self.task = None
+        self.metrics = {
+            "flushes": 0,
+            "flushed_messages": 0,
+            "dropped_messages": 0,
+            "failed_messages": 0,
+            "retries": 0,
+            "last_flush_latency_ms": 0.0,
+            "max_flush_latency_ms": 0.0,
+            "total_flush_latency_ms": 0.0,
+        }
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def get_metrics(self):
+        return dict(self.metrics, queue_depth=self.queue_depth)
+
+    async def put(self, chat_id, sent_from, text):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+        # Blocks the sending socket when the queue is full
+        await self.queue.put({
+            "chat_id": chat_id,
+            "sent_from": sent_from,
+            "text": text,
+        })
+        self.pending.set()
+        if self.queue.qsize() >= self.flush_batch_size:
+            self.due.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.pending.wait()
+            timer = loop.call_later(self.flush_interval, self.due.set)
+            await self.due.wait()
+            timer.cancel()
+            self.due.clear()
+
+            await self.write_queued()
+            # Messages queued during the writes wait for the next round
+            if self.queue.empty():
+                self.pending.clear()
+
+    async def write_queued(self):
+        while not self.queue.empty():
+            batch = []
+            while len(batch) < self.flush_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            await self.write(batch)
+
+    async def flush(self):
+        '''
+        Write everything queued so far, including a batch being written
+        '''
+        await self.write_queued()
+        await self.queue.join()
+
+    async def write(self, batch):
+        start = time.perf_counter()
+        try:
+            dropped, failed = await self.save(batch)
+            self.metrics["flushed_messages"] += len(batch) - dropped - failed
+            self.metrics["dropped_messages"] += dropped
+            self.metrics["failed_messages"] += failed
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+            self.record_flush(time.perf_counter() - start)
+
+    async def save(self, batch):
+        '''
+        Save the batch. Returns how many messages were dropped because their
+        chat is gone and how many couldn't be saved.
+        '''
+        try:
+            return await self.save_with_retries(batch), 0
+        except OperationalError:
+            logger.exception(
+                "Dropped a batch of %d messages after %d attempts",
+                len(batch),
+                self.retries + 1,
+            )
+            return 0, len(batch)
+        except Exception:
+            if len(batch) == 1:
+                logger.exception("Dropped a message that couldn't be saved")
+                return 0, 1
+
+        # One bad message fails the whole batch
+        dropped = failed = 0
+        for item in batch:
+            item_dropped, item_failed = await self.save([item])
+            dropped += item_dropped
+            failed += item_failed
+        return dropped, failed
+
+    async def save_with_retries(self, batch):
+        '''
+        Save the batch, retrying with exponential backoff while the database
+        is unavailable
+        '''
+        for attempt in range(self.retries + 1):
+            try:
+                # The batch is saved in one transaction, a failed attempt
+                # leaves nothing behind
+                return await database_sync_to_async(save_messages)(batch)
+            except OperationalError:
+                if attempt == self.retries:
+                    raise
+                self.metrics["retries"] += 1
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+    def record_flush(self, latency):
+        latency_ms = latency * 1000
+        self.metrics["flushes"] += 1
+        self.metrics["last_flush_latency_ms"] = latency_ms
+        self.metrics["total_flush_latency_ms"] += latency_ms
+        self.metrics["max_flush_latency_ms"] = max(
+            self.metrics["max_flush_latency_ms"], latency_ms
+        )
+
+        now = time.monotonic()
+        if (self.metrics_interval is not None
+                and now - self.last_report >= self.metrics_interval):
+            self.last_report = now
+            logger.info("Message buffer metrics: %s", self.get_metrics())
+
+    def flush_sync(self):
+        '''
+        Write what is left in the queue outside of the event loop, used when
+        the process exits
+        '''
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if batch:
+            save_messages(batch)
+
+
+_buffers = weakref.WeakKeyDictionary()
+
+
+def get_message_buffer():
+    '''
+    Return the buffer of the running event loop, creating it on first use
+    '''
+    loop = asyncio.get_running_loop()
+    if loop not in _buffers:
+        config = dict(
+            DEFAULTS,
+            **getattr(settings, "MESSENGER_WRITE_BEHIND", {})
+        )
+        _buffers[loop] = MessageBuffer(
+            config["MAX_QUEUE_SIZE"],
+            config["FLUSH_BATCH_SIZE"],
+            config["FLUSH_INTERVAL_MS"],
+            config["RETRIES"],
+            config["RETRY_DELAY_MS"],
+            config["METRICS_INTERVAL_S"],
+        )
+    return _buffers[loop]
+
+
+@atexit.register
+def flush_buffers():
+    for buffer in list(_buffers.values()):
+        try:
+            buffer.flush_sync()
+        except Exception:
+            logger.exception("Flushing the message buffer failed")
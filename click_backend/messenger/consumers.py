@@ -1,44 +1,119 @@
 import json
+import uuid
 from channels.generic.websocket import AsyncWebsocketConsumer
 
+from restapi.models import Message
+
+from .buffer import get_message_buffer
+from .membership import membership_cache
+from .outbox import create_outbox
+
+# Rooms relaying a user's notifications, named <prefix><username>
+NOTIFICATION_ROOM_PREFIXES = ('requests', 'contacts')
+
 
 class ChatRoomConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_group_name = 'chat_%s' % self.room_name
 
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        # Chat rooms are named after the chat id, other rooms only relay
+        try:
+            self.chat_id = uuid.UUID(self.room_name)
+        except ValueError:
+            self.chat_id = None
+
+        self.user = self.scope.get('user')
+        if self.user is None or not self.user.is_authenticated:
+            await self.close()
+            return
+
+        if not await self.is_member():
+            await self.close()
+            return
+
+        # Anyone may notify a user, only the user may listen
+        if self.may_listen():
+            await self.channel_layer.group_add(
+                self.room_group_name,
+                self.channel_name
+            )
 
         await self.accept()
+        self.outbox = create_outbox(self.send, self.close)
 
     async def disconnect(self, close_code):
+        if hasattr(self, 'outbox'):
+            self.outbox.close()
+
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message = text_data_json['message']
-        username = text_data_json['username']
+        if self.chat_id is not None:
+            await get_message_buffer().flush()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        message = self.parse_message(text_data)
+        if message is None:
+            self.outbox.put(json.dumps({'Error': 'Invalid message'}))
+            return
+        # The sender is the authenticated user, not what the frame claims
+        username = self.user.username
+
+        if not await self.is_member():
+            await self.close()
+            return
+
+        if self.chat_id is not None:
+            await get_message_buffer().put(self.chat_id, username, message)
 
+        # Serialized once here and shared by every recipient
         await self.channel_layer.group_send(
             self.room_group_name,
             {
                 'type': 'chatroom_message',
-                'message': message,
-                'username': username,
+                'text': json.dumps({
+                    'message': message,
+                    'username': username,
+                }),
             }
         )
 
-    async def chatroom_message(self, event):
-        message = event['message']
-        username = event['username']
+    @staticmethod
+    def parse_message(text_data):
+        '''
+        Text of the message in a frame, None unless it is a non-empty
+        string a Message can hold
+        '''
+        try:
+            message = json.loads(text_data)['message']
+        except (TypeError, ValueError, KeyError):
+            return None
+        max_length = Message._meta.get_field('text').max_length
+        if not isinstance(message, str) or not 0 < len(message) <= max_length:
+            return None
+        return message
+
+    async def is_member(self):
+        if self.chat_id is None:
+            return True
+        return await membership_cache.is_member(self.chat_id, self.user.pk)
 
-        await self.send(text_data=json.dumps({
-            'message': message,
-            'username': username,
-        }))
+    def may_listen(self):
+        '''
+        Whether the user receives the room's messages. Notification rooms
+        are only listened to by the user they are named after, whose
+        username is in the room name without its dashes.
+        '''
+        if self.chat_id is not None:
+            return True
+        for prefix in NOTIFICATION_ROOM_PREFIXES:
+            if self.room_name.startswith(prefix):
+                owner = self.room_name[len(prefix):]
+                return owner == self.user.username.replace('-', '')
+        return True
+
+    async def chatroom_message(self, event):
+        self.outbox.put(event['text'])
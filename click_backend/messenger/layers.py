@@ -0,0 +1,356 @@
+import asyncio
+import base64
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from functools import partial
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+
+def _encode(message):
+    def default(value):
+        if isinstance(value, bytes):
+            return {"__bytes__": base64.b64encode(value).decode()}
+        raise TypeError(f"{type(value).__name__} is not serializable")
+
+    return json.dumps(message, default=default)
+
+
+def _decode(payload):
+    def object_hook(value):
+        if len(value) == 1 and "__bytes__" in value:
+            return base64.b64decode(value["__bytes__"])
+        return value
+
+    return json.loads(payload, object_hook=object_hook)
+
+
+class SQLiteChannelLayer(BaseChannelLayer):
+    """
+    Channel layer sharing channels and groups between the worker processes
+    of one host through a SQLite database file used as the broker.
+
+    Each process polls the broker once per tick for all of its specific
+    channels ("<prefix>.<process id>!<local id>") and hands the messages to
+    the local receivers, so the number of open sockets does not multiply
+    the number of queries. Messages are stored with the receiver polling
+    for them, "!<process id>" or the channel name for other channels, so
+    every poll is an indexed lookup. Idle receivers poll less and less
+    often, from poll_interval up to max_poll_interval.
+    """
+
+    extensions = ["groups", "flush"]
+    # SQLite builds before 3.32 allow at most 999 parameters per query
+    max_parameters = 900
+
+    def __init__(
+        self,
+        path=None,
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        poll_interval=0.02,
+        max_poll_interval=0.25,
+        **kwargs
+    ):
+        super().__init__(
+            expiry=expiry,
+            capacity=capacity,
+            channel_capacity=channel_capacity,
+            **kwargs
+        )
+        self.path = path or os.path.join(
+            tempfile.gettempdir(), "channels.sqlite3"
+        )
+        self.group_expiry = group_expiry
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.client_prefix = uuid.uuid4().hex
+        self.receive_buffers = {}
+        self.receivers = 0
+        self.poller = None
+        self.last_cleanup = 0
+        self.lock = threading.Lock()
+        self.connection = None
+
+    # Broker access
+
+    def _connect(self):
+        if self.connection is None:
+            connection = sqlite3.connect(
+                self.path,
+                timeout=30,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    receiver TEXT NOT NULL,
+                    channel TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    expires REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS messages_receiver_idx
+                    ON messages (receiver, id);
+                CREATE INDEX IF NOT EXISTS messages_channel_idx
+                    ON messages (channel, expires);
+                CREATE INDEX IF NOT EXISTS messages_expires_idx
+                    ON messages (expires);
+                CREATE TABLE IF NOT EXISTS groups (
+                    group_name TEXT NOT NULL,
+                    channel TEXT NOT NULL,
+                    expires REAL NOT NULL,
+                    PRIMARY KEY (group_name, channel)
+                );
+            """)
+            self.connection = connection
+        return self.connection
+
+    def _execute(self, function, *args, write=True):
+        with self.lock:
+            connection = self._connect()
+            if not write:
+                return function(connection, *args)
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = function(connection, *args)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+            return result
+
+    async def _run(self, function, *args, write=True):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, partial(self._execute, function, *args, write=write)
+        )
+
+    @staticmethod
+    def _receiver(channel):
+        '''
+        Who polls for the messages of channel: the process owning a
+        specific channel, or the receivers of the channel itself
+        '''
+        if "!" in channel:
+            return "!" + channel.split("!", 1)[0].rsplit(".", 1)[-1]
+        return channel
+
+    def _insert(self, connection, channels, payload):
+        '''
+        Insert payload on every channel below its capacity, return the
+        channels that were full
+        '''
+        now = time.time()
+        sizes = {}
+        # Below SQLite's limit on the number of query parameters
+        for i in range(0, len(channels), self.max_parameters):
+            chunk = channels[i:i + self.max_parameters]
+            placeholders = ",".join("?" * len(chunk))
+            sizes.update(connection.execute(
+                f"SELECT channel, COUNT(*) FROM messages "
+                f"WHERE channel IN ({placeholders}) AND expires >= ? "
+                f"GROUP BY channel",
+                [*chunk, now],
+            ).fetchall())
+
+        full = {
+            channel for channel in channels
+            if sizes.get(channel, 0) >= self.get_capacity(channel)
+        }
+        connection.executemany(
+            "INSERT INTO messages (receiver, channel, payload, expires) "
+            "VALUES (?, ?, ?, ?)",
+            [
+                (self._receiver(channel), channel, payload, now + self.expiry)
+                for channel in channels if channel not in full
+            ],
+        )
+        return full
+
+    def _has_messages(self, connection, receiver):
+        return connection.execute(
+            "SELECT 1 FROM messages WHERE receiver = ? LIMIT 1",
+            (receiver,),
+        ).fetchone() is not None
+
+    async def _receive_pending(self, receiver, limit):
+        '''
+        Pop up to limit messages of receiver, only taking the write lock
+        when there is something to pop
+        '''
+        if not await self._run(self._has_messages, receiver, write=False):
+            return []
+        return await self._run(self._pop, receiver, limit)
+
+    def _pop(self, connection, receiver, limit):
+        rows = connection.execute(
+            "SELECT id, channel, payload FROM messages "
+            "WHERE receiver = ? AND expires >= ? "
+            "ORDER BY id LIMIT ?",
+            (receiver, time.time(), limit),
+        ).fetchall()
+        if rows:
+            connection.executemany(
+                "DELETE FROM messages WHERE id = ?",
+                [(row[0],) for row in rows],
+            )
+        return [(channel, payload) for _, channel, payload in rows]
+
+    def _clean_expired(self, connection):
+        now = time.time()
+        # Channels that let messages expire are not listening anymore
+        connection.execute(
+            "DELETE FROM groups WHERE channel IN "
+            "(SELECT channel FROM messages WHERE expires < ?)",
+            (now,),
+        )
+        connection.execute("DELETE FROM messages WHERE expires < ?", (now,))
+        connection.execute("DELETE FROM groups WHERE expires < ?", (now,))
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        """
+        Send a message onto a (general or specific) channel.
+        """
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        assert "__asgi_channel__" not in message
+
+        full = await self._run(self._insert, [channel], _encode(message))
+        if full:
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        """
+        Receive the first message that arrives on the channel.
+        """
+        assert self.valid_channel_name(channel)
+
+        if "!" not in channel:
+            interval = self.poll_interval
+            while True:
+                messages = await self._receive_pending(channel, 1)
+                if messages:
+                    return _decode(messages[0][1])
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, self.max_poll_interval)
+
+        queue = self.receive_buffers.setdefault(channel, asyncio.Queue())
+        self.receivers += 1
+        if self.poller is None or self.poller.done():
+            self.poller = asyncio.get_running_loop().create_task(self._poll())
+        try:
+            return await queue.get()
+        finally:
+            self.receivers -= 1
+            if queue.empty() and self.receive_buffers.get(channel) is queue:
+                del self.receive_buffers[channel]
+
+    async def new_channel(self, prefix="specific."):
+        """
+        Returns a new channel name that can be used by something in our
+        process as a specific channel.
+        """
+        return "%s.%s!%s" % (prefix, self.client_prefix, uuid.uuid4().hex)
+
+    async def _poll(self):
+        '''
+        Move messages for this process' specific channels from the broker
+        to the local receive buffers
+        '''
+        receiver = "!" + self.client_prefix
+        interval = self.poll_interval
+        while self.receivers:
+            if time.time() - self.last_cleanup > self.expiry:
+                self.last_cleanup = time.time()
+                await self._run(self._clean_expired)
+
+            messages = await self._receive_pending(receiver, 1000)
+            for channel, payload in messages:
+                # Keep messages arriving between two receive calls
+                queue = self.receive_buffers.setdefault(channel, asyncio.Queue())
+                queue.put_nowait(_decode(payload))
+            if messages:
+                interval = self.poll_interval
+            else:
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, self.max_poll_interval)
+
+    # Flush extension
+
+    async def flush(self):
+        def flush(connection):
+            connection.execute("DELETE FROM messages")
+            connection.execute("DELETE FROM groups")
+
+        await self._run(flush)
+
+    async def close(self):
+        if self.poller is not None:
+            self.poller.cancel()
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        """
+        Adds the channel name to a group.
+        """
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+
+        def group_add(connection):
+            connection.execute(
+                "INSERT OR REPLACE INTO groups (group_name, channel, expires) "
+                "VALUES (?, ?, ?)",
+                (group, channel, time.time() + self.group_expiry),
+            )
+
+        await self._run(group_add)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), "Invalid channel name"
+        assert self.valid_group_name(group), "Invalid group name"
+
+        def group_discard(connection):
+            connection.execute(
+                "DELETE FROM groups WHERE group_name = ? AND channel = ?",
+                (group, channel),
+            )
+
+        await self._run(group_discard)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+
+        payload = _encode(message)
+
+        def group_send(connection):
+            channels = [
+                row[0] for row in connection.execute(
+                    "SELECT channel FROM groups "
+                    "WHERE group_name = ? AND expires >= ?",
+                    (group, time.time()),
+                )
+            ]
+            # Full channels are skipped, like the other channel layers do
+            if channels:
+                self._insert(connection, channels, payload)
+
+        await self._run(group_send)
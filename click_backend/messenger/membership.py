@@ -0,0 +1,71 @@
+import threading
+import time
+
+from channels.db import database_sync_to_async
+from django.db.models.signals import m2m_changed, post_delete
+from django.dispatch import receiver
+
+from restapi.models import Chat
+
+
+class MembershipCache:
+    '''
+    In-process map of chat id to the ids of its participants. Entries are
+    dropped when the participants change in this process and expire after
+    ttl seconds to pick up changes made by other processes.
+    '''
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.members = {}
+        self.lock = threading.Lock()
+
+    def get_cached(self, chat_id):
+        entry = self.members.get(chat_id)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def load(self, chat_id):
+        members = frozenset(
+            Chat.participants.through.objects.filter(
+                chat_id=chat_id
+            ).values_list("user_id", flat=True)
+        )
+        with self.lock:
+            self.members[chat_id] = (time.monotonic() + self.ttl, members)
+        return members
+
+    async def is_member(self, chat_id, user_id):
+        # Served without leaving the event loop once cached
+        members = self.get_cached(chat_id)
+        if members is None:
+            members = await database_sync_to_async(self.load)(chat_id)
+        return user_id in members
+
+    def invalidate(self, *chat_ids):
+        with self.lock:
+            for chat_id in chat_ids:
+                self.members.pop(chat_id, None)
+
+
+membership_cache = MembershipCache()
+
+
+@receiver(m2m_changed, sender=Chat.participants.through)
+def invalidate_chat_members(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        membership_cache.invalidate(instance.pk)
+    elif pk_set:
+        membership_cache.invalidate(*pk_set)
+    else:
+        # user.chat.clear() doesn't report the affected chats
+        with membership_cache.lock:
+            membership_cache.members.clear()
+
+
+@receiver(post_delete, sender=Chat)
+def invalidate_deleted_chat(sender, instance, **kwargs):
+    membership_cache.invalidate(instance.pk)
@@ -0,0 +1,43 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from rest_framework.exceptions import AuthenticationFailed
+
+from restapi.authentication import CachedTokenAuthentication
+
+
+@database_sync_to_async
+def authenticate_token(token):
+    try:
+        user, _ = CachedTokenAuthentication().authenticate_credentials(
+            token.encode()
+        )
+        return user
+    except AuthenticationFailed:
+        return None
+
+
+class TokenAuthMiddleware(BaseMiddleware):
+    '''
+    Authenticate websocket connections with the knox token passed as
+    ?token=<token>, since browsers can't set headers on websockets.
+    Connections already authenticated by the session keep their user.
+
+    The token is part of the URL, so it ends up in the access logs of the
+    ASGI server and of proxies in front of it. Keep these logs private, or
+    have clients exchange their token for a short-lived single-use ticket
+    to put in the URL instead.
+    '''
+
+    async def __call__(self, scope, receive, send):
+        user = scope.get("user")
+        if user is None or not user.is_authenticated:
+            query = parse_qs(scope.get("query_string", b"").decode())
+            token = query.get("token", [None])[0]
+            if token:
+                token_user = await authenticate_token(token)
+                if token_user is not None:
+                    scope = dict(scope, user=token_user)
+
+        return await super().__call__(scope, receive, send)
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "MAX_SIZE": 100,
+    "MAX_BATCH": 50,
+    "SEND_INTERVAL_MS": 50,
+    "OVERFLOW": "drop_oldest",
+}
+
+OVERFLOW_POLICIES = ("drop_oldest", "disconnect")
+
+
+class Outbox:
+    '''
+    Bounded per-connection send queue. Frames are already serialized JSON
+    texts; when several are pending they are sent together as one JSON
+    array frame.
+
+    A connection gets at most one frame of up to max_batch messages every
+    send_interval seconds, or fewer when sending takes longer, e.g. under
+    servers whose send waits for a slow client. Frames produced faster fill
+    the queue; when it is full the oldest frame is dropped, or disconnect
+    is called. Daphne's send returns at once, so there the rate limit is
+    what bounds the traffic and memory a client causes.
+
+    When sending fails the queue is closed and disconnect is called.
+    '''
+
+    def __init__(self, send, disconnect, max_size, max_batch, send_interval, overflow):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"OVERFLOW must be one of {', '.join(OVERFLOW_POLICIES)}"
+            )
+        self.send = send
+        self.disconnect = disconnect
+        self.max_size = max_size
+        self.max_batch = max_batch
+        self.send_interval = send_interval
+        self.overflow = overflow
+        self.frames = deque()
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self.closed = False
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def put(self, text):
+        '''
+        Queue a frame without waiting for the client
+        '''
+        if self.closed:
+            return
+        if len(self.frames) >= self.max_size:
+            if self.overflow == "disconnect":
+                self.close()
+                asyncio.get_running_loop().create_task(self.disconnect())
+                return
+            self.frames.popleft()
+            self.dropped += 1
+        self.frames.append(text)
+        self.ready.set()
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            # Let the rest of a burst arrive before draining
+            await asyncio.sleep(0)
+            self.ready.clear()
+
+            while self.frames:
+                count = min(self.max_batch, len(self.frames))
+                batch = [self.frames.popleft() for _ in range(count)]
+                start = time.monotonic()
+                try:
+                    if count == 1:
+                        await self.send(text_data=batch[0])
+                    else:
+                        await self.send(text_data="[%s]" % ",".join(batch))
+                except Exception:
+                    logger.exception("Sending to a websocket client failed")
+                    self.closed = True
+                    self.frames.clear()
+                    await self.disconnect()
+                    return
+                # Frames put meanwhile wait in the queue
+                await asyncio.sleep(
+                    self.send_interval - (time.monotonic() - start)
+                )
+
+    def close(self):
+        self.closed = True
+        self.frames.clear()
+        self.task.cancel()
+
+
+def create_outbox(send, disconnect):
+    config = dict(DEFAULTS, **getattr(settings, "MESSENGER_SEND_QUEUE", {}))
+    return Outbox(
+        send,
+        disconnect,
+        config["MAX_SIZE"],
+        config["MAX_BATCH"],
+        config["SEND_INTERVAL_MS"] / 1000,
+        config["OVERFLOW"],
+    )
@@ -1,3 +1,393 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.testing import WebsocketCommunicator
+from django.db import OperationalError
+from django.test import (
+    SimpleTestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from knox.models import AuthToken
+
+from click_backend.routing import application
+from restapi.models import Message
+from restapi.testing import create_chat, create_user
+
+from .buffer import MessageBuffer, save_messages
+from .layers import SQLiteChannelLayer
+from .outbox import Outbox
+
+
+# Consumers reach the database through database_sync_to_async, which
+# closes connections a TestCase transaction depends on
+class MessageBufferTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.chat = create_chat([create_user("owner"), create_user("friend")])
+
+    def create_buffer(self, **kwargs):
+        options = dict(
+            max_queue_size=100,
+            flush_batch_size=3,
+            flush_interval_ms=10000,
+            retries=2,
+            retry_delay_ms=1,
+        )
+        options.update(kwargs)
+        return MessageBuffer(**options)
+
+    async def put(self, buffer, count):
+        for i in range(count):
+            await buffer.put(self.chat.id, "owner", f"message {i}")
+
+    async def test_full_batches_are_written_at_once(self):
+        buffer = self.create_buffer()
+
+        await self.put(buffer, 7)
+        # The interval is long, only full batches are due
+        await asyncio.sleep(0.1)
+
+        self.assertEqual(buffer.metrics["flushes"], 3)
+        self.assertEqual(buffer.metrics["flushed_messages"], 7)
+        self.assertEqual(buffer.queue_depth, 0)
+        self.assertEqual(await Message.objects.filter(chat=self.chat).acount(), 7)
+
+    async def test_partial_batch_is_written_after_the_interval(self):
+        buffer = self.create_buffer(flush_interval_ms=20)
+
+        await self.put(buffer, 2)
+        self.assertEqual(buffer.metrics["flushes"], 0)
+        await asyncio.sleep(0.2)
+
+        self.assertEqual(buffer.metrics["flushes"], 1)
+        self.assertEqual(await Message.objects.filter(chat=self.chat).acount(), 2)
+
+    async def test_flush_writes_queued_messages(self):
+        buffer = self.create_buffer()
+
+        await self.put(buffer, 2)
+        await buffer.flush()
+
+        self.assertEqual(await Message.objects.filter(chat=self.chat).acount(), 2)
+        self.assertEqual(buffer.get_metrics()["queue_depth"], 0)
+
+    async def test_failed_batch_is_retried(self):
+        buffer = self.create_buffer()
+        attempts = []
+
+        def flaky_save(batch):
+            attempts.append(len(batch))
+            if len(attempts) == 1:
+                raise OperationalError("database is locked")
+            return save_messages(batch)
+
+        with mock.patch("messenger.buffer.save_messages", flaky_save):
+            await self.put(buffer, 2)
+            await buffer.flush()
+
+        self.assertEqual(attempts, [2, 2])
+        self.assertEqual(buffer.metrics["retries"], 1)
+        self.assertEqual(await Message.objects.filter(chat=self.chat).acount(), 2)
+
+    async def test_failed_batch_is_dropped_after_the_retries(self):
+        buffer = self.create_buffer()
+        failing_save = mock.Mock(side_effect=OperationalError("disk I/O error"))
+
+        with mock.patch("messenger.buffer.save_messages", failing_save):
+            await self.put(buffer, 2)
+            with self.assertLogs("messenger.buffer", "ERROR"):
+                await buffer.flush()
+
+        self.assertEqual(failing_save.call_count, 3)
+        self.assertEqual(buffer.metrics["failed_messages"], 2)
+        self.assertEqual(buffer.queue_depth, 0)
+
+    async def test_bad_message_only_drops_itself(self):
+        buffer = self.create_buffer()
+
+        await buffer.put(self.chat.id, "owner", "first")
+        await buffer.put(self.chat.id, "owner", None)
+        await buffer.put(self.chat.id, "owner", "last")
+        with self.assertLogs("messenger.buffer", "ERROR"):
+            await buffer.flush()
+
+        self.assertEqual(buffer.metrics["failed_messages"], 1)
+        self.assertEqual(buffer.metrics["flushed_messages"], 2)
+        self.assertEqual(buffer.metrics["retries"], 0)
+        self.assertEqual(
+            [text async for text in Message.objects.filter(
+                chat=self.chat,
+            ).order_by("created").values_list("text", flat=True)],
+            ["first", "last"],
+        )
+
+
+class SQLiteChannelLayerTestCase(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "channels.sqlite3")
+
+    def create_layer(self, **kwargs):
+        layer = SQLiteChannelLayer(path=self.path, poll_interval=0.005, **kwargs)
+        self.addCleanup(async_to_sync(layer.close))
+        return layer
+
+    def count_messages(self):
+        with sqlite3.connect(self.path) as connection:
+            return connection.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    async def receive(self, layer, channel, timeout=1):
+        return await asyncio.wait_for(layer.receive(channel), timeout)
+
+    async def test_send_and_receive(self):
+        layer = self.create_layer()
+
+        await layer.send("worker", {"type": "test", "data": b"\x00bytes"})
+
+        self.assertEqual(
+            await self.receive(layer, "worker"),
+            {"type": "test", "data": b"\x00bytes"},
+        )
+
+    async def test_specific_channels_are_received_by_their_process(self):
+        first, second = self.create_layer(), self.create_layer()
+        channel = await first.new_channel()
+
+        await second.send(channel, {"type": "test"})
+
+        self.assertEqual(await self.receive(first, channel), {"type": "test"})
+        self.assertEqual(self.count_messages(), 0)
+
+    async def test_group_send_reaches_other_processes(self):
+        first, second = self.create_layer(), self.create_layer()
+        channels = [await first.new_channel(), await second.new_channel()]
+        await first.group_add("chat", channels[0])
+        await second.group_add("chat", channels[1])
+
+        await second.group_send("chat", {"type": "test"})
+
+        self.assertEqual(await self.receive(first, channels[0]), {"type": "test"})
+        self.assertEqual(await self.receive(second, channels[1]), {"type": "test"})
+
+        await first.group_discard("chat", channels[0])
+        await second.group_send("chat", {"type": "again"})
+        self.assertEqual(await self.receive(second, channels[1]), {"type": "again"})
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.receive(first, channels[0], timeout=0.1)
+
+    async def test_large_group(self):
+        layer = self.create_layer()
+        channels = [f"worker{i}" for i in range(2 * layer.max_parameters + 1)]
+        for channel in channels:
+            await layer.group_add("everyone", channel)
+
+        await layer.group_send("everyone", {"type": "test"})
+
+        self.assertEqual(await self.receive(layer, channels[-1]), {"type": "test"})
+
+    async def test_expired_messages_are_not_received(self):
+        layer = self.create_layer(expiry=0.05)
+
+        await layer.send("worker", {"type": "test"})
+        await asyncio.sleep(0.1)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.receive(layer, "worker", timeout=0.1)
+
+    async def test_channel_full(self):
+        layer = self.create_layer(capacity=2)
+
+        await layer.send("worker", {"type": "test"})
+        await layer.send("worker", {"type": "test"})
+
+        with self.assertRaises(ChannelFull):
+            await layer.send("worker", {"type": "test"})
+        # Full channels are skipped by group sends
+        await layer.group_add("workers", "worker")
+        await layer.group_send("workers", {"type": "test"})
+        self.assertEqual(self.count_messages(), 2)
+
+
+@override_settings(CHANNEL_LAYERS={
+    "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"},
+})
+class ChatRoomConsumerTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.owner = create_user("owner")
+        self.chat = create_chat([self.owner, create_user("friend")])
+        self.token = AuthToken.objects.create(self.owner)[1]
+
+    async def connect(self, token=None, room=None):
+        path = f"/ws/chat/{room or self.chat.id.hex}/"
+        if token is not None:
+            path += f"?token={token}"
+        communicator = WebsocketCommunicator(application, path)
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def test_anonymous_connection_is_rejected(self):
+        for token in (None, "not-a-token"):
+            communicator, connected = await self.connect(token)
+            self.assertFalse(connected)
+
+    async def test_non_member_is_rejected(self):
+        stranger = await database_sync_to_async(create_user)("stranger")
+        token = (await database_sync_to_async(AuthToken.objects.create)(stranger))[1]
+
+        communicator, connected = await self.connect(token)
+
+        self.assertFalse(connected)
+
+    async def test_sender_is_the_authenticated_user(self):
+        communicator, connected = await self.connect(self.token)
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({"message": "hi", "username": "friend"})
+
+        self.assertEqual(
+            await communicator.receive_json_from(),
+            {"message": "hi", "username": "owner"},
+        )
+        # The message is written once the socket is closed
+        await communicator.disconnect()
+        message = await Message.objects.aget(chat=self.chat)
+        self.assertEqual((message.sent_from, message.text), ("owner", "hi"))
+
+    async def test_invalid_messages_are_rejected(self):
+        communicator, connected = await self.connect(self.token)
+        self.assertTrue(connected)
+
+        for frame in ('{"message": null}', '{"message": ""}', "[]", "not json",
+                      json.dumps({"message": "x" * 1001})):
+            await communicator.send_to(text_data=frame)
+            self.assertEqual(
+                await communicator.receive_json_from(),
+                {"Error": "Invalid message"},
+            )
+
+        await communicator.disconnect()
+        self.assertFalse(await Message.objects.filter(chat=self.chat).aexists())
+
+    async def test_only_the_named_user_listens_to_notifications(self):
+        stranger = await database_sync_to_async(create_user)("stranger")
+        stranger_token = (await database_sync_to_async(AuthToken.objects.create)(stranger))[1]
+
+        owner, connected = await self.connect(self.token, room="requestsowner")
+        self.assertTrue(connected)
+        # Others may still connect, to send
+        other, connected = await self.connect(stranger_token, room="requestsowner")
+        self.assertTrue(connected)
+
+        await other.send_json_to({"message": "new request"})
+
+        self.assertEqual(
+            await owner.receive_json_from(),
+            {"message": "new request", "username": "stranger"},
+        )
+        self.assertTrue(await other.receive_nothing())
+        await owner.disconnect()
+        await other.disconnect()
+
+
+class OutboxTestCase(SimpleTestCase):
+
+    def create_outbox(self, overflow="drop_oldest", send_interval=0):
+        self.frames = []
+        # Cleared to make send wait, like a client not reading
+        self.reading = asyncio.Event()
+        self.reading.set()
+        self.disconnected = asyncio.Event()
+
+        async def send(text_data):
+            await self.reading.wait()
+            if text_data == '"fail"':
+                raise ConnectionResetError()
+            self.frames.append(text_data)
+
+        async def disconnect():
+            self.disconnected.set()
+
+        outbox = Outbox(send, disconnect, 3, 2, send_interval, overflow)
+        self.addCleanup(outbox.close)
+        return outbox
+
+    async def drain(self):
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+    async def test_burst_is_sent_as_json_arrays(self):
+        outbox = self.create_outbox()
+
+        for i in range(3):
+            outbox.put(json.dumps({"message": i}))
+        await self.drain()
+
+        self.assertEqual(
+            [json.loads(frame) for frame in self.frames],
+            [[{"message": 0}, {"message": 1}], {"message": 2}],
+        )
+
+    async def test_oldest_frames_are_dropped_when_full(self):
+        outbox = self.create_outbox()
+        self.reading.clear()
+        outbox.put('"blocked"')
+        await self.drain()
+
+        for i in range(5):
+            outbox.put(str(i))
+        self.reading.set()
+        await self.drain()
+
+        self.assertEqual(outbox.dropped, 2)
+        self.assertEqual(self.frames, ['"blocked"', "[2,3]", "4"])
+
+    async def test_disconnect_when_full(self):
+        outbox = self.create_outbox("disconnect")
+        self.reading.clear()
+        outbox.put('"blocked"')
+        await self.drain()
+
+        for i in range(4):
+            outbox.put(str(i))
+        await self.drain()
+
+        self.assertTrue(self.disconnected.is_set())
+        self.assertTrue(outbox.closed)
+        outbox.put("5")
+        self.assertEqual(len(outbox.frames), 0)
+
+    async def test_sends_are_rate_limited(self):
+        outbox = self.create_outbox(send_interval=60)
+
+        outbox.put("0")
+        await self.drain()
+        # Faster than one frame a minute, the client gets the newest ones
+        for i in range(1, 6):
+            outbox.put(str(i))
+        await self.drain()
+
+        self.assertEqual(self.frames, ["0"])
+        self.assertEqual(list(outbox.frames), ["3", "4", "5"])
+        self.assertEqual(outbox.dropped, 2)
+
+    async def test_failed_send_disconnects(self):
+        outbox = self.create_outbox()
+
+        with self.assertLogs("messenger.outbox", "ERROR"):
+            outbox.put('"fail"')
+            await self.drain()
+
+        self.assertTrue(self.disconnected.is_set())
+        self.assertTrue(outbox.closed)
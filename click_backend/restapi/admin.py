@@ -1,10 +1,13 @@
 from django.contrib import admin
 from .models import (
+    ChatReadState,
     FriendRequest,
     User,
     Profile,
     Chat,
     Message,
+    MessageSegment,
+    PurgeJob,
 )
 
 # Register your models here.
@@ -13,4 +16,7 @@ admin.site.register(User)
 admin.site.register(Profile)
 admin.site.register(Chat)
 admin.site.register(Message)
+admin.site.register(MessageSegment)
 admin.site.register(FriendRequest)
+admin.site.register(ChatReadState)
+admin.site.register(PurgeJob)
@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def create_search_index(sender, using, **kwargs):
+    from .utils.search import create_message_index
+    create_message_index(using)
 
 
 class RestapiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'restapi'
+
+    def ready(self):
+        from . import checks, signals  # noqa: F401
+        post_migrate.connect(create_search_index, sender=self)
@@ -0,0 +1,81 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from rest_framework import generics
+from rest_framework.response import Response
+
+
+class AsyncGenericAPIView(generics.GenericAPIView):
+    '''
+    Generic view with async HTTP handlers, served without holding a thread
+    under ASGI. Authentication, permissions and throttling still run sync,
+    like sync handlers, e.g. OPTIONS. Under WSGI Django runs the view in an
+    event loop of its own.
+
+    Transactions can't be used from async code, code needing one, e.g.
+    bulk_save_messages, must be wrapped with sync_to_async.
+    '''
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(),
+                                  self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+
+            if asyncio.iscoroutinefunction(handler):
+                response = await handler(request, *args, **kwargs)
+            else:
+                response = await sync_to_async(handler)(request, *args, **kwargs)
+
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    async def apaginate_queryset(self, queryset):
+        '''
+        Page of the queryset, fetched with the async ORM interface, or None
+        '''
+        if self.paginator is None:
+            return None
+        return await self.paginator.apaginate_queryset(
+            queryset,
+            self.request,
+            view=self,
+        )
+
+
+class AsyncListAPIView(AsyncGenericAPIView):
+    '''
+    Async version of generics.ListAPIView
+    '''
+
+    async def get(self, request, *args, **kwargs):
+        return await self.list(request, *args, **kwargs)
+
+    async def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = await self.apaginate_queryset(queryset)
+        if page is None:
+            objects = [obj async for obj in queryset]
+        else:
+            objects = page
+
+        # Serializers may load related objects lazily
+        data = await sync_to_async(
+            lambda: self.get_serializer(objects, many=True).data
+        )()
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
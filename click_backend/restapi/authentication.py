@@ -0,0 +1,119 @@
+import binascii
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from knox.auth import TokenAuthentication
+from knox.crypto import hash_token
+from knox.settings import knox_settings
+from rest_framework import exceptions
+
+from .routers import bind_request_user
+
+
+class TokenCache:
+    '''
+    Cache of verified knox tokens, keyed by token digest, kept in a Django
+    cache shared by the worker processes. Entries live at most ttl seconds.
+
+    Deleting a token drops its entry, and changing or deleting a user bumps
+    a version of the user that its cached tokens must match, so no process
+    keeps accepting them.
+    '''
+
+    def __init__(self, alias="default", ttl=60):
+        self.alias = alias
+        self.ttl = ttl
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def _token_key(digest):
+        return f"token:{digest}"
+
+    @staticmethod
+    def _user_key(user_id):
+        return f"token:user:{user_id}:version"
+
+    def _user_version(self, user_id):
+        key = self._user_key(user_id)
+        version = self.cache.get(key)
+        if version is None:
+            self.cache.add(key, uuid.uuid4().hex, None)
+            version = self.cache.get(key)
+        return version
+
+    def get(self, digest):
+        if self.ttl <= 0:
+            return None
+        entry = self.cache.get(self._token_key(digest))
+        if entry is None:
+            return None
+        # Unpickled, so requests don't share model instances
+        version, auth_token = entry
+        if self.cache.get(self._user_key(auth_token.user_id)) != version:
+            return None
+        return auth_token
+
+    def set(self, digest, auth_token):
+        if self.ttl <= 0:
+            return
+        self.cache.set(
+            self._token_key(digest),
+            (self._user_version(auth_token.user_id), auth_token),
+            self.ttl,
+        )
+
+    def invalidate(self, digest):
+        if self.ttl > 0:
+            self.cache.delete(self._token_key(digest))
+
+    def invalidate_user(self, user_id):
+        if self.ttl > 0:
+            self.cache.set(self._user_key(user_id), uuid.uuid4().hex, None)
+
+
+token_cache = TokenCache(**{
+    key.lower(): value
+    for key, value in getattr(settings, "TOKEN_CACHE", {}).items()
+})
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    '''
+    Knox token authentication answering repeated requests with the same
+    token from the shared token cache.
+
+    The verified token and its user are available to the views as
+    request.auth and request.user.
+    '''
+
+    def authenticate(self, request):
+        result = super().authenticate(request)
+        if result is not None:
+            bind_request_user(result[0].pk)
+        return result
+
+    def authenticate_credentials(self, token):
+        try:
+            digest = hash_token(token.decode("utf-8"))
+        except (TypeError, UnicodeDecodeError, binascii.Error):
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        auth_token = token_cache.get(digest)
+        if auth_token is not None:
+            if auth_token.expiry is None or auth_token.expiry > timezone.now():
+                if knox_settings.AUTO_REFRESH and auth_token.expiry:
+                    self.renew_token(auth_token)
+                    token_cache.set(digest, auth_token)
+                return self.validate_user(auth_token)
+            # Let knox delete the expired token
+            token_cache.invalidate(digest)
+
+        user, auth_token = super().authenticate_credentials(token)
+        token_cache.set(digest, auth_token)
+        return user, auth_token
@@ -1,5 +1,7 @@
 from django.urls import path
 from .views import chat_views as views
+from .views import search_views
+from .views import sync_views
 
 urlpatterns = [
     path(
@@ -27,6 +29,31 @@ urlpatterns = [
         views.listChats,
         name="listChats",
     ),
+    path(
+        "inbox/",
+        views.inbox,
+        name="inbox",
+    ),
+    path(
+        "search/",
+        search_views.searchMessages,
+        name="searchMessages",
+    ),
+    path(
+        "search/<str:chat_id>/",
+        search_views.searchMessages,
+        name="searchChatMessages",
+    ),
+    path(
+        "sync/",
+        sync_views.sync,
+        name="sync",
+    ),
+    path(
+        "read/<str:chat_id>/",
+        views.markChatRead,
+        name="markChatRead",
+    ),
     path(
         "update/<str:chat_id>/",
         views.updateLastMessageChat,
@@ -37,11 +64,27 @@ urlpatterns = [
         views.listRequests,
         name="listRequests",
     ),
+    path(
+        "requests/list/outgoing/",
+        views.listRequests,
+        {"direction": "outgoing"},
+        name="listOutgoingRequests",
+    ),
+    path(
+        "requests/count/",
+        views.countRequests,
+        name="countRequests",
+    ),
     path(
         "requests/send/",
         views.sendRequest,
         name="sendRequest",
     ),
+    path(
+        "requests/accept/",
+        views.acceptRequest,
+        name="acceptRequest",
+    ),
     path(
         "requests/delete/",
         views.deleteRequest,
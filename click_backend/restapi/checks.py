@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.checks import Warning, register
+
+
+@register()
+def check_response_cache(app_configs, **kwargs):
+    '''
+    Warn when responses are cached in a cache local to the process, which
+    the invalidations of other worker processes wouldn't reach
+    '''
+    config = settings.RESPONSE_CACHE
+    if not config["ENABLED"]:
+        return []
+    if not isinstance(caches[config["ALIAS"]], (LocMemCache, DummyCache)):
+        return []
+    return [Warning(
+        f"The response cache uses the process local cache {config['ALIAS']!r}.",
+        hint="Only run a single worker process, or point RESPONSE_CACHE['ALIAS'] "
+             "to a cache shared by the workers.",
+        id="restapi.W001",
+    )]
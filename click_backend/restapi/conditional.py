@@ -0,0 +1,100 @@
+import hashlib
+import time
+from calendar import timegm
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+
+def _validators(request, validator):
+    '''
+    ETag of the response, and its Last-Modified time when it is exact
+    '''
+    if isinstance(validator, tuple):
+        modified, version = validator
+    else:
+        modified, version = validator, None
+
+    etag = quote_etag(hashlib.md5(
+        "|".join((
+            request.get_full_path(),
+            request.accepted_renderer.format,
+            modified.isoformat(),
+            version or "",
+        )).encode(),
+        usedforsecurity=False,
+    ).hexdigest())
+
+    # Last-Modified is in whole seconds. It misses the changes a version
+    # stands for, and the ones made later in the same second.
+    last_modified = timegm(modified.utctimetuple())
+    if version is not None or time.time() < last_modified + 1:
+        last_modified = None
+    return etag, last_modified
+
+
+def _set_validators(response, etag, last_modified):
+    if response.status_code in (200, 304):
+        response["ETag"] = etag
+        if last_modified is not None:
+            response["Last-Modified"] = http_date(last_modified)
+    return response
+
+
+class ConditionalGetMixin:
+    '''
+    Answer GET requests with 304 Not Modified while the client's ETag or
+    Last-Modified validators are current.
+
+    get_validator returns when the resource last changed, or a tuple of it
+    and a string that changes with it (e.g. a row count), from a cheap
+    query and without serializing the response. None skips validation. The
+    ETag also covers the query string and the response format.
+
+    The ETag is kept in self.etag, for the response cache to only serve
+    responses matching it.
+    '''
+    etag = None
+
+    def get_validator(self):
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        validator = self.get_validator()
+        if validator is None:
+            return super().get(request, *args, **kwargs)
+
+        self.etag, last_modified = _validators(request, validator)
+        response = get_conditional_response(
+            request,
+            etag=self.etag,
+            last_modified=last_modified,
+        )
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        return _set_validators(response, self.etag, last_modified)
+
+
+class AsyncConditionalGetMixin:
+    '''
+    ConditionalGetMixin for async views, get_validator is async too
+    '''
+    etag = None
+
+    async def get_validator(self):
+        raise NotImplementedError
+
+    async def get(self, request, *args, **kwargs):
+        validator = await self.get_validator()
+        if validator is None:
+            return await super().get(request, *args, **kwargs)
+
+        self.etag, last_modified = _validators(request, validator)
+        response = get_conditional_response(
+            request,
+            etag=self.etag,
+            last_modified=last_modified,
+        )
+        if response is None:
+            response = await super().get(request, *args, **kwargs)
+        return _set_validators(response, self.etag, last_modified)
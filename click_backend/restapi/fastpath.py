@@ -0,0 +1,164 @@
+from django.db import connections, models
+from django.db.models.query import BaseIterable
+from django.db.models.sql.constants import MULTI
+from rest_framework.response import Response
+
+
+def _uuid(value):
+    # SQLite stores UUIDs as 32 hex digits
+    return value if value is None else (
+        f"{value[:8]}-{value[8:12]}-{value[12:16]}-{value[16:20]}-{value[20:]}"
+    )
+
+
+def _datetime(value):
+    # Naive UTC datetimes, or "YYYY-MM-DD HH:MM:SS[.ffffff]" for computed
+    # columns which the sqlite3 module doesn't parse
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value.replace(" ", "T", 1) + "Z"
+    return value.isoformat() + "Z"
+
+
+class RawValuesIterable(BaseIterable):
+    '''
+    values() rows straight from SQLite, without the model field converters.
+    UUIDs and datetimes are formatted as the serializer fields render them,
+    for a small fraction of the cost of building Python objects.
+    '''
+
+    def __iter__(self):
+        queryset = self.queryset
+        query = queryset.query
+        compiler = query.get_compiler(queryset.db)
+        names = [
+            *query.extra_select,
+            *query.values_select,
+            *query.annotation_select,
+        ]
+        formatters = [self.formatter(queryset, name) for name in names]
+        columns = list(enumerate(zip(names, formatters)))
+
+        results = compiler.execute_sql(
+            MULTI,
+            chunked_fetch=self.chunked_fetch,
+            chunk_size=self.chunk_size,
+        )
+        for rows in results:
+            for row in rows:
+                yield {
+                    name: row[i] if formatter is None else formatter(row[i])
+                    for i, (name, formatter) in columns
+                }
+
+    @staticmethod
+    def formatter(queryset, name):
+        annotation = queryset.query.annotation_select.get(name)
+        if annotation is not None:
+            field = annotation.output_field
+        else:
+            field = queryset.model._meta.get_field(name)
+        if field.is_relation:
+            field = field.target_field
+
+        if isinstance(field, models.UUIDField):
+            return _uuid
+        if isinstance(field, models.DateTimeField):
+            return _datetime
+        return None
+
+
+class BaseValuesListMixin:
+    '''
+    List view serializing rows straight from queryset.values(), without
+    building a model instance and running every serializer field per row.
+
+    values_fields are the serializer fields whose representation is the
+    column value itself. values_extra_fields are filled in for a whole page
+    at once by add_values_extras. values_required are fetched for the
+    pagination or the extras even when ?fields= leaves them out. Any other
+    field requested falls back to the serializer.
+    '''
+    values_fields = ()
+    values_extra_fields = ()
+    values_required = ()
+
+    def values_names(self):
+        '''
+        Fields of the response, or None when the fast path can't build them
+        '''
+        # The serializer decides the names and order, e.g. with ?fields=
+        names = list(self.get_serializer().fields)
+        if not set(names) <= {*self.values_fields, *self.values_extra_fields}:
+            return None
+        return names
+
+    def values_queryset(self, names):
+        columns = [name for name in names if name in self.values_fields]
+        queryset = self.filter_queryset(self.get_queryset())
+        queryset = queryset.prefetch_related(None).values(
+            *dict.fromkeys([*columns, *self.values_required])
+        )
+        if connections[queryset.db].vendor == "sqlite":
+            queryset._iterable_class = RawValuesIterable
+        return queryset
+
+    def values_extras(self, names):
+        return [name for name in names if name in self.values_extra_fields]
+
+    def values_response(self, rows, names, paginated):
+        data = [{name: row[name] for name in names} for row in rows]
+        if paginated:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+
+class ValuesListMixin(BaseValuesListMixin):
+
+    def list(self, request, *args, **kwargs):
+        names = self.values_names()
+        if names is None:
+            return super().list(request, *args, **kwargs)
+
+        queryset = self.values_queryset(names)
+        page = self.paginate_queryset(queryset)
+        rows = list(queryset if page is None else page)
+        extras = self.values_extras(names)
+        if extras and rows:
+            self.add_values_extras(rows, extras)
+        return self.values_response(rows, names, page is not None)
+
+    def add_values_extras(self, rows, fields):
+        raise NotImplementedError
+
+
+class AsyncValuesListMixin(BaseValuesListMixin):
+    '''
+    ValuesListMixin for AsyncListAPIView, with the async ORM interface
+    '''
+
+    async def list(self, request, *args, **kwargs):
+        names = self.values_names()
+        if names is None:
+            return await super().list(request, *args, **kwargs)
+
+        queryset = self.values_queryset(names)
+        page = await self.apaginate_queryset(queryset)
+        if page is None:
+            rows = await self.all_values_rows(queryset)
+        else:
+            rows = page
+        extras = self.values_extras(names)
+        if extras and rows:
+            await self.add_values_extras(rows, extras)
+        return self.values_response(rows, names, page is not None)
+
+    async def all_values_rows(self, queryset):
+        '''
+        Rows of the list when it isn't paginated
+        '''
+        return [row async for row in queryset]
+
+    async def add_values_extras(self, rows, fields):
+        raise NotImplementedError
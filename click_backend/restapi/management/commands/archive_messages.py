@@ -0,0 +1,46 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from restapi.models import Message
+from restapi.utils.archive import archive_chat
+
+
+class Command(BaseCommand):
+    help = "Move old messages out of the Message table into compressed per-chat segments"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--age-days",
+            type=int,
+            default=settings.MESSAGE_ARCHIVE["AGE_DAYS"],
+        )
+        parser.add_argument(
+            "--segment-size",
+            type=int,
+            default=settings.MESSAGE_ARCHIVE["SEGMENT_MESSAGES"],
+        )
+
+    def handle(self, *args, **options):
+        if options["age_days"] < 0 or options["segment_size"] < 1:
+            raise CommandError("--age-days must be positive and --segment-size at least 1")
+
+        cutoff = timezone.now() - timedelta(days=options["age_days"])
+        chat_ids = Message.objects.filter(
+            created__lt=cutoff,
+        ).values_list("chat_id", flat=True).distinct()
+
+        chats = messages = 0
+        # Only one archival may run at a time
+        for chat_id in list(chat_ids):
+            archived = archive_chat(chat_id, cutoff, options["segment_size"])
+            if archived:
+                chats += 1
+                messages += archived
+                self.stdout.write(f"Archived {archived} messages of chat {chat_id}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {messages} messages of {chats} chats"
+        ))
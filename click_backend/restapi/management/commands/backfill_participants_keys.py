@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from restapi.utils.utils import backfill_participants_keys
+
+
+class Command(BaseCommand):
+    help = (
+        "Set the participants key of chats created before it existed and "
+        "merge the chats with the same participants"
+    )
+
+    def handle(self, *args, **options):
+        keyed, merged, unmerged = backfill_participants_keys()
+
+        if unmerged:
+            self.stdout.write(self.style.WARNING(
+                f"{unmerged} duplicate chats hold archived messages and were "
+                "left without a participants key"
+            ))
+        self.stdout.write(self.style.SUCCESS(
+            f"Set the participants key of {keyed} chats, merged {merged} duplicates"
+        ))
@@ -0,0 +1,259 @@
+import json
+import platform
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from knox.models import AuthToken
+from rest_framework.test import APIClient
+
+from restapi import response_cache
+from restapi.models import (
+    Chat,
+    FriendRequest,
+    Message,
+    Profile,
+    SyncTombstone,
+    User,
+)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = (len(values) - 1) * percent / 100
+    lower = int(index)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (index - lower)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure latency percentiles and SQL query counts of the REST hot "
+        "paths against the current database, e.g. one filled by seed_data. "
+        "The response cache is disabled, unless --response-cache is given "
+        "to also measure the reads served from it. Writes are committed and "
+        "their rows deleted after every iteration, outside of the timing."
+    )
+    benchmarks = {
+        "listChats": "list_chats",
+        "listMessages": "list_messages",
+        "createChat": "create_chat",
+        "sendRequest": "send_request",
+        "listRequests": "list_requests",
+        "addContact": "add_contact",
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument("--username",
+                            help="User making the requests, defaults to the "
+                                 "user with the most chats")
+        parser.add_argument("--iterations", type=int, default=50)
+        parser.add_argument("--warmup", type=int, default=5)
+        parser.add_argument("--output",
+                            help="Write the results as JSON to this file")
+        parser.add_argument("--only", nargs="*", choices=list(self.benchmarks),
+                            help="Only run these benchmarks")
+        parser.add_argument("--response-cache", action="store_true",
+                            help="Run every benchmark again with the response "
+                                 "cache enabled, reported as <name>:cached")
+
+    def handle(self, *args, **options):
+        if options["iterations"] < 1 or options["warmup"] < 0:
+            raise CommandError("--iterations must be at least 1 and --warmup positive")
+        self.user = self.get_user(options["username"])
+        self.setup_fixtures()
+
+        auth_token, token = AuthToken.objects.create(self.user)
+        self.client = APIClient(SERVER_NAME="localhost")
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {token}")
+
+        names = options["only"] or list(self.benchmarks)
+        runs = [(False, "")]
+        if options["response_cache"]:
+            # Warm: the warmup iterations fill the cache
+            runs.append((True, ":cached"))
+
+        results = {}
+        try:
+            for cached, suffix in runs:
+                with override_settings(RESPONSE_CACHE={
+                    **settings.RESPONSE_CACHE,
+                    "ENABLED": cached,
+                }):
+                    for name in names:
+                        method = self.benchmarks[name]
+                        results[name + suffix] = self.run(
+                            getattr(self, method),
+                            getattr(self, f"undo_{method}", None),
+                            options["iterations"],
+                            options["warmup"],
+                        )
+                        self.report(name + suffix, results[name + suffix])
+        finally:
+            auth_token.delete()
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump({
+                    "meta": self.meta(options),
+                    "results": results,
+                }, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+    def get_user(self, username):
+        if username:
+            try:
+                return User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError(f"User {username} does not exist")
+
+        user = User.objects.annotate(
+            chat_count=Count("chat")
+        ).order_by("-chat_count").first()
+        if user is None:
+            raise CommandError("No users, run seed_data first")
+        return user
+
+    def setup_fixtures(self):
+        self.chat = Chat.objects.filter(
+            participants=self.user
+        ).annotate(
+            message_count=Count("message")
+        ).order_by("-message_count").first()
+        if self.chat is None:
+            raise CommandError(f"{self.user.username} has no chats")
+
+        # A user without a chat with self.user, for the write benchmarks
+        partners = Chat.participants.through.objects.filter(
+            chat__participants=self.user
+        ).values("user_id")
+        self.stranger = User.objects.exclude(
+            id__in=partners
+        ).exclude(id=self.user.id).first()
+        if self.stranger is None:
+            raise CommandError(f"{self.user.username} chats with every user")
+        FriendRequest.objects.filter(
+            sent_from=self.user, received_from=self.stranger
+        ).delete()
+        # Not removed again by undo_add_contact
+        self.was_contact = self.stranger.contact.filter(user=self.user).exists()
+
+    def run(self, request, undo, iterations, warmup):
+        latencies = []
+        queries = []
+        cache_stats = response_cache.stats.copy()
+        for i in range(warmup + iterations):
+            # Writes are committed, their cost includes the commit
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                response = request()
+                latency = time.perf_counter() - start
+            if undo is not None:
+                # So that every iteration sees the same data
+                undo()
+
+            if response.status_code >= 400:
+                raise CommandError(
+                    f"{request.__name__} failed with {response.status_code}: "
+                    f"{response.content[:200]}"
+                )
+            if i >= warmup:
+                latencies.append(latency * 1000)
+                queries.append(len(context.captured_queries))
+
+        return {
+            "iterations": iterations,
+            "mean_ms": statistics.mean(latencies),
+            "p50_ms": percentile(latencies, 50),
+            "p90_ms": percentile(latencies, 90),
+            "p99_ms": percentile(latencies, 99),
+            "max_ms": max(latencies),
+            "queries": max(queries),
+            # Response cache hits and misses, warmup included
+            "cache_hits": response_cache.stats["hit"] - cache_stats["hit"],
+            "cache_misses": response_cache.stats["miss"] - cache_stats["miss"],
+        }
+
+    def report(self, name, result):
+        self.stdout.write(
+            f"{name:<21} p50 {result['p50_ms']:8.2f} ms  "
+            f"p90 {result['p90_ms']:8.2f} ms  "
+            f"p99 {result['p99_ms']:8.2f} ms  "
+            f"queries {result['queries']}  "
+            f"cache hits {result['cache_hits']}/"
+            f"{result['cache_hits'] + result['cache_misses']}"
+        )
+
+    def meta(self, options):
+        return {
+            "timestamp": timezone.now().isoformat(),
+            "python": platform.python_version(),
+            "database": connection.vendor,
+            "response_cache": options["response_cache"],
+            "username": self.user.username,
+            "iterations": options["iterations"],
+            "rows": {
+                "users": User.objects.count(),
+                "chats": Chat.objects.count(),
+                "messages": Message.objects.count(),
+                "friend_requests": FriendRequest.objects.count(),
+            },
+        }
+
+    # Benchmarked requests
+
+    def list_chats(self):
+        return self.client.get(f"/chat/list/{self.user.username}/")
+
+    def list_messages(self):
+        return self.client.get(
+            f"/chat/messages/list/{self.chat.id}/", {"limit": 50}
+        )
+
+    def create_chat(self):
+        return self.client.post("/chat/create/", {
+            "participants": [str(self.user.id), str(self.stranger.id)],
+            "room_name": "benchmark",
+            "last_message": timezone.now().isoformat(),
+        }, format="json")
+
+    def send_request(self):
+        return self.client.post("/chat/requests/send/", {
+            "received_from": self.stranger.username,
+        }, format="json")
+
+    # Deletion of the rows written by the benchmarked requests, including
+    # the deletion records the sync endpoint would report
+
+    def undo_create_chat(self):
+        with transaction.atomic():
+            chats = list(Chat.objects.filter(
+                participants_key=Chat.participants_signature([self.user, self.stranger]),
+            ).values_list("id", flat=True))
+            Chat.objects.filter(id__in=chats).delete()
+            SyncTombstone.objects.filter(object_id__in=chats).delete()
+
+    def undo_send_request(self):
+        with transaction.atomic():
+            requests = list(FriendRequest.objects.filter(
+                sent_from=self.user, received_from=self.stranger,
+            ).values_list("id", flat=True))
+            FriendRequest.objects.filter(id__in=requests).delete()
+            SyncTombstone.objects.filter(object_id__in=requests).delete()
+
+    def list_requests(self):
+        return self.client.get("/chat/requests/list/")
+
+    def add_contact(self):
+        return self.client.put("/users/contacts/add/", {
+            "contacts": [str(self.stranger.id)],
+        }, format="json")
+
+    def undo_add_contact(self):
+        if not self.was_contact:
+            Profile.objects.get(user=self.user).contacts.remove(self.stranger)
@@ -0,0 +1,87 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from restapi.utils.purge import (
+    claim_job,
+    delete_old_tombstones,
+    delete_stale_requests,
+    pending_jobs,
+    queue_orphaned_chats,
+    run_purge_job,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Purge deleted users and orphaned chats in small batches, and delete "
+        "stale friend requests and old sync tombstones"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.PURGE["BATCH_SIZE"],
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=settings.PURGE["PAUSE"],
+            help="Seconds between two batches",
+        )
+        parser.add_argument(
+            "--stale-request-days",
+            type=int,
+            default=settings.PURGE["STALE_REQUEST_DAYS"],
+        )
+        parser.add_argument(
+            "--tombstone-days",
+            type=int,
+            default=settings.PURGE["TOMBSTONE_DAYS"],
+            help="Should not be shorter than PURGE[\"TOMBSTONE_DAYS\"], "
+                 "which sync tokens are trusted for",
+        )
+        parser.add_argument(
+            "--no-cleanup",
+            action="store_true",
+            help="Only run the queued jobs",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        batch_size = options["batch_size"]
+        pause = options["pause"]
+        self.verbosity = options["verbosity"]
+
+        if not options["no_cleanup"]:
+            queued = queue_orphaned_chats()
+            self.stdout.write(f"Queued {queued} orphaned chats")
+            deleted = delete_stale_requests(
+                options["stale_request_days"],
+                batch_size,
+                pause,
+            )
+            self.stdout.write(f"Deleted {deleted} stale friend requests")
+            deleted = delete_old_tombstones(
+                options["tombstone_days"],
+                batch_size,
+                pause,
+            )
+            self.stdout.write(f"Deleted {deleted} sync tombstones")
+
+        jobs = 0
+        for job in pending_jobs():
+            # Another worker may be running it
+            if not claim_job(job.pk):
+                continue
+            self.stdout.write(f"Purging {job.kind} {job.object_id}")
+            run_purge_job(job, batch_size, pause, self.report)
+            self.stdout.write(f"Purged {job.purged} rows")
+            jobs += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Finished {jobs} purge jobs"))
+
+    def report(self, job):
+        if self.verbosity > 1:
+            self.stdout.write(f"  {job.stage}: {job.purged} rows purged")
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from restapi.utils.search import (
+    create_message_index,
+    rebuild_message_index,
+    search_supported,
+)
+
+
+class Command(BaseCommand):
+    help = "Reindex every message for full-text search, e.g. after a VACUUM"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default="default")
+
+    def handle(self, *args, **options):
+        using = options["database"]
+        if not search_supported(using):
+            raise CommandError("Message search needs an SQLite database")
+
+        create_message_index(using)
+        rebuild_message_index(using)
+        self.stdout.write(self.style.SUCCESS("Message search index rebuilt"))
@@ -0,0 +1,162 @@
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from restapi.models import (
+    Chat,
+    ChatReadState,
+    FriendRequest,
+    Message,
+    Profile,
+    User,
+)
+
+
+class Command(BaseCommand):
+    help = "Seed the database with users, contacts, chats, messages and friend requests"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--contacts", type=int, default=20,
+                            help="Contacts per user")
+        parser.add_argument("--chats", type=int, default=5000)
+        parser.add_argument("--group-size", type=int, default=3,
+                            help="Maximum participants per chat")
+        parser.add_argument("--messages", type=int, default=100000)
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument("--prefix", default="user",
+                            help="Prefix of the generated usernames")
+        parser.add_argument("--password", default="click-benchmark")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options["seed"])
+        self.batch_size = options["batch_size"]
+
+        with transaction.atomic():
+            users = self.create_users(options)
+            self.create_contacts(users, options["contacts"])
+            chats = self.create_chats(
+                users, options["chats"], options["group_size"]
+            )
+            self.create_messages(chats, options["messages"])
+            self.create_requests(users, options["requests"])
+
+    def bulk_create(self, model, objects):
+        for start in range(0, len(objects), self.batch_size):
+            model.objects.bulk_create(objects[start:start + self.batch_size])
+
+    def create_users(self, options):
+        password = make_password(options["password"])
+        prefix = options["prefix"]
+        users = [
+            User(
+                username=f"{prefix}{i}",
+                email=f"{prefix}{i}@click.com",
+                first_name="Seed",
+                last_name=f"User{i}",
+                password=password,
+            )
+            for i in range(options["users"])
+        ]
+        self.bulk_create(User, users)
+        # bulk_create skips Profile.save, so no image is processed
+        self.bulk_create(Profile, [Profile(user=user) for user in users])
+        self.stdout.write(f"Created {len(users)} users and profiles")
+        return users
+
+    def create_contacts(self, users, per_user):
+        Contact = Profile.contacts.through
+        profiles = dict(
+            Profile.objects.filter(
+                user__in=users
+            ).values_list("user_id", "id")
+        )
+        contacts = []
+        for user in users:
+            for contact in self.random.sample(users, min(per_user, len(users))):
+                if contact.pk != user.pk:
+                    contacts.append(Contact(
+                        profile_id=profiles[user.pk],
+                        user_id=contact.pk,
+                    ))
+        self.bulk_create(Contact, contacts)
+        self.stdout.write(f"Created {len(contacts)} contacts")
+
+    def create_chats(self, users, count, group_size):
+        Participant = Chat.participants.through
+        now = timezone.now()
+        keys = set()
+        chats = []
+        participants = []
+        for _ in range(count * 2):
+            if len(chats) == count:
+                break
+            members = self.random.sample(
+                users, self.random.randint(2, max(2, group_size))
+            )
+            key = Chat.participants_signature(members)
+            if key in keys:
+                continue
+            keys.add(key)
+            chat = Chat(
+                room_name=f"room{len(chats)}",
+                last_message=now,
+                participants_key=key,
+            )
+            chat.usernames = [user.username for user in members]
+            chats.append(chat)
+            participants.extend(
+                Participant(chat_id=chat.pk, user_id=user.pk)
+                for user in members
+            )
+        self.bulk_create(Chat, chats)
+        self.bulk_create(Participant, participants)
+        # bulk_create sends no m2m_changed, so read states are added here
+        self.bulk_create(ChatReadState, [
+            ChatReadState(chat_id=p.chat_id, user_id=p.user_id)
+            for p in participants
+        ])
+        self.stdout.write(f"Created {len(chats)} chats")
+        return chats
+
+    def create_messages(self, chats, count):
+        if not chats:
+            return
+        # Skewed towards a few busy chats, like real traffic
+        weights = [1 / (rank + 1) for rank in range(len(chats))]
+        created = 0
+        while created < count:
+            size = min(self.batch_size, count - created)
+            batch_chats = self.random.choices(chats, weights, k=size)
+            Message.objects.bulk_create([
+                Message(
+                    chat_id=chat.pk,
+                    sent_from=self.random.choice(chat.usernames),
+                    text=f"Message {created + i}",
+                )
+                for i, chat in enumerate(batch_chats)
+            ])
+            created += size
+        self.stdout.write(f"Created {created} messages")
+
+    def create_requests(self, users, count):
+        pairs = set()
+        requests = []
+        for _ in range(count * 2):
+            if len(requests) == count:
+                break
+            sent_from, received_from = self.random.sample(users, 2)
+            if (sent_from.pk, received_from.pk) in pairs:
+                continue
+            pairs.add((sent_from.pk, received_from.pk))
+            requests.append(FriendRequest(
+                sent_from=sent_from,
+                received_from=received_from,
+            ))
+        self.bulk_create(FriendRequest, requests)
+        self.stdout.write(f"Created {len(requests)} friend requests")
@@ -0,0 +1,34 @@
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class Command(BaseCommand):
+    help = "Copy the primary SQLite database over the file replicas of DATABASE_REPLICAS"
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError("DATABASE_REPLICAS is empty")
+        aliases = [DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS]
+        if any(connections[alias].vendor != "sqlite" for alias in aliases):
+            raise CommandError("Replicas can only be copied between SQLite files")
+
+        primary = connections[DEFAULT_DB_ALIAS].settings_dict
+
+        source = sqlite3.connect(primary["NAME"])
+        try:
+            for alias in settings.DATABASE_REPLICAS:
+                replica = connections[alias].settings_dict
+                # The backup API copies a consistent snapshot while the
+                # primary keeps serving writes
+                connections[alias].close()
+                target = sqlite3.connect(replica["NAME"])
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+                self.stdout.write(f"Copied the primary to {alias}")
+        finally:
+            source.close()
@@ -1,8 +1,14 @@
+import hashlib
 import uuid
-from PIL import Image
 
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
+from django.db.models import DEFERRED
+from django.utils import timezone
+
+from .storage import ContentAddressedStorage
+from .utils.images import schedule_profile_image
 
 
 class User(AbstractUser):
@@ -23,25 +29,56 @@ class Profile(models.Model):
         related_name="profile",
         on_delete=models.CASCADE
     )
-    image = models.ImageField(default="default.jpeg", upload_to="profile_pics")
+    image = models.ImageField(
+        default="default.jpeg",
+        upload_to="profile_pics",
+        storage=ContentAddressedStorage(),
+    )
     contacts = models.ManyToManyField(
         User,
         related_name="contact",
         blank=True,
     )
+    contacts_updated = models.DateTimeField(default=timezone.now)
+    updated = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.user.username}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Unknown when the image was deferred, e.g. by only()
+        instance._loaded_image = instance.__dict__.get("image", DEFERRED)
+        return instance
+
+    def image_changed(self):
+        if not self.image or not self.image._committed:
+            return bool(self.image)
+        if self._state.adding:
+            return self.image.name != self._meta.get_field("image").default
+
+        loaded_image = getattr(self, "_loaded_image", self.image.name)
+        if loaded_image is DEFERRED:
+            loaded_image = Profile.objects.filter(
+                pk=self.pk,
+            ).values_list("image", flat=True).first()
+        return self.image.name != loaded_image
+
     def save(self, *args, **kwargs):
+        image_changed = self.image_changed()
         super().save(*args, **kwargs)
+        self._loaded_image = self.image.name
 
-        img = Image.open(self.image.path)
-
-        if img.height > 300 or img.width > 300:
-            output_size = (300, 300)
-            img.thumbnail(output_size)
-            img.save(self.image.path)
+        # Only decode and resize images that actually changed, after commit
+        if image_changed:
+            path = self.image.path
+            transaction.on_commit(lambda: schedule_profile_image(
+                path,
+                settings.PROFILE_IMAGE_SIZES,
+                settings.PROFILE_IMAGE_MAX_SIZE,
+                settings.PROFILE_IMAGE_WORKERS,
+            ))
 
 
 class Chat(models.Model):
@@ -49,12 +86,45 @@ class Chat(models.Model):
     # admin = models.ForeignKey(User)
     participants = models.ManyToManyField(User, related_name='chat')
     created = models.DateTimeField(auto_now_add=True, editable=False)
+    updated = models.DateTimeField(auto_now=True, db_index=True)
     room_name = models.CharField(max_length=50, default="")
     last_message = models.DateTimeField()
+    # Preview of the newest message, kept by bulk_save_messages
+    last_message_text = models.CharField(max_length=100, blank=True, default="")
+    last_message_sender = models.CharField(max_length=150, blank=True, default="")
+    # Canonical signature of the participant set, used for duplicate lookups
+    participants_key = models.CharField(
+        max_length=64,
+        unique=True,
+        null=True,
+        editable=False,
+    )
 
     def __str__(self):
         return f"{self.id}"
 
+    @staticmethod
+    def participants_signature(participants):
+        '''
+        Return a canonical key for a set of participants (users or user ids)
+        '''
+        ids = sorted({
+            str(uuid.UUID(str(getattr(p, "pk", p)))) for p in participants
+        })
+        return hashlib.sha256(",".join(ids).encode()).hexdigest()
+
+    def refresh_participants_key(self):
+        ids = self.participants.values_list("id", flat=True)
+        key = Chat.participants_signature(ids)
+        # Left by a participant, the chat may now have the participants of
+        # another one, which keeps the key
+        if Chat.objects.filter(participants_key=key).exclude(pk=self.pk).exists():
+            key = None
+        self.participants_key = key
+        Chat.objects.filter(pk=self.pk).update(
+            participants_key=self.participants_key
+        )
+
 
 class Message(models.Model):
     id = models.UUIDField(primary_key=True, editable=False, default=uuid.uuid4)
@@ -67,6 +137,78 @@ class Message(models.Model):
     sent_from = models.CharField(max_length=150)
     text = models.TextField(max_length=1000)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["chat", "created", "id"],
+                name="message_chat_created_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.id}"
+
+
+class MessageSegment(models.Model):
+    '''
+    Index of a compressed archive file holding a chat's messages from
+    (first_created, first_id) to (last_created, last_id), in this order.
+    A chat's segments never overlap and are older than its messages
+    still in the Message table.
+    '''
+    id = models.UUIDField(primary_key=True, editable=False, default=uuid.uuid4)
+    chat = models.ForeignKey(
+        Chat,
+        on_delete=models.CASCADE,
+        related_name="segments",
+    )
+    sequence = models.PositiveIntegerField()
+    # Relative to MESSAGE_ARCHIVE["ROOT"]
+    path = models.CharField(max_length=255)
+    count = models.PositiveIntegerField()
+    first_created = models.DateTimeField()
+    first_id = models.UUIDField()
+    last_created = models.DateTimeField()
+    last_id = models.UUIDField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["chat", "sequence"],
+                name="segment_chat_sequence_unique",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.id}"
+
+
+class ChatReadState(models.Model):
+    '''
+    Read high-water mark and unread message counter of a user in a chat
+    '''
+    id = models.UUIDField(primary_key=True, editable=False, default=uuid.uuid4)
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="read_states",
+    )
+    chat = models.ForeignKey(
+        Chat,
+        on_delete=models.CASCADE,
+        related_name="read_states",
+    )
+    last_read = models.DateTimeField(null=True, blank=True)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "chat"],
+                name="read_state_user_chat_unique",
+            ),
+        ]
+
     def __str__(self):
         return f"{self.id}"
 
@@ -87,3 +229,69 @@ class FriendRequest(models.Model):
 
     def __str__(self):
         return f"{self.id}"
+
+
+class SyncTombstone(models.Model):
+    '''
+    Record of an object deleted from a user's view, reported by the sync
+    endpoint. user_id is not a foreign key so tombstones can be written
+    while the user itself is being deleted.
+    '''
+    CHAT = "chat"
+    FRIEND_REQUEST = "friend_request"
+    KIND_CHOICES = (
+        (CHAT, "Chat"),
+        (FRIEND_REQUEST, "Friend request"),
+    )
+
+    id = models.UUIDField(primary_key=True, editable=False, default=uuid.uuid4)
+    user_id = models.UUIDField()
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    object_id = models.UUIDField()
+    deleted = models.DateTimeField(auto_now_add=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["user_id", "deleted"],
+                name="tombstone_user_deleted_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.id}"
+
+
+class PurgeJob(models.Model):
+    '''
+    Background deletion of a user or a chat with the rows depending on it,
+    in small batches. stage and purged report the progress, updated is
+    the time of the last batch.
+    '''
+    USER = "user"
+    CHAT = "chat"
+    KIND_CHOICES = (
+        (USER, "User"),
+        (CHAT, "Chat"),
+    )
+
+    id = models.UUIDField(primary_key=True, editable=False, default=uuid.uuid4)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    object_id = models.UUIDField()
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+    updated = models.DateTimeField(auto_now=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    stage = models.CharField(max_length=30, blank=True, default="")
+    purged = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["finished", "created"],
+                name="purge_job_finished_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.id}"
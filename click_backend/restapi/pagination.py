@@ -0,0 +1,285 @@
+import uuid
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.core.paginator import InvalidPage
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import (
+    BasePagination,
+    PageNumberPagination,
+    _positive_int,
+)
+from rest_framework.response import Response
+
+from .utils.archive import archived_after, archived_before, row_position
+
+
+def message_position(message):
+    '''
+    (created, id) of a message, a model instance or a serialized row
+    '''
+    if isinstance(message, dict):
+        return row_position(message)
+    return message.created, message.id
+
+
+class OptionalPageNumberPagination(PageNumberPagination):
+    '''
+    Page number pagination enabled only when the client asks for a page size,
+    so plain list responses stay unchanged for existing clients
+    '''
+    page_size = None
+    page_size_query_param = "page_size"
+    max_page_size = 100
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        '''
+        paginate_queryset with the async ORM interface
+        '''
+        self.request = request
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+
+        paginator = self.django_paginator_class(queryset, page_size)
+        # Counted here so that the paginator doesn't query
+        paginator.count = await queryset.acount()
+        page_number = self.get_page_number(request, paginator)
+        try:
+            self.page = paginator.page(page_number)
+        except InvalidPage as exc:
+            msg = self.invalid_page_message.format(
+                page_number=page_number, message=str(exc)
+            )
+            raise NotFound(msg)
+
+        self.page.object_list = [obj async for obj in self.page.object_list]
+        return self.page.object_list
+
+
+class MessageCursorPagination(BasePagination):
+    '''
+    Keyset pagination over (created, id) for a chat's messages.
+
+    ?limit=N returns the newest N messages, ?before=<cursor> pages towards
+    older messages and ?after=<cursor> towards newer ones. Every page is
+    returned oldest first, like the unpaginated list. Without any of these
+    parameters the full list is returned unchanged.
+
+    Pages continue into the archived messages of the chat given by the
+    view's get_archived_chat(), which are all older than the others. They
+    are not looked up when the after cursor is still in the table, e.g.
+    while polling for new messages.
+    '''
+    default_limit = 50
+    max_limit = 200
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        queryset = self.page_queryset(queryset, request)
+        if queryset is None:
+            return None
+        page = self.remove_anchor(list(queryset))
+        return self.set_page(self.add_archived(page, view))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        '''
+        paginate_queryset with the async ORM interface
+        '''
+        queryset = self.page_queryset(queryset, request)
+        if queryset is None:
+            return None
+        page = self.remove_anchor([message async for message in queryset])
+        # The archive is read with sync file and ORM calls
+        return self.set_page(await sync_to_async(self.add_archived)(page, view))
+
+    def page_queryset(self, queryset, request):
+        '''
+        Messages of the requested page, plus one telling whether there is
+        another page and the one the after cursor points to, if it's still
+        there. None when the list isn't paginated.
+        '''
+        params = request.query_params
+        if not any(key in params for key in ("limit", "before", "after")):
+            return None
+
+        self.limit = self.get_limit(request)
+        self.before = before = self.decode_cursor(params.get("before"))
+        self.after = after = self.decode_cursor(params.get("after"))
+
+        # Fetch one extra row to know whether there is another page
+        if after is not None:
+            created, pk = after
+            queryset = queryset.filter(
+                Q(created__gt=created) | Q(created=created, id__gte=pk)
+            ).order_by("created", "id")
+            return queryset[:self.limit + 2]
+
+        if before is not None:
+            created, pk = before
+            queryset = queryset.filter(
+                Q(created__lt=created) | Q(created=created, id__lt=pk)
+            )
+        return queryset.order_by("-created", "-id")[:self.limit + 1]
+
+    def remove_anchor(self, page):
+        '''
+        Remove the message the after cursor points to from the page
+        '''
+        self.anchor_in_table = bool(
+            self.after is not None and page
+            and message_position(page[0]) == self.after
+        )
+        return page[1:] if self.anchor_in_table else page[:self.limit + 1]
+
+    def add_archived(self, page, view):
+        '''
+        Complete the page of messages fetched by page_queryset with archived
+        ones, before them when paging towards newer messages and after them
+        otherwise
+        '''
+        get_archived_chat = getattr(view, "get_archived_chat", None)
+        chat_id = get_archived_chat() if get_archived_chat else None
+        if chat_id is None:
+            return page
+
+        missing = self.limit + 1 - len(page)
+        if self.anchor_in_table:
+            # The archive only holds messages older than the table's
+            return page
+        if self.after is not None:
+            archived = archived_after(chat_id, self.after, self.limit + 1)
+            page = archived + page
+        elif missing > 0:
+            boundary = message_position(page[-1]) if page else self.before
+            archived = archived_before(chat_id, boundary, missing)
+            page = page + archived
+        else:
+            return page
+
+        # A message archived while the page was read would appear twice
+        seen = set()
+        unique = []
+        for message in page:
+            pk = str(message_position(message)[1])
+            if pk not in seen:
+                seen.add(pk)
+                unique.append(message)
+        return unique[:self.limit + 1]
+
+    def set_page(self, page):
+        has_more = len(page) > self.limit
+        page = page[:self.limit]
+
+        if self.after is None:
+            page.reverse()
+            self.has_older, self.has_newer = has_more, self.before is not None
+        else:
+            self.has_older, self.has_newer = True, has_more
+
+        self.page = page
+        return page
+
+    def get_paginated_response(self, data):
+        older = newer = None
+        if self.page:
+            if self.has_older:
+                older = self.encode_cursor(self.page[0])
+            # The newest message is always a valid anchor for polling
+            newer = self.encode_cursor(self.page[-1])
+        return Response(OrderedDict([
+            ("before", older),
+            ("after", newer),
+            ("has_newer", self.has_newer),
+            ("results", data),
+        ]))
+
+    def get_limit(self, request):
+        try:
+            return _positive_int(
+                request.query_params["limit"],
+                strict=True,
+                cutoff=self.max_limit,
+            )
+        except (KeyError, ValueError):
+            return self.default_limit
+
+    def encode_cursor(self, message):
+        # Messages may also be rows of a values() queryset or the archive
+        if isinstance(message, dict):
+            created, pk = message["created"], message["id"]
+        else:
+            created, pk = message.created, message.id
+        if not isinstance(created, str):
+            created = created.isoformat()
+        position = f"{created}|{pk}"
+        return urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, encoded):
+        if encoded is None:
+            return None
+        try:
+            created, pk = urlsafe_b64decode(encoded.encode()).decode().split("|")
+            created = datetime.fromisoformat(created.replace("Z", "+00:00"))
+            return created, uuid.UUID(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+
+class MessageSearchPagination(BasePagination):
+    '''
+    Keyset pagination over (rank, rowid) for message search results, best
+    match first. ?limit=N sets the page size and ?cursor=<cursor> returns
+    the page after it. Ranks shift slightly as messages are added, so a
+    result close to a page boundary may be repeated or skipped.
+    '''
+    default_limit = 20
+    max_limit = 100
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, search, request, view=None):
+        '''
+        search is called with the page size and the position to start after
+        '''
+        self.limit = self.get_limit(request)
+        after = self.decode_cursor(request.query_params.get("cursor"))
+
+        page = search(self.limit + 1, after)
+        self.has_next = len(page) > self.limit
+        self.page = page[:self.limit]
+        return self.page
+
+    def get_paginated_response(self, data):
+        cursor = None
+        if self.has_next:
+            cursor = self.encode_cursor(self.page[-1])
+        return Response(OrderedDict([
+            ("cursor", cursor),
+            ("results", data),
+        ]))
+
+    def get_limit(self, request):
+        try:
+            return _positive_int(
+                request.query_params["limit"],
+                strict=True,
+                cutoff=self.max_limit,
+            )
+        except (KeyError, ValueError):
+            return self.default_limit
+
+    def encode_cursor(self, message):
+        position = f"{message.rank!r}|{message.fts_rowid}"
+        return urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, encoded):
+        if encoded is None:
+            return None
+        try:
+            rank, rowid = urlsafe_b64decode(encoded.encode()).decode().split("|")
+            return float(rank), int(rowid)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
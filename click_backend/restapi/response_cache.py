@@ -0,0 +1,171 @@
+import threading
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.response import Response
+
+from .models import Chat
+
+stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def enabled():
+    '''
+    Whether responses are cached. A cache local to the process is only
+    warned about by the restapi.W001 check, it is fine with one worker.
+    '''
+    return settings.RESPONSE_CACHE["ENABLED"]
+
+
+def _cache():
+    return caches[settings.RESPONSE_CACHE["ALIAS"]]
+
+
+def _version_key(resource, owner):
+    return f"response:{resource}:{owner}:version"
+
+
+def _record(outcome):
+    with _stats_lock:
+        stats[outcome] += 1
+
+
+def _response_key(resource, owner, version, request, etag):
+    return (
+        f"response:{resource}:{owner}:{version}:"
+        f"{request.user.pk}:{etag or ''}:{request.get_full_path()}"
+    )
+
+
+def response_key(resource, owner, request, etag=None):
+    '''
+    Key of a response, valid until the resource of owner is invalidated.
+    Every variant of the resource, e.g. every page, shares its version.
+    With the ETag of a conditional view, only a response computed for it
+    is served, so the body never lags behind its ETag.
+    '''
+    cache = _cache()
+    version_key = _version_key(resource, owner)
+    version = cache.get(version_key)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(version_key, version, None)
+        version = cache.get(version_key, version)
+    return _response_key(resource, owner, version, request, etag)
+
+
+async def aresponse_key(resource, owner, request, etag=None):
+    '''
+    response_key with the async cache interface
+    '''
+    cache = _cache()
+    version_key = _version_key(resource, owner)
+    version = await cache.aget(version_key)
+    if version is None:
+        version = uuid.uuid4().hex
+        await cache.aadd(version_key, version, None)
+        version = await cache.aget(version_key, version)
+    return _response_key(resource, owner, version, request, etag)
+
+
+def invalidate(resource, *owners):
+    '''
+    Drop every cached response of the resource of each owner. It is done
+    again once the current transaction commits, so a response computed from
+    uncommitted data in between is dropped too.
+    '''
+    if not enabled() or not owners:
+        return
+
+    def bump():
+        _cache().set_many(
+            {_version_key(resource, owner): uuid.uuid4().hex for owner in owners},
+            None,
+        )
+
+    bump()
+    transaction.on_commit(bump)
+
+
+def invalidate_chats(chat_ids):
+    '''
+    Invalidate the given chats and the chat lists of their participants
+    '''
+    if not enabled() or not chat_ids:
+        return
+
+    user_ids = Chat.participants.through.objects.filter(
+        chat_id__in=chat_ids,
+    ).values_list("user_id", flat=True).distinct()
+    invalidate("chat", *chat_ids)
+    invalidate("chats", *user_ids)
+
+
+class CachedResponseMixin:
+    '''
+    Serve GET responses from the response cache, per requesting user and
+    per owner of cache_resource. Views return None from get_cache_owner to
+    skip the cache.
+    '''
+    cache_resource = None
+
+    def get_cache_owner(self):
+        return self.request.user.pk
+
+    def get(self, request, *args, **kwargs):
+        owner = self.get_cache_owner() if enabled() else None
+        if owner is None:
+            return super().get(request, *args, **kwargs)
+
+        key = response_key(
+            self.cache_resource, owner, request, getattr(self, "etag", None)
+        )
+        data = _cache().get(key)
+        if data is not None:
+            _record("hit")
+            return Response(data, headers={"X-Cache": "HIT"})
+
+        _record("miss")
+        response = super().get(request, *args, **kwargs)
+        if response.status_code == 200:
+            _cache().set(key, response.data, settings.RESPONSE_CACHE["TIMEOUT"])
+        response["X-Cache"] = "MISS"
+        return response
+
+
+class AsyncCachedResponseMixin:
+    '''
+    CachedResponseMixin for async views
+    '''
+    cache_resource = None
+
+    def get_cache_owner(self):
+        return self.request.user.pk
+
+    async def get(self, request, *args, **kwargs):
+        owner = self.get_cache_owner() if enabled() else None
+        if owner is None:
+            return await super().get(request, *args, **kwargs)
+
+        key = await aresponse_key(
+            self.cache_resource, owner, request, getattr(self, "etag", None)
+        )
+        data = await _cache().aget(key)
+        if data is not None:
+            _record("hit")
+            return Response(data, headers={"X-Cache": "HIT"})
+
+        _record("miss")
+        response = await super().get(request, *args, **kwargs)
+        if response.status_code == 200:
+            await _cache().aset(
+                key,
+                response.data,
+                settings.RESPONSE_CACHE["TIMEOUT"],
+            )
+        response["X-Cache"] = "MISS"
+        return response
@@ -0,0 +1,141 @@
+import asyncio
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+_request_state = ContextVar("request_state", default=None)
+
+
+class RequestState:
+    '''
+    What the router needs to know about the request being served
+    '''
+
+    def __init__(self, method):
+        self.method = method
+        self.user_id = None
+        self.pinned = False
+        # Picked on the first read
+        self.replica = None
+
+
+def pin_key(user_id):
+    return f"replica-pin:{user_id}"
+
+
+def bind_request_user(user_id):
+    '''
+    Called once the request is authenticated. The user's reads stay on the
+    primary if they wrote recently.
+    '''
+    state = _request_state.get()
+    if state is None or not settings.DATABASE_REPLICAS:
+        return
+    state.user_id = user_id
+    if state.method in SAFE_METHODS:
+        state.pinned = cache.get(pin_key(user_id)) is not None
+
+
+class PrimaryReplicaRouter:
+    '''
+    Send the reads of safe HTTP requests to an alias of DATABASE_REPLICAS,
+    picked at random once per request so that all of its reads see the
+    same replication lag, and everything else to the primary.
+
+    After a write, the user's reads stay on the primary for
+    REPLICA_PIN_SECONDS so that they see their own changes despite
+    replication lag. Pins live in the default cache, which must be shared
+    by all workers for this to hold across processes.
+    '''
+    # Freshly issued tokens have to authenticate right away
+    primary_models = ("knox.authtoken",)
+
+    def db_for_read(self, model, **hints):
+        if not settings.DATABASE_REPLICAS or not self.can_use_replica(model):
+            return DEFAULT_DB_ALIAS
+        state = _request_state.get()
+        if state.replica is None:
+            state.replica = random.choice(settings.DATABASE_REPLICAS)
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+    def can_use_replica(self, model):
+        state = _request_state.get()
+        if state is None or state.method not in SAFE_METHODS or state.pinned:
+            return False
+        if model._meta.label_lower in self.primary_models:
+            return False
+        # Reads inside a transaction must see its writes
+        return not connections[DEFAULT_DB_ALIAS].in_atomic_block
+
+
+class ReplicaRoutingMiddleware:
+    '''
+    Record the request for PrimaryReplicaRouter and pin users to the
+    primary after their writes. Async under ASGI, so that async views
+    aren't run in a thread.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Django checks for the marker to call the middleware async
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        state = RequestState(request.method)
+        token = _request_state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_state.reset(token)
+
+        if self.wrote(request, state):
+            cache.set(
+                pin_key(state.user_id),
+                True,
+                settings.REPLICA_PIN_SECONDS,
+            )
+        return response
+
+    async def __acall__(self, request):
+        state = RequestState(request.method)
+        token = _request_state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_state.reset(token)
+
+        if self.wrote(request, state):
+            await cache.aset(
+                pin_key(state.user_id),
+                True,
+                settings.REPLICA_PIN_SECONDS,
+            )
+        return response
+
+    def wrote(self, request, state):
+        return (
+            settings.DATABASE_REPLICAS
+            and state.user_id is not None
+            and request.method not in SAFE_METHODS
+        )
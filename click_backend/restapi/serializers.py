@@ -1,10 +1,16 @@
+import uuid
 from statistics import mode
 from wsgiref import validate
+from django.conf import settings
 from django.contrib.auth import authenticate
+from django.db import transaction
+from django.utils.html import escape
 from django.contrib.auth.password_validation import validate_password
 from rest_framework.validators import UniqueValidator
 from rest_framework import serializers
 
+from .utils.images import variant_path
+from .utils.utils import bulk_save_messages
 from .models import (
     User,
     Profile,
@@ -14,18 +20,71 @@ from .models import (
 )
 
 
-class UserSerializer(serializers.ModelSerializer):
+def requested_fields(request):
+    '''
+    Names in the ?fields=a,b query parameter of a safe request, or None
+    '''
+    if request is None or request.method not in ("GET", "HEAD"):
+        return None
+    fields = request.query_params.get("fields")
+    if not fields:
+        return None
+    return {name.strip() for name in fields.split(",") if name.strip()}
+
+
+class SparseFieldsMixin:
+    '''
+    Serializer returning only the fields named in ?fields=, unknown names
+    are ignored
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        requested = requested_fields(self.context.get("request"))
+        if requested is not None and requested & set(self.fields):
+            for name in set(self.fields) - requested:
+                self.fields.pop(name)
+
+
+class UserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     class Meta:
         model = User
-        fields = "__all__"
+        # Never expose the password hash or the permission fields
+        fields = (
+            "id",
+            "username",
+            "email",
+            "first_name",
+            "last_name",
+            "date_joined",
+        )
 
 
-class ProfileSerializer(serializers.ModelSerializer):
+class ProfileSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    image_variants = serializers.SerializerMethodField()
 
     class Meta:
         model = Profile
         fields = "__all__"
+        read_only_fields = ("contacts_updated",)
+
+    def get_image_variants(self, obj):
+        '''
+        URL of every pre-generated size of the image, keyed by size
+        '''
+        image = obj.image
+        if not image or image.name == Profile._meta.get_field("image").default:
+            return {}
+
+        request = self.context.get("request")
+        variants = {}
+        for size in settings.PROFILE_IMAGE_SIZES:
+            url = image.storage.url(variant_path(image.name, size))
+            variants[str(size)] = (
+                request.build_absolute_uri(url) if request is not None else url
+            )
+        return variants
 
 
 class CreateUserSerializer(serializers.ModelSerializer):
@@ -80,40 +139,119 @@ class LoginSerializer(serializers.Serializer):
         raise serializers.ValidationError('Incorrect credentials.')
 
 
-class ChatSerializer(serializers.ModelSerializer):
+class ChatSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Chat
-        fields = "__all__"
+        exclude = ("participants_key",)
+        read_only_fields = ("last_message_text", "last_message_sender")
 
     def create(self, validated_data):
-        chat = Chat.objects.create(
-            room_name=validated_data['room_name'],
-            last_message=validated_data['last_message'],
-        )
-        chat.participants.set(validated_data['participants'])
-        chat.save()
+        # The unique participants_key makes the db reject racing duplicates
+        with transaction.atomic():
+            chat = Chat.objects.create(
+                room_name=validated_data['room_name'],
+                last_message=validated_data['last_message'],
+                participants_key=Chat.participants_signature(
+                    validated_data['participants']
+                ),
+            )
+            chat.participants.set(validated_data['participants'])
 
         return chat
 
 
-class MessageSerializer(serializers.ModelSerializer):
+class ListChatSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    participants = serializers.SlugRelatedField(
+        many=True,
+        read_only=True,
+        slug_field="username",
+    )
+
+    class Meta:
+        model = Chat
+        exclude = ("participants_key",)
+
+
+class InboxChatSerializer(ListChatSerializer):
+    unread_count = serializers.IntegerField(read_only=True)
+    last_read = serializers.DateTimeField(read_only=True)
+
+
+class PreloadedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    '''
+    Primary key field that first looks the object up in the instances
+    preloaded by a list serializer, to avoid one query per item
+    '''
+
+    def to_internal_value(self, data):
+        preloaded = getattr(self.parent, "preloaded", {}).get(self.field_name)
+        if preloaded is not None:
+            try:
+                return preloaded[uuid.UUID(str(data))]
+            except (KeyError, ValueError):
+                pass
+        return super().to_internal_value(data)
+
+
+class BulkMessageListSerializer(serializers.ListSerializer):
+    max_batch_size = 500
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            chat_ids = set()
+            for item in data:
+                try:
+                    chat_ids.add(uuid.UUID(str(item["chat"])))
+                except (KeyError, TypeError, ValueError):
+                    pass
+            self.child.preloaded = {
+                "chat": Chat.objects.in_bulk(list(chat_ids)),
+            }
+        return super().to_internal_value(data)
+
+    def validate(self, attrs):
+        if len(attrs) == 0:
+            raise serializers.ValidationError("Messages list can't be empty")
+        if len(attrs) > self.max_batch_size:
+            raise serializers.ValidationError(
+                f"At most {self.max_batch_size} messages can be saved at once"
+            )
+        return attrs
+
+    def create(self, validated_data):
+        return bulk_save_messages(
+            [Message(**item) for item in validated_data]
+        )
+
+
+class MessageSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    chat = PreloadedPrimaryKeyRelatedField(queryset=Chat.objects.all())
 
     class Meta:
         model = Message
         fields = "__all__"
+        list_serializer_class = BulkMessageListSerializer
 
     def create(self, validated_data):
 
-        message = Message.objects.create(
+        message = Message(
             text=validated_data['text'],
             chat=validated_data['chat'],
             sent_from=validated_data['sent_from']
         )
 
-        message.save()
+        return bulk_save_messages([message])[0]
+
+
+class SearchMessageSerializer(MessageSerializer):
+    snippet = serializers.SerializerMethodField()
 
-        return message
+    def get_snippet(self, obj):
+        # The message text is escaped, only the highlight markers are HTML
+        return escape(obj.snippet).replace(
+            "\x02", "<mark>"
+        ).replace("\x03", "</mark>")
 
 
 class ContactsSerializer(serializers.ModelSerializer):
@@ -148,7 +286,7 @@ class FriendRequestSerializer(serializers.ModelSerializer):
         return friendRequest
 
 
-class ListRequestSerializer(serializers.Serializer):
+class ListRequestSerializer(SparseFieldsMixin, serializers.Serializer):
     id = serializers.UUIDField()
     sent_from_id = serializers.UUIDField()
     sent_from_username = serializers.CharField()
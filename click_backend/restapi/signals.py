@@ -0,0 +1,265 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete,
+)
+from django.dispatch import receiver
+from django.utils import timezone
+from knox.models import AuthToken
+
+from . import response_cache
+from .authentication import token_cache
+from .utils.archive import delete_segment
+from .models import (
+    Chat,
+    ChatReadState,
+    FriendRequest,
+    Message,
+    MessageSegment,
+    Profile,
+    SyncTombstone,
+    User,
+)
+
+
+@receiver(m2m_changed, sender=Chat.participants.through)
+def sync_participants_key(sender, instance, action, reverse, pk_set, **kwargs):
+    '''
+    Keep Chat.participants_key in line with the participants relation
+    '''
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            instance.refresh_participants_key()
+        return
+
+    # Changed from the user side, e.g. user.chat.remove(chat)
+    if action == "pre_clear":
+        instance._cleared_chat_ids = list(
+            instance.chat.values_list("id", flat=True)
+        )
+        return
+
+    if action in ("post_add", "post_remove"):
+        chat_ids = pk_set
+    elif action == "post_clear":
+        chat_ids = getattr(instance, "_cleared_chat_ids", [])
+    else:
+        return
+
+    for chat in Chat.objects.filter(id__in=chat_ids):
+        chat.refresh_participants_key()
+
+
+@receiver(m2m_changed, sender=Chat.participants.through)
+def sync_read_states(sender, instance, action, reverse, pk_set, **kwargs):
+    '''
+    Keep one ChatReadState per participant of a chat
+    '''
+    if action == "post_add":
+        ChatReadState.objects.bulk_create(
+            [
+                ChatReadState(user_id=pk, chat_id=instance.pk) if not reverse
+                else ChatReadState(user_id=instance.pk, chat_id=pk)
+                for pk in pk_set
+            ],
+            ignore_conflicts=True,
+        )
+    elif action == "post_remove":
+        if reverse:
+            states = ChatReadState.objects.filter(user=instance, chat__in=pk_set)
+        else:
+            states = ChatReadState.objects.filter(chat=instance, user__in=pk_set)
+        states.delete()
+    elif action == "post_clear":
+        if reverse:
+            ChatReadState.objects.filter(user=instance).delete()
+        else:
+            ChatReadState.objects.filter(chat=instance).delete()
+
+
+@receiver(m2m_changed, sender=Chat.participants.through)
+def track_participant_changes(sender, instance, action, reverse, pk_set, **kwargs):
+    '''
+    Mark chats as updated for the sync endpoint, and leave a tombstone for
+    users removed from a chat
+    '''
+    if action not in ("pre_clear", "post_add", "post_remove"):
+        return
+
+    if action == "pre_clear":
+        if reverse:
+            pairs = [
+                (instance.pk, chat_id)
+                for chat_id in instance.chat.values_list("id", flat=True)
+            ]
+        else:
+            pairs = [
+                (user_id, instance.pk)
+                for user_id in instance.participants.values_list("id", flat=True)
+            ]
+    elif reverse:
+        pairs = [(instance.pk, chat_id) for chat_id in pk_set]
+    else:
+        pairs = [(user_id, instance.pk) for user_id in pk_set]
+
+    Chat.objects.filter(
+        pk__in={chat_id for _, chat_id in pairs}
+    ).update(updated=timezone.now())
+
+    if action != "post_add":
+        SyncTombstone.objects.bulk_create([
+            SyncTombstone(
+                user_id=user_id,
+                kind=SyncTombstone.CHAT,
+                object_id=chat_id,
+            )
+            for user_id, chat_id in pairs
+        ])
+
+
+@receiver(pre_delete, sender=Chat)
+def track_chat_deletion(sender, instance, **kwargs):
+    SyncTombstone.objects.bulk_create([
+        SyncTombstone(
+            user_id=user_id,
+            kind=SyncTombstone.CHAT,
+            object_id=instance.pk,
+        )
+        for user_id in instance.participants.values_list("id", flat=True)
+    ])
+
+
+@receiver(post_delete, sender=FriendRequest)
+def track_friend_request_deletion(sender, instance, **kwargs):
+    SyncTombstone.objects.bulk_create([
+        SyncTombstone(
+            user_id=user_id,
+            kind=SyncTombstone.FRIEND_REQUEST,
+            object_id=instance.pk,
+        )
+        for user_id in (instance.sent_from_id, instance.received_from_id)
+    ])
+
+
+@receiver(m2m_changed, sender=Profile.contacts.through)
+def track_contact_changes(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear" and reverse:
+        instance._cleared_contact_profiles = list(
+            instance.contact.values_list("id", flat=True)
+        )
+        return
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    if not reverse:
+        profile_ids = [instance.pk]
+    elif action == "post_clear":
+        profile_ids = getattr(instance, "_cleared_contact_profiles", [])
+    else:
+        profile_ids = pk_set
+    Profile.objects.filter(
+        pk__in=profile_ids
+    ).update(contacts_updated=timezone.now())
+
+
+@receiver(post_save, sender=Chat)
+@receiver(pre_delete, sender=Chat)
+def invalidate_chat_responses(sender, instance, **kwargs):
+    # Before the delete, while the participants are still known
+    response_cache.invalidate_chats([instance.pk])
+
+
+@receiver(m2m_changed, sender=Chat.participants.through)
+def invalidate_participant_responses(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear":
+        # The removed participants lose the chat from their list
+        chat_ids = (
+            instance.chat.values_list("id", flat=True) if reverse
+            else [instance.pk]
+        )
+        response_cache.invalidate_chats(list(chat_ids))
+        return
+    if action not in ("post_add", "post_remove"):
+        return
+
+    if reverse:
+        response_cache.invalidate("chats", instance.pk)
+        response_cache.invalidate_chats(list(pk_set))
+    else:
+        response_cache.invalidate("chats", *pk_set)
+        response_cache.invalidate_chats([instance.pk])
+
+
+@receiver(post_save, sender=Message)
+def invalidate_message_responses(sender, instance, **kwargs):
+    # Message deletes are not tracked: they only happen when their chat is
+    # deleted, and a receiver would disable fast cascade deletes
+    response_cache.invalidate_chats([instance.chat_id])
+
+
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+def invalidate_profile_responses(sender, instance, **kwargs):
+    response_cache.invalidate("profile", instance.user_id)
+    response_cache.invalidate("contacts", instance.user_id)
+
+
+@receiver(m2m_changed, sender=Profile.contacts.through)
+def invalidate_contact_responses(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("pre_clear", "post_add", "post_remove"):
+        return
+
+    if not reverse:
+        user_ids = [instance.user_id]
+    elif action == "pre_clear":
+        user_ids = instance.contact.values_list("user_id", flat=True)
+    else:
+        user_ids = Profile.objects.filter(
+            pk__in=pk_set,
+        ).values_list("user_id", flat=True)
+    user_ids = list(user_ids)
+    response_cache.invalidate("profile", *user_ids)
+    response_cache.invalidate("contacts", *user_ids)
+
+
+@receiver(post_save, sender=FriendRequest)
+@receiver(post_delete, sender=FriendRequest)
+def invalidate_request_responses(sender, instance, **kwargs):
+    response_cache.invalidate(
+        "requests",
+        instance.sent_from_id,
+        instance.received_from_id,
+    )
+
+
+@receiver(post_delete, sender=AuthToken)
+def invalidate_cached_token(sender, instance, **kwargs):
+    token_cache.invalidate(instance.digest)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user_tokens(sender, instance, **kwargs):
+    token_cache.invalidate_user(instance.pk)
+
+
+@receiver(post_delete, sender=MessageSegment)
+def delete_segment_file(sender, instance, **kwargs):
+    # Only once the segment is gone for good, e.g. with its chat
+    transaction.on_commit(lambda: delete_segment(instance.path))
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    '''
+    Tune new SQLite connections with the PRAGMAS of their DATABASES entry
+    '''
+    pragmas = connection.settings_dict.get("PRAGMAS", {})
+    if connection.vendor != "sqlite" or not pragmas:
+        return
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
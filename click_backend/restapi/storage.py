@@ -0,0 +1,64 @@
+import hashlib
+import os
+import re
+import uuid
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+# dir/3f/3fa4...e1.jpg, or one of its size variants dir/3f/3fa4...e1_96px.jpg
+HASHED_NAME = re.compile(r"(?:^|/)([0-9a-f]{2})/\1[0-9a-f]{62}(?:_\d+px)?\.\w+$")
+
+
+def is_content_addressed(name):
+    '''
+    Whether the file at name never changes, so it can be cached forever
+    '''
+    return HASHED_NAME.search(name) is not None
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    '''
+    File storage naming files after the SHA-256 of their content, e.g.
+    profile_pics/3f/3fa4...e1.jpg. Identical uploads are stored once and a
+    name always refers to the same bytes, so its URL can be cached forever.
+    '''
+
+    def save(self, name, content, max_length=None):
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+        name = self.hashed_name(name, content)
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length=max_length)
+
+    def get_available_name(self, name, max_length=None):
+        # An existing file with this name has the same content
+        return name
+
+    def _save(self, name, content):
+        '''
+        Write the file aside and link it in place, so an identical upload
+        saved at the same time finds either no file or the complete one,
+        which is then reused
+        '''
+        partial = super()._save(f"{name}.{uuid.uuid4().hex}.part", content)
+        try:
+            os.link(self.path(partial), self.path(name))
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(self.path(partial))
+        return name
+
+    def hashed_name(self, name, content):
+        digest = hashlib.sha256()
+        content.seek(0)
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+
+        directory, filename = os.path.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+        digest = digest.hexdigest()
+        return os.path.join(directory, digest[:2], f"{digest}{extension}")
@@ -0,0 +1,35 @@
+from django.test import TestCase
+from django.utils import timezone
+from knox.models import AuthToken
+from rest_framework.test import APIClient
+
+from .models import Chat, User
+
+
+def create_user(username):
+    return User.objects.create(
+        username=username,
+        email=f"{username}@click.com",
+    )
+
+
+def create_chat(participants):
+    chat = Chat.objects.create(
+        last_message=timezone.now(),
+        participants_key=Chat.participants_signature(participants),
+    )
+    chat.participants.set(participants)
+    return chat
+
+
+class AuthenticatedTestCase(TestCase):
+    '''
+    TestCase with an APIClient authenticated with a new token of a user
+    '''
+
+    def authenticate(self, user):
+        self.client = APIClient()
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f"Token {AuthToken.objects.create(user)[1]}"
+        )
+        return self.client
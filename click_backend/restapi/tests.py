@@ -1,3 +1,1384 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from concurrent.futures import Future
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.http import HttpResponse
+from django.test import (
+    AsyncClient,
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from knox.models import AuthToken
+from PIL import Image
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from .authentication import TokenCache
+from .checks import check_response_cache
+from .models import (
+    Chat,
+    ChatReadState,
+    FriendRequest,
+    Message,
+    MessageSegment,
+    Profile,
+    PurgeJob,
+    SyncTombstone,
+    User,
+)
+from .pagination import MessageCursorPagination
+from .serializers import (
+    ListChatSerializer,
+    MessageSerializer,
+    ProfileSerializer,
+)
+from .storage import is_content_addressed
+from .testing import AuthenticatedTestCase, create_chat, create_user
+from .views.chat_views import listChats, listMessages, saveMessage
+from .views.sync_views import SyncAPIView
+from .utils.images import process_profile_image, variant_path
+from .utils.purge import _report_failure, delete_user
+from .utils.utils import bulk_save_messages, chat_exists
+from .routers import (
+    PrimaryReplicaRouter,
+    ReplicaRoutingMiddleware,
+    bind_request_user,
+)
+
+
+class ParticipantsKeyTestCase(TestCase):
+
+    def setUp(self):
+        self.alice = create_user("alice")
+        self.bob = create_user("bob")
+        self.carol = create_user("carol")
+
+    def test_chat_exists_ignores_order(self):
+        create_chat([self.alice, self.bob])
+
+        self.assertTrue(chat_exists([self.bob.pk, self.alice.pk]))
+        self.assertTrue(chat_exists([str(self.alice.pk), str(self.bob.pk)]))
+        self.assertFalse(chat_exists([self.alice.pk, self.carol.pk]))
+        self.assertFalse(chat_exists([self.alice.pk, self.bob.pk, self.carol.pk]))
+
+    def test_key_follows_participants(self):
+        chat = create_chat([self.alice, self.bob])
+
+        chat.participants.add(self.carol)
+        self.assertTrue(chat_exists([self.alice, self.bob, self.carol]))
+        self.assertFalse(chat_exists([self.alice, self.bob]))
+
+        # Changed from the user side
+        self.carol.chat.remove(chat)
+        chat.refresh_from_db()
+        self.assertEqual(
+            chat.participants_key,
+            Chat.participants_signature([self.alice, self.bob]),
+        )
+
+    def test_backfill_merges_duplicates(self):
+        chats = []
+        for text in ("first", "second"):
+            chat = Chat.objects.create(last_message=timezone.now())
+            chat.participants.set([self.alice, self.bob])
+            Chat.objects.filter(pk=chat.pk).update(participants_key=None)
+            Message.objects.create(chat=chat, sent_from="alice", text=text)
+            chats.append(chat)
+
+        call_command("backfill_participants_keys", stdout=io.StringIO())
+
+        chat = Chat.objects.get()
+        self.assertEqual(chat.pk, chats[0].pk)
+        self.assertTrue(chat_exists([self.alice, self.bob]))
+        self.assertEqual(
+            sorted(chat.message.values_list("text", flat=True)),
+            ["first", "second"],
+        )
+        self.assertTrue(SyncTombstone.objects.filter(
+            user_id=self.bob.pk,
+            object_id=chats[1].pk,
+        ).exists())
+
+
+class ListChatsTestCase(AuthenticatedTestCase):
+
+    def setUp(self):
+        self.user = create_user("owner")
+        self.authenticate(self.user)
+        # Authenticate once so that the token is cached
+        self.client.get("/chat/list/owner/")
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response
+
+    def test_participants_are_usernames(self):
+        friend = create_user("friend")
+        create_chat([self.user, friend])
+        create_chat([create_user("stranger"), friend])
+
+        _, response = self.count_queries("/chat/list/owner/")
+
+        self.assertEqual(len(response.json()), 1)
+        self.assertEqual(
+            sorted(response.json()[0]["participants"]),
+            ["friend", "owner"],
+        )
+
+    def test_query_count_is_flat(self):
+        create_chat([self.user, create_user("first")])
+        few, _ = self.count_queries("/chat/list/owner/")
+
+        for i in range(20):
+            create_chat([
+                self.user,
+                create_user(f"user{i}"),
+                create_user(f"other{i}"),
+            ])
+        many, response = self.count_queries("/chat/list/owner/")
+
+        self.assertEqual(len(response.json()), 21)
+        self.assertEqual(few, many)
+
+    def test_pagination(self):
+        for i in range(5):
+            create_chat([self.user, create_user(f"user{i}")])
+
+        _, response = self.count_queries("/chat/list/owner/?page_size=2")
+
+        self.assertEqual(response.json()["count"], 5)
+        self.assertEqual(len(response.json()["results"]), 2)
+        self.assertIsNotNone(response.json()["next"])
+
+
+class MessagePaginationTestCase(AuthenticatedTestCase):
+
+    def setUp(self):
+        self.user = create_user("owner")
+        self.chat = create_chat([self.user, create_user("friend")])
+        start = timezone.now() - timedelta(hours=1)
+        for i in range(6):
+            message = Message.objects.create(
+                chat=self.chat,
+                sent_from="owner",
+                text=f"message {i}",
+            )
+            # Messages 2 and 3 share their timestamp
+            Message.objects.filter(id=message.id).update(
+                created=start + timedelta(minutes=[0, 1, 2, 2, 3, 4][i]),
+            )
+        self.texts = [
+            message.text for message in
+            Message.objects.filter(chat=self.chat).order_by("created", "id")
+        ]
+
+        self.authenticate(self.user)
+        self.url = f"/chat/messages/list/{self.chat.id}/"
+
+    def page(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_limit_returns_the_newest_messages(self):
+        page = self.page(limit=2)
+
+        self.assertEqual([m["text"] for m in page["results"]], self.texts[-2:])
+        self.assertIsNotNone(page["before"])
+        self.assertFalse(page["has_newer"])
+
+    def test_before_pages_through_every_message(self):
+        # A limit of 3 puts the messages sharing a timestamp on two pages
+        for limit in (2, 3):
+            texts = []
+            page = self.page(limit=limit)
+            while True:
+                texts = [m["text"] for m in page["results"]] + texts
+                if page["before"] is None:
+                    break
+                page = self.page(before=page["before"], limit=limit)
+                self.assertTrue(page["has_newer"])
+
+            self.assertEqual(texts, self.texts)
+
+    def test_after_returns_newer_messages(self):
+        oldest = self.page(limit=4)["before"]
+
+        page = self.page(after=oldest, limit=2)
+
+        self.assertEqual([m["text"] for m in page["results"]], self.texts[-3:-1])
+        self.assertTrue(page["has_newer"])
+
+        # Polling from the newest message
+        page = self.page(after=self.page(limit=1)["after"])
+        self.assertEqual(page["results"], [])
+        self.assertFalse(page["has_newer"])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {"before": "not-a-cursor"})
+
+        self.assertEqual(response.status_code, 404)
+
+
+class SaveMessagesTestCase(AuthenticatedTestCase):
+
+    def setUp(self):
+        self.user = create_user("owner")
+        self.chats = [
+            create_chat([self.user, create_user("friend")]),
+            create_chat([self.user, create_user("other")]),
+        ]
+        self.authenticate(self.user)
+        # Authenticate once so that the token is cached
+        self.client.get("/chat/list/owner/")
+
+    def messages(self, count):
+        return [
+            {
+                "chat": str(self.chats[i % 2].id),
+                "sent_from": "owner",
+                "text": f"message {i}",
+            }
+            for i in range(count)
+        ]
+
+    def save(self, data):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post("/chat/save_message/", data, format="json")
+        return len(ctx.captured_queries), response
+
+    def test_save_batch(self):
+        _, response = self.save(self.messages(3))
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.json()), 3)
+        self.assertEqual(Message.objects.count(), 3)
+        self.chats[0].refresh_from_db()
+        self.assertEqual(self.chats[0].last_message_text, "message 2")
+
+    def test_invalid_item(self):
+        data = self.messages(3)
+        data[1]["chat"] = str(uuid.uuid4())
+        del data[2]["text"]
+
+        _, response = self.save(data)
+
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()
+        self.assertEqual(errors[0], {})
+        self.assertIn("chat", errors[1])
+        self.assertIn("text", errors[2])
+        self.assertEqual(Message.objects.count(), 0)
+
+    def test_query_count_is_flat(self):
+        few, _ = self.save(self.messages(2))
+        many, response = self.save(self.messages(40))
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(few, many)
+
+
+class UnreadCountTestCase(AuthenticatedTestCase):
+
+    def setUp(self):
+        self.user = create_user("owner")
+        self.friend = create_user("friend")
+        self.chat = create_chat([self.user, self.friend])
+        self.authenticate(self.user)
+
+    def send(self, sent_from, count=1):
+        bulk_save_messages([
+            Message(chat=self.chat, sent_from=sent_from, text=f"message {i}")
+            for i in range(count)
+        ])
+
+    def unread_count(self):
+        response = self.client.get("/chat/inbox/")
+        self.assertEqual(response.status_code, 200)
+        return response.json()[0]["unread_count"]
+
+    def mark_read(self):
+        response = self.client.post(f"/chat/read/{self.chat.id}/")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_messages_of_others_are_unread(self):
+        self.send("friend", 3)
+        self.send("owner")
+
+        self.assertEqual(self.unread_count(), 3)
+        self.assertEqual(
+            ChatReadState.objects.get(user=self.friend).unread_count,
+            1,
+        )
+
+    def test_mark_read(self):
+        self.send("friend", 2)
+
+        self.assertEqual(self.mark_read()["unread_count"], 0)
+        self.assertEqual(self.unread_count(), 0)
+
+        self.send("friend")
+        self.assertEqual(self.unread_count(), 1)
+
+    def test_message_saved_while_marking_read_stays_unread(self):
+        self.send("friend")
+        read_until = Chat.objects.get(pk=self.chat.pk).last_message
+        self.send("friend")
+        # The view read last_message before the second message was saved
+        Chat.objects.filter(pk=self.chat.pk).update(last_message=read_until)
+
+        data = self.mark_read()
+
+        self.assertEqual(data["unread_count"], 1)
+        self.assertEqual(self.unread_count(), 1)
+
+    def test_read_mark_never_moves_back(self):
+        self.send("friend")
+        self.mark_read()
+        state = ChatReadState.objects.get(user=self.user)
+        Chat.objects.filter(pk=self.chat.pk).update(
+            last_message=state.last_read - timedelta(minutes=1),
+        )
+
+        self.mark_read()
+
+        self.assertEqual(ChatReadState.objects.get(user=self.user).last_read, state.last_read)
+
+
+class SyncTestCase(AuthenticatedTestCase):
+
+    def setUp(self):
+        self.user = create_user("owner")
+        self.friend = create_user("friend")
+        self.chat = create_chat([self.user, self.friend])
+        self.authenticate(self.user)
+
+    def sync(self, token=None):
+        response = self.client.get("/chat/sync/", {"token": token} if token else {})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def token_at(self, moment):
+        return SyncAPIView().encode_token(moment)
+
+    def test_full_sync(self):
+        data = self.sync()
+
+        self.assertTrue(data["full_sync"])
+        self.assertEqual([chat["id"] for chat in data["chats"]], [str(self.chat.id)])
+        self.assertEqual(data["messages"], [])
+
+    def test_messages_sharing_a_timestamp_are_not_skipped(self):
+        token = self.token_at(timezone.now() - timedelta(minutes=1))
+        created = timezone.now()
+        for i in range(5):
+            message = Message.objects.create(chat=self.chat, sent_from="friend", text=str(i))
+            Message.objects.filter(pk=message.pk).update(created=created)
+
+        texts = []
+        with mock.patch.object(SyncAPIView, "max_messages", 2):
+            while True:
+                data = self.sync(token)
+                texts += [message["text"] for message in data["messages"]]
+                token = data["token"]
+                if not data["has_more"]:
+                    break
+
+        self.assertCountEqual(texts, ["0", "1", "2", "3", "4"])
+        self.assertFalse(data["full_sync"])
+
+    def test_deletions(self):
+        token = self.sync()["token"]
+
+        self.chat.participants.remove(self.user)
+        data = self.sync(token)
+
+        self.assertEqual(data["deleted_chats"], [str(self.chat.id)])
+
+    def test_old_tokens_get_a_full_sync(self):
+        days = settings.PURGE["TOMBSTONE_DAYS"]
+        data = self.sync(self.token_at(timezone.now() - timedelta(days=days + 1)))
+
+        self.assertTrue(data["full_sync"])
+        self.assertEqual(len(data["chats"]), 1)
+
+    def test_old_tombstones_are_purged(self):
+        self.chat.participants.remove(self.friend)
+        SyncTombstone.objects.update(deleted=timezone.now() - timedelta(days=31))
+        self.chat.participants.remove(self.user)
+
+        call_command("purge_deleted", tombstone_days=30, stdout=io.StringIO())
+
+        self.assertEqual(
+            list(SyncTombstone.objects.values_list("user_id", flat=True)),
+            [self.user.pk],
+        )
+
+    def test_invalid_token(self):
+        response = self.client.get("/chat/sync/", {"token": "bm90LWEtZGF0ZQ=="})
+
+        self.assertEqual(response.status_code, 400)
+
+
+class SearchMessagesTestCase(AuthenticatedTestCase):
+
+    def setUp(self):
+        self.user = create_user("owner")
+        self.friend = create_user("friend")
+        self.chat = create_chat([self.user, self.friend])
+        self.authenticate(self.user)
+
+    def search(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_scoped_to_own_chats(self):
+        Message.objects.create(chat=self.chat, sent_from="friend", text="see you tomorrow")
+        other = create_chat([self.friend, create_user("stranger")])
+        Message.objects.create(chat=other, sent_from="friend", text="see you later")
+
+        results = self.search("/chat/search/", q="see")["results"]
+
+        self.assertEqual([r["text"] for r in results], ["see you tomorrow"])
+        self.assertEqual(
+            self.client.get(f"/chat/search/{other.id}/", {"q": "see"}).status_code,
+            404,
+        )
+
+    def test_index_follows_updates_and_deletes(self):
+        message = Message.objects.create(chat=self.chat, sent_from="owner", text="first draft")
+        message.text = "final version"
+        message.save()
+
+        url = f"/chat/search/{self.chat.id}/"
+        self.assertEqual(self.search(url, q="draft")["results"], [])
+        self.assertEqual(
+            self.search(url, q="fin")["results"][0]["snippet"],
+            "<mark>final</mark> version",
+        )
+
+        message.delete()
+        self.assertEqual(self.search(url, q="final")["results"], [])
+
+    def test_cursor_pagination(self):
+        for i in range(5):
+            Message.objects.create(chat=self.chat, sent_from="owner", text=f"ping {i}")
+
+        url = f"/chat/search/{self.chat.id}/"
+        first = self.search(url, q="ping", limit=3)
+        second = self.search(url, q="ping", limit=3, cursor=first["cursor"])
+
+        self.assertEqual(len(first["results"]), 3)
+        self.assertIsNone(second["cursor"])
+        self.assertEqual(
+            len({r["id"] for r in first["results"] + second["results"]}),
+            5,
+        )
+
+
+@override_settings(DATABASE_REPLICAS=["replica1"])
+class ReplicaRoutingTestCase(SimpleTestCase):
+    # Outside of a test transaction, which always reads from the primary
+
+    def setUp(self):
+        cache.clear()
+        self.user_id = uuid.uuid4()
+
+    def route_reads(self, method, user_id=None, reads=1):
+        routes = []
+
+        def view(request):
+            if user_id is not None:
+                bind_request_user(user_id)
+            for _ in range(reads):
+                routes.append(PrimaryReplicaRouter().db_for_read(Chat))
+            return HttpResponse()
+
+        request = getattr(RequestFactory(), method)("/")
+        ReplicaRoutingMiddleware(view)(request)
+        return routes
+
+    def route_read(self, method, user_id=None):
+        return self.route_reads(method, user_id)[0]
+
+    def test_safe_requests_read_from_replicas(self):
+        self.assertEqual(self.route_read("get", self.user_id), "replica1")
+        self.assertEqual(self.route_read("post", self.user_id), "default")
+        self.assertEqual(PrimaryReplicaRouter().db_for_read(Chat), "default")
+
+    def test_reads_stick_to_primary_after_a_write(self):
+        self.route_read("post", self.user_id)
+
+        self.assertEqual(self.route_read("get", self.user_id), "default")
+        self.assertEqual(self.route_read("get", uuid.uuid4()), "replica1")
+
+    @override_settings(DATABASE_REPLICAS=["replica1", "replica2", "replica3"])
+    def test_one_replica_per_request(self):
+        with mock.patch("restapi.routers.random.choice", side_effect=["replica2", "replica3"]):
+            first = self.route_reads("get", self.user_id, reads=3)
+            second = self.route_reads("get", self.user_id, reads=3)
+
+        self.assertEqual(first, ["replica2"] * 3)
+        self.assertEqual(second, ["replica3"] * 3)
+
+
+class TokenCacheTestCase(AuthenticatedTestCase):
+
+    def setUp(self):
+        self.user = create_user("owner")
+        self.authenticate(self.user)
+        self.auth_token = AuthToken.objects.get(user=self.user)
+        # Another process sharing the cache
+        self.other_cache = TokenCache(settings.TOKEN_CACHE["ALIAS"], 60)
+
+    def get(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get("/chat/list/owner/")
+        token_queries = [
+            query for query in ctx.captured_queries
+            if AuthToken._meta.db_table in query["sql"]
+        ]
+        return response, len(token_queries)
+
+    def test_cache_hit(self):
+        response, queries = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(queries, 0)
+
+        response, queries = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, 0)
+        self.assertIsNotNone(self.other_cache.get(self.auth_token.digest))
+
+    def test_entries_expire(self):
+        self.get()
+        expired = mock.Mock(time=mock.Mock(return_value=time.time() + 61))
+
+        with mock.patch("django.core.cache.backends.filebased.time", expired):
+            self.assertIsNone(self.other_cache.get(self.auth_token.digest))
+
+    def test_logged_out_token_is_rejected(self):
+        self.get()
+
+        response = self.client.post("/users/logout/")
+        self.assertEqual(response.status_code, 200)
+
+        self.assertIsNone(self.other_cache.get(self.auth_token.digest))
+        self.assertEqual(self.get()[0].status_code, 401)
+
+    def test_tokens_of_changed_users_are_dropped(self):
+        self.get()
+
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertIsNone(self.other_cache.get(self.auth_token.digest))
+        self.assertEqual(self.get()[0].status_code, 401)
+
+    def test_expired_token_is_rejected(self):
+        self.get()
+        AuthToken.objects.filter(pk=self.auth_token.pk).update(
+            expiry=timezone.now() - timedelta(seconds=1),
+        )
+        # Updates don't send signals, the cached copy is still valid
+        cached = self.other_cache.get(self.auth_token.digest)
+        cached.expiry = timezone.now() - timedelta(seconds=1)
+        self.other_cache.set(self.auth_token.digest, cached)
+
+        self.assertEqual(self.get()[0].status_code, 401)
+        self.assertFalse(AuthToken.objects.filter(pk=self.auth_token.pk).exists())
+
+
+class ContactsTestCase(AuthenticatedTestCase):
+
+    def setUp(self):
+        self.user = create_user("owner")
+        self.profile = Profile.objects.create(user=self.user)
+        self.authenticate(self.user)
+        self.client.get("/users/contacts/list/")
+
+    def change_contacts(self, action, users, query=""):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.put(
+                f"/users/contacts/{action}/{query}",
+                {"contacts": [str(user.id) for user in users]},
+                format="json",
+            )
+        return len(ctx.captured_queries), response
+
+    def test_add_is_incremental(self):
+        few, response = self.change_contacts("add", [create_user("first")])
+        self.assertEqual(response.status_code, 201)
+
+        self.profile.contacts.add(*[create_user(f"user{i}") for i in range(30)])
+        known, new = create_user("known"), create_user("new")
+        self.profile.contacts.add(known)
+        self.profile.refresh_from_db()
+        updated = self.profile.contacts_updated
+        many, response = self.change_contacts("add", [known, new])
+
+        self.assertEqual(response.json(), {"added": [str(new.id)]})
+        self.assertEqual(self.profile.contacts.count(), 33)
+        self.assertEqual(few, many)
+        # The signals of contacts.add() were sent
+        self.profile.refresh_from_db()
+        self.assertGreater(self.profile.contacts_updated, updated)
+
+    def test_remove(self):
+        kept, removed = create_user("kept"), create_user("removed")
+        self.profile.contacts.add(kept, removed)
+
+        _, response = self.change_contacts("remove", [removed])
+
+        self.assertEqual(response.json(), {"removed": [str(removed.id)]})
+        self.assertEqual(list(self.profile.contacts.all()), [kept])
+
+    def test_contact_list_on_request(self):
+        contact = create_user("contact")
+
+        _, response = self.change_contacts("add", [contact], "?include=contacts")
+
+        self.assertEqual(response.json(), {
+            "contacts": [str(contact.id)],
+            "added": [str(contact.id)],
+        })
+        # The list is served fresh, not from the cache filled in setUp
+        response = self.client.get("/users/contacts/list/")
+        self.assertEqual(response.json()["contacts"], [str(contact.id)])
+
+    def test_unknown_user(self):
+        _, response = self.change_contacts("add", [User(username="ghost")])
+        self.assertEqual(response.status_code, 400)
+
+
+class AcceptRequestTestCase(AuthenticatedTestCase):
+
+    def setUp(self):
+        self.user = create_user("owner")
+        self.sender = create_user("sender")
+        for user in (self.user, self.sender):
+            Profile.objects.create(user=user)
+        self.request = FriendRequest.objects.create(
+            sent_from=self.sender,
+            received_from=self.user,
+        )
+        self.authenticate(self.user)
+
+    def accept(self, request_id):
+        return self.client.post(
+            "/chat/requests/accept/",
+            {"id": str(request_id)},
+            format="json",
+        )
+
+    def test_accept(self):
+        response = self.accept(self.request.id)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            sorted(response.json()["participants"]),
+            ["owner", "sender"],
+        )
+        self.assertFalse(FriendRequest.objects.exists())
+        self.assertEqual(list(self.user.profile.contacts.all()), [self.sender])
+        self.assertEqual(list(self.sender.profile.contacts.all()), [self.user])
+
+    def test_existing_chat_is_reused(self):
+        chat = create_chat([self.user, self.sender])
+
+        response = self.accept(self.request.id)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["id"], str(chat.id))
+        self.assertEqual(Chat.objects.count(), 1)
+
+    def test_only_the_receiver_can_accept(self):
+        self.authenticate(self.sender)
+
+        self.assertEqual(self.accept(self.request.id).status_code, 404)
+        self.assertTrue(FriendRequest.objects.exists())
+
+
+class ListRequestsTestCase(AuthenticatedTestCase):
+
+    def setUp(self):
+        self.user = create_user("owner")
+        self.authenticate(self.user)
+        self.client.get("/chat/requests/count/")
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response
+
+    def test_incoming_and_outgoing(self):
+        for i in range(3):
+            FriendRequest.objects.create(
+                sent_from=create_user(f"sender{i}"),
+                received_from=self.user,
+            )
+        FriendRequest.objects.create(
+            sent_from=self.user,
+            received_from=create_user("receiver"),
+        )
+
+        _, incoming = self.count_queries("/chat/requests/list/")
+        _, outgoing = self.count_queries("/chat/requests/list/outgoing/")
+        _, counts = self.count_queries("/chat/requests/count/")
+
+        self.assertEqual(
+            sorted(r["sent_from_username"] for r in incoming.json()),
+            ["sender0", "sender1", "sender2"],
+        )
+        self.assertEqual(outgoing.json()[0]["received_from_username"], "receiver")
+        self.assertEqual(counts.json(), {"incoming": 3, "outgoing": 1})
+
+    def test_query_count_is_flat(self):
+        FriendRequest.objects.create(
+            sent_from=create_user("first"),
+            received_from=self.user,
+        )
+        few, _ = self.count_queries("/chat/requests/list/?page_size=1")
+
+        for i in range(20):
+            FriendRequest.objects.create(
+                sent_from=create_user(f"sender{i}"),
+                received_from=self.user,
+            )
+        many, response = self.count_queries("/chat/requests/list/?page_size=20")
+
+        self.assertEqual(response.json()["count"], 21)
+        self.assertEqual(len(response.json()["results"]), 20)
+        self.assertEqual(few, many)
+
+
+class ResponseCacheTestCase(AuthenticatedTestCase):
+
+    def setUp(self):
+        self.user = create_user("owner")
+        self.friend = create_user("friend")
+        Profile.objects.create(user=self.user)
+        self.chat = create_chat([self.user, self.friend])
+        self.authenticate(self.user)
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_hit_until_invalidated(self):
+        self.assertEqual(self.get("/chat/list/owner/")["X-Cache"], "MISS")
+        self.assertEqual(self.get("/chat/list/owner/")["X-Cache"], "HIT")
+
+        self.client.post(
+            "/chat/save_message/",
+            {"chat": str(self.chat.id), "sent_from": "friend", "text": "hi"},
+            format="json",
+        )
+        response = self.get("/chat/list/owner/")
+
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertEqual(response.json()[0]["last_message_text"], "hi")
+
+    def test_contacts_are_invalidated(self):
+        self.assertEqual(self.get("/users/contacts/list/").json()["contacts"], [])
+
+        self.client.put(
+            "/users/contacts/add/",
+            {"contacts": [str(self.friend.id)]},
+            format="json",
+        )
+
+        self.assertEqual(
+            self.get("/users/contacts/list/").json()["contacts"],
+            [str(self.friend.id)],
+        )
+
+    @override_settings(RESPONSE_CACHE={
+        "ENABLED": False,
+        "ALIAS": "default",
+        "TIMEOUT": 300,
+    })
+    def test_disabled(self):
+        self.get("/chat/list/owner/")
+        self.assertFalse(self.get("/chat/list/owner/").has_header("X-Cache"))
+
+    @override_settings(
+        CACHES={
+            **settings.CACHES,
+            "local": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        },
+        RESPONSE_CACHE={**settings.RESPONSE_CACHE, "ALIAS": "local"},
+    )
+    def test_process_local_cache_is_warned_about(self):
+        self.get("/chat/list/owner/")
+        self.assertEqual(self.get("/chat/list/owner/")["X-Cache"], "HIT")
+
+        warnings = check_response_cache(None)
+        self.assertEqual([warning.id for warning in warnings], ["restapi.W001"])
+
+
+class FastListTestCase(AuthenticatedTestCase):
+
+    def setUp(self):
+        self.user = create_user("owner")
+        self.user.is_staff = True
+        self.user.save()
+        self.chat = create_chat([self.user, create_user("friend")])
+        for i in range(3):
+            Message.objects.create(chat=self.chat, sent_from="owner", text=f"hi {i}")
+        self.authenticate(self.user)
+
+    def get(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def render(self, serializer):
+        return json.loads(JSONRenderer().render(serializer.data))
+
+    def test_same_output_as_serializers(self):
+        messages = Message.objects.order_by("created", "id")
+        self.assertEqual(
+            self.get(f"/chat/messages/list/{self.chat.id}/"),
+            self.render(MessageSerializer(messages, many=True)),
+        )
+        self.assertEqual(
+            self.get("/chat/list/owner/"),
+            self.render(ListChatSerializer(Chat.objects.all(), many=True)),
+        )
+
+    def test_sparse_fields(self):
+        messages = self.get(
+            f"/chat/messages/list/{self.chat.id}/",
+            fields="id,text",
+            limit=2,
+        )
+        self.assertEqual(
+            [set(m) for m in messages["results"]],
+            [{"id", "text"}, {"id", "text"}],
+        )
+        self.assertIsNotNone(messages["before"])
+
+        chats = self.get("/chat/list/owner/", fields="participants")
+        self.assertEqual(sorted(chats[0]["participants"]), ["friend", "owner"])
+        self.assertEqual(set(chats[0]), {"participants"})
+
+    def test_users_hide_password(self):
+        users = self.get("/users/list/")
+        self.assertNotIn("password", users[0])
+        self.assertNotIn("is_superuser", users[0])
+
+
+class ConditionalGetTestCase(AuthenticatedTestCase):
+
+    def setUp(self):
+        self.user = create_user("owner")
+        Profile.objects.create(user=self.user)
+        self.chat = create_chat([self.user, create_user("friend")])
+        Message.objects.create(chat=self.chat, sent_from="owner", text="hi")
+        self.authenticate(self.user)
+
+    def revalidate(self, url):
+        etag = self.client.get(url)["ETag"]
+        return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_not_modified(self):
+        for url in (
+            "/chat/list/owner/",
+            f"/chat/messages/list/{self.chat.id}/",
+            f"/chat/retrieve/{self.chat.id}/",
+            "/users/profiles/retrieve/",
+        ):
+            response = self.revalidate(url)
+            self.assertEqual(response.status_code, 304, url)
+            self.assertEqual(response.content, b"")
+
+    def test_modified_after_new_message(self):
+        etags = {
+            url: self.client.get(url)["ETag"]
+            for url in ("/chat/list/owner/", f"/chat/messages/list/{self.chat.id}/")
+        }
+
+        self.client.post(
+            "/chat/save_message/",
+            {"chat": str(self.chat.id), "sent_from": "owner", "text": "again"},
+            format="json",
+        )
+
+        for url, etag in etags.items():
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200, url)
+
+    def test_modified_after_leaving_a_chat(self):
+        other = create_chat([self.user, create_user("other")])
+        Chat.objects.filter(pk=other.pk).update(
+            updated=timezone.now() - timedelta(days=1),
+        )
+        etag = self.client.get("/chat/list/owner/")["ETag"]
+
+        # Leaves the list's newest chat untouched
+        Chat.participants.through.objects.filter(chat=other, user=self.user).delete()
+
+        response = self.client.get("/chat/list/owner/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 1)
+
+    def test_last_modified_only_when_exact(self):
+        # Versioned validators and times in the current second could miss
+        # a change, If-Modified-Since isn't offered for them
+        for url in (
+            "/chat/list/owner/",
+            f"/chat/messages/list/{self.chat.id}/",
+            f"/chat/retrieve/{self.chat.id}/",
+        ):
+            self.assertFalse(self.client.get(url).has_header("Last-Modified"), url)
+
+        Chat.objects.filter(pk=self.chat.pk).update(
+            updated=timezone.now() - timedelta(seconds=2),
+        )
+        url = f"/chat/retrieve/{self.chat.id}/"
+        last_modified = self.client.get(url)["Last-Modified"]
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+
+        self.assertEqual(response.status_code, 304)
+        # Only the validator, the token is cached
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+    def test_cached_body_matches_its_etag(self):
+        url = "/users/profiles/retrieve/"
+        first = self.client.get(url)
+        # Not seen by the response cache
+        Profile.objects.filter(user=self.user).update(
+            updated=timezone.now() + timedelta(hours=1),
+        )
+
+        second = self.client.get(url)
+
+        self.assertEqual(second["X-Cache"], "MISS")
+        self.assertNotEqual(second["ETag"], first["ETag"])
+        self.assertEqual(self.client.get(url)["X-Cache"], "HIT")
+
+    def test_query_string_is_part_of_the_etag(self):
+        url = f"/chat/messages/list/{self.chat.id}/"
+        etag = self.client.get(url)["ETag"]
+
+        response = self.client.get(url, {"limit": 1}, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+
+
+class ProfileImageStorageTestCase(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(
+            MEDIA_ROOT=self.media_root,
+            PROFILE_IMAGE_WORKERS=0,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self, username, process=True):
+        content = io.BytesIO()
+        Image.new("RGB", (400, 200), "red").save(content, format="PNG")
+        self.content = content.getvalue()
+        image = SimpleUploadedFile("Avatar.PNG", self.content)
+        with self.captureOnCommitCallbacks(execute=process):
+            return Profile.objects.create(user=create_user(username), image=image)
+
+    def test_identical_images_are_stored_once(self):
+        first = self.upload("first")
+        second = self.upload("second")
+
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertTrue(is_content_addressed(first.image.name))
+        self.assertTrue(first.image.name.endswith(".png"))
+        # The original and one file per size, none of them duplicated
+        self.assertCountEqual(
+            os.listdir(os.path.dirname(first.image.path)),
+            [os.path.basename(first.image.name)] + [
+                os.path.basename(variant_path(first.image.name, size))
+                for size in settings.PROFILE_IMAGE_SIZES
+            ],
+        )
+        # Named after the upload, then scaled down by the image workers
+        self.assertIn(hashlib.sha256(self.content).hexdigest(), first.image.name)
+        with Image.open(first.image.path) as img:
+            self.assertEqual(img.size, (300, 150))
+
+    def test_identical_upload_saved_concurrently_is_reused(self):
+        first = self.upload("first")
+        storage = first.image.storage
+
+        # Another upload stored the file after this one checked for it
+        with mock.patch.object(storage, "exists", return_value=False):
+            second = self.upload("second")
+
+        self.assertEqual(second.image.name, first.image.name)
+        # No copy under another name, no partial file left behind
+        self.assertEqual(
+            len(os.listdir(os.path.dirname(first.image.path))),
+            1 + len(settings.PROFILE_IMAGE_SIZES),
+        )
+
+    def test_unchanged_image_is_not_processed_again(self):
+        profile = self.upload("owner")
+
+        with mock.patch("restapi.models.schedule_profile_image") as schedule:
+            with self.captureOnCommitCallbacks(execute=True):
+                for loaded in (
+                    Profile.objects.get(pk=profile.pk),
+                    Profile.objects.defer("image").get(pk=profile.pk),
+                    Profile.objects.only("user").get(pk=profile.pk),
+                ):
+                    loaded.save()
+            schedule.assert_not_called()
+
+            loaded = Profile.objects.defer("image").get(pk=profile.pk)
+            loaded.image = "profile_pics/other.png"
+            with self.captureOnCommitCallbacks(execute=True):
+                loaded.save()
+            schedule.assert_called_once()
+
+    def test_variants_are_served_with_immutable_caching(self):
+        profile = self.upload("owner")
+        variants = ProfileSerializer(profile).data["image_variants"]
+
+        response = self.client.get(variants["96"])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertIn("immutable", response["Cache-Control"])
+        with Image.open(io.BytesIO(b"".join(response.streaming_content))) as img:
+            self.assertEqual(img.size, (96, 48))
+
+        response = self.client.get(
+            variants["96"],
+            HTTP_IF_MODIFIED_SINCE=response["Last-Modified"],
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_image_is_only_immutable_once_processed(self):
+        profile = self.upload("owner", process=False)
+        url = profile.image.url
+
+        self.assertNotIn("immutable", self.client.get(url)["Cache-Control"])
+
+        process_profile_image(
+            profile.image.path,
+            settings.PROFILE_IMAGE_SIZES,
+            settings.PROFILE_IMAGE_MAX_SIZE,
+        )
+        self.assertIn("immutable", self.client.get(url)["Cache-Control"])
+
+    def test_media_outside_media_root(self):
+        response = self.client.get("/media/../manage.py")
+
+        self.assertEqual(response.status_code, 404)
+
+
+class AsyncViewsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = create_user("owner")
+        self.chat = create_chat([self.user, create_user("friend")])
+        # AsyncClient takes the ASGI header names
+        self.auth = {
+            "AUTHORIZATION": f"Token {AuthToken.objects.create(self.user)[1]}",
+        }
+        self.client = AsyncClient()
+
+    def test_views_are_async(self):
+        for view in (saveMessage, listMessages, listChats):
+            self.assertTrue(asyncio.iscoroutinefunction(view))
+
+    async def test_save_and_list_messages(self):
+        response = await self.client.post(
+            "/chat/save_message/",
+            [
+                {"chat": str(self.chat.id), "sent_from": "owner", "text": "hi"},
+                {"chat": str(self.chat.id), "sent_from": "owner", "text": "bye"},
+            ],
+            content_type="application/json",
+            **self.auth,
+        )
+        self.assertEqual(response.status_code, 201)
+
+        response = await self.client.get(
+            f"/chat/messages/list/{self.chat.id}/",
+            {"limit": 1},
+            **self.auth,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [message["text"] for message in response.json()["results"]],
+            ["bye"],
+        )
+
+        response = await self.client.get(
+            "/chat/list/owner/",
+            {"page_size": 1},
+            **self.auth,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["count"], 1)
+        self.assertEqual(
+            sorted(response.json()["results"][0]["participants"]),
+            ["friend", "owner"],
+        )
+        self.assertEqual(response["X-Cache"], "MISS")
+
+    async def test_unauthenticated(self):
+        response = await self.client.get(f"/chat/messages/list/{self.chat.id}/")
+
+        self.assertEqual(response.status_code, 401)
+
+
+class MessageArchiveTestCase(AuthenticatedTestCase):
+
+    def setUp(self):
+        archive_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_root)
+        settings_override = override_settings(MESSAGE_ARCHIVE={
+            **settings.MESSAGE_ARCHIVE,
+            "ROOT": archive_root,
+        })
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = create_user("owner")
+        self.chat = create_chat([self.user, create_user("friend")])
+        start = timezone.now() - timedelta(days=30)
+        for i in range(7):
+            message = Message.objects.create(
+                chat=self.chat,
+                sent_from="owner",
+                text=f"message {i}",
+            )
+            # The first 5 messages are old enough to be archived
+            Message.objects.filter(id=message.id).update(
+                created=start + timedelta(days=5 * i),
+            )
+        self.texts = [f"message {i}" for i in range(7)]
+
+        self.authenticate(self.user)
+        self.url = f"/chat/messages/list/{self.chat.id}/"
+
+    def archive(self):
+        call_command(
+            "archive_messages",
+            age_days=7,
+            segment_size=2,
+            stdout=io.StringIO(),
+        )
+
+    def test_archive_moves_old_messages_to_segments(self):
+        self.archive()
+
+        self.assertEqual(Message.objects.filter(chat=self.chat).count(), 2)
+        segments = MessageSegment.objects.filter(chat=self.chat)
+        self.assertEqual([segment.count for segment in segments.order_by("sequence")], [2, 2, 1])
+        for segment in segments:
+            self.assertTrue(os.path.exists(
+                os.path.join(settings.MESSAGE_ARCHIVE["ROOT"], segment.path)
+            ))
+
+    def test_list_only_reads_the_table(self):
+        self.archive()
+
+        with mock.patch("restapi.utils.archive.read_segment") as read_segment:
+            response = self.client.get(self.url).json()
+
+        read_segment.assert_not_called()
+        self.assertEqual([message["text"] for message in response], self.texts[5:])
+
+    def test_polling_skips_the_archive(self):
+        self.archive()
+        newest = self.client.get(self.url, {"limit": 1}).json()["after"]
+        Message.objects.create(chat=self.chat, sent_from="owner", text="new")
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url, {"after": newest}).json()
+
+        self.assertEqual([message["text"] for message in response["results"]], ["new"])
+        self.assertFalse(any(
+            "restapi_messagesegment" in query["sql"]
+            for query in ctx.captured_queries
+        ))
+
+    def test_paging_continues_into_the_archive(self):
+        self.archive()
+
+        texts = []
+        response = self.client.get(self.url, {"limit": 3}).json()
+        while True:
+            texts = [message["text"] for message in response["results"]] + texts
+            if response["before"] is None:
+                break
+            response = self.client.get(
+                self.url,
+                {"before": response["before"], "limit": 3},
+            ).json()
+        self.assertEqual(texts, self.texts)
+
+        # Back towards newer messages, from the archive to the table
+        oldest = response["results"][0]
+        response = self.client.get(
+            self.url,
+            {"after": MessageCursorPagination().encode_cursor(oldest), "limit": 5},
+        ).json()
+        self.assertEqual(
+            [message["text"] for message in response["results"]],
+            self.texts[1:6],
+        )
+        self.assertTrue(response["has_newer"])
+
+    def test_search_skips_the_archive(self):
+        search_url = f"/chat/search/{self.chat.id}/"
+        before = self.client.get(search_url, {"q": "message"}).json()
+        self.assertEqual(len(before["results"]), 7)
+        self.assertIsNone(before["archived_until"])
+
+        self.archive()
+
+        response = self.client.get(search_url, {"q": "message"}).json()
+        self.assertEqual(
+            sorted(result["text"] for result in response["results"]),
+            self.texts[5:],
+        )
+        newest_archived = MessageSegment.objects.filter(
+            chat=self.chat,
+        ).order_by("-sequence")[0].last_created
+        self.assertEqual(
+            response["archived_until"],
+            JSONRenderer().render(newest_archived).decode().strip('"'),
+        )
+
+    def test_deleting_the_chat_deletes_its_segments(self):
+        self.archive()
+        paths = [
+            os.path.join(settings.MESSAGE_ARCHIVE["ROOT"], segment.path)
+            for segment in MessageSegment.objects.filter(chat=self.chat)
+        ]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chat.delete()
+
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+
+@override_settings(PURGE={**settings.PURGE, "IN_PROCESS": False})
+class PurgeTestCase(AuthenticatedTestCase):
+
+    def setUp(self):
+        self.user = create_user("leaving")
+        self.user.set_password("secret-password")
+        self.user.save()
+        self.friend = create_user("friend")
+        Profile.objects.create(user=self.user).contacts.add(self.friend)
+        Profile.objects.create(user=self.friend).contacts.add(self.user)
+
+        self.shared = create_chat([self.user, self.friend])
+        self.own = create_chat([self.user])
+        for chat in (self.shared, self.own):
+            for i in range(3):
+                Message.objects.create(chat=chat, sent_from="leaving", text=f"{i}")
+        FriendRequest.objects.create(sent_from=self.friend, received_from=self.user)
+
+        self.authenticate(self.user)
+
+    def purge(self, **options):
+        call_command("purge_deleted", batch_size=2, pause=0, stdout=io.StringIO(), **options)
+
+    def test_account_is_disabled_at_once(self):
+        response = self.client.delete("/users/delete/leaving/")
+
+        self.assertEqual(response.status_code, 204)
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.is_active)
+        self.assertFalse(AuthToken.objects.filter(user=self.user).exists())
+        self.assertFalse(User.objects.filter(username="leaving").exists())
+        # The rest is left to the purge job
+        self.assertEqual(self.shared.participants.count(), 2)
+        self.assertTrue(PurgeJob.objects.filter(
+            object_id=self.user.pk,
+            finished__isnull=True,
+        ).exists())
+
+        response = APIClient().post(
+            "/users/login/",
+            {"username": "leaving", "password": "secret-password"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_purge_in_batches(self):
+        delete_user(self.user)
+        self.purge(no_cleanup=True)
+
+        self.assertFalse(User.objects.filter(pk=self.user.pk).exists())
+        self.assertFalse(FriendRequest.objects.exists())
+        self.assertEqual(list(self.friend.profile.contacts.all()), [])
+        # The chat of the friend stays, the chat nobody is left in goes
+        self.shared.refresh_from_db()
+        self.assertEqual(list(self.shared.participants.all()), [self.friend])
+        self.assertEqual(
+            self.shared.participants_key,
+            Chat.participants_signature([self.friend]),
+        )
+        self.assertEqual(Message.objects.filter(chat=self.shared).count(), 3)
+        self.assertFalse(Chat.objects.filter(pk=self.own.pk).exists())
+        self.assertFalse(Message.objects.filter(chat_id=self.own.pk).exists())
+
+        job = PurgeJob.objects.get(object_id=self.user.pk)
+        self.assertIsNotNone(job.finished)
+        self.assertEqual(job.stage, "orphaned_chats")
+        self.assertGreater(job.purged, 5)
+
+    def test_cleanup(self):
+        orphaned = create_chat([])
+        Message.objects.create(chat=orphaned, sent_from="nobody", text="hi")
+        FriendRequest.objects.update(created=timezone.now() - timedelta(days=365))
+
+        self.purge()
+
+        self.assertFalse(Chat.objects.filter(pk=orphaned.pk).exists())
+        self.assertFalse(FriendRequest.objects.exists())
+        self.assertTrue(Chat.objects.filter(pk=self.own.pk).exists())
+
+    def test_background_failure_is_logged(self):
+        future = Future()
+        future.set_exception(RuntimeError("database is locked"))
+
+        with self.assertLogs("restapi.utils.purge", "ERROR") as logs:
+            _report_failure("job", future)
+
+        self.assertIn("Purge job job failed", logs.output[0])
+        self.assertIn("database is locked", logs.output[0])
@@ -38,6 +38,11 @@ urlpatterns = [
         views.addContact,
         name="addContact",
     ),
+    path(
+        "contacts/remove/",
+        views.removeContact,
+        name="removeContact",
+    ),
     path(
         "contacts/list/",
         views.listContacts,
@@ -0,0 +1,154 @@
+import gzip
+import json
+import os
+import uuid
+from datetime import datetime
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Q
+from rest_framework.utils.encoders import JSONEncoder
+
+from ..models import Message, MessageSegment
+from ..serializers import MessageSerializer
+
+
+def archive_root():
+    return settings.MESSAGE_ARCHIVE["ROOT"]
+
+
+def row_position(row):
+    '''
+    (created, id) of a message as serialized, the order of a chat's messages
+    '''
+    created = row["created"]
+    if isinstance(created, str):
+        created = datetime.fromisoformat(created.replace("Z", "+00:00"))
+    pk = row["id"]
+    if not isinstance(pk, uuid.UUID):
+        pk = uuid.UUID(pk)
+    return created, pk
+
+
+def write_segment(chat_id, sequence, rows):
+    '''
+    Write the serialized messages to a new segment file of the chat and
+    return its path relative to the archive root
+    '''
+    path = os.path.join(str(chat_id), f"{sequence:06d}.jsonl.gz")
+    target = os.path.join(archive_root(), path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    # Segments are cached by readers, they must never be seen half written
+    partial = f"{target}.{os.getpid()}.part"
+    with gzip.open(partial, "wt", encoding="utf-8") as segment:
+        for row in rows:
+            segment.write(json.dumps(row, cls=JSONEncoder))
+            segment.write("\n")
+    os.replace(partial, target)
+    return path
+
+
+def delete_segment(path):
+    target = os.path.join(archive_root(), path)
+    try:
+        os.remove(target)
+        os.rmdir(os.path.dirname(target))
+    except OSError:
+        # Already deleted, or other segments of the chat are left
+        pass
+
+
+@lru_cache(maxsize=settings.MESSAGE_ARCHIVE["CACHED_SEGMENTS"])
+def _read_segment(target):
+    with gzip.open(target, "rt", encoding="utf-8") as segment:
+        return tuple(json.loads(line) for line in segment)
+
+
+def read_segment(segment):
+    '''
+    Serialized messages of a segment, oldest first. The rows are shared
+    with other readers and must not be modified.
+    '''
+    return _read_segment(os.path.join(archive_root(), segment.path))
+
+
+def archive_chat(chat_id, cutoff, segment_size):
+    '''
+    Move the chat's messages created before cutoff to new segments of at
+    most segment_size messages, oldest first. Returns how many were moved.
+    '''
+    archived = 0
+    while True:
+        messages = list(Message.objects.filter(
+            chat_id=chat_id,
+            created__lt=cutoff,
+        ).order_by("created", "id")[:segment_size])
+        if not messages:
+            return archived
+
+        # The SQLite write lock is only taken by the inserts and deletes,
+        # after the segment file is written
+        with transaction.atomic():
+            sequence = MessageSegment.objects.filter(
+                chat_id=chat_id,
+            ).aggregate(sequence=Max("sequence"))["sequence"] or 0
+            rows = MessageSerializer(messages, many=True).data
+            MessageSegment.objects.create(
+                chat_id=chat_id,
+                sequence=sequence + 1,
+                path=write_segment(chat_id, sequence + 1, rows),
+                count=len(messages),
+                first_created=messages[0].created,
+                first_id=messages[0].id,
+                last_created=messages[-1].created,
+                last_id=messages[-1].id,
+            )
+            Message.objects.filter(
+                id__in=[message.id for message in messages],
+            ).delete()
+        archived += len(messages)
+
+
+def archived_before(chat_id, position, count):
+    '''
+    Up to count archived messages of the chat older than position, or the
+    newest ones when position is None, newest first. Only the segments
+    holding them are read.
+    '''
+    segments = MessageSegment.objects.filter(chat_id=chat_id)
+    if position is not None:
+        created, pk = position
+        segments = segments.filter(
+            Q(first_created__lt=created) | Q(first_created=created, first_id__lt=pk)
+        )
+
+    rows = []
+    for segment in segments.order_by("-sequence").iterator():
+        for row in reversed(read_segment(segment)):
+            if position is None or row_position(row) < position:
+                rows.append(row)
+                if len(rows) == count:
+                    return rows
+    return rows
+
+
+def archived_after(chat_id, position, count):
+    '''
+    Up to count archived messages of the chat newer than position, oldest
+    first
+    '''
+    created, pk = position
+    segments = MessageSegment.objects.filter(chat_id=chat_id).filter(
+        Q(last_created__gt=created) | Q(last_created=created, last_id__gt=pk)
+    )
+
+    rows = []
+    for segment in segments.order_by("sequence").iterator():
+        for row in read_segment(segment):
+            if row_position(row) > position:
+                rows.append(row)
+                if len(rows) == count:
+                    return rows
+    return rows
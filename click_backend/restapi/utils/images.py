@@ -0,0 +1,100 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def variant_path(path, size):
+    '''
+    Path of the size x size variant generated next to an image
+    '''
+    root, ext = os.path.splitext(path)
+    return f"{root}_{size}px{ext}"
+
+
+def _save_atomically(img, target, image_format):
+    # Cached forever, never to be seen half written
+    partial = f"{target}.{os.getpid()}.part"
+    img.save(partial, format=image_format)
+    os.replace(partial, target)
+
+
+def is_processed(path, sizes):
+    '''
+    Whether every variant of the image was generated, and so the image
+    itself scaled down
+    '''
+    return all(os.path.exists(variant_path(path, size)) for size in sizes)
+
+
+def is_final(path, sizes):
+    '''
+    Whether the image file at path won't change anymore: a variant, or an
+    image already processed
+    '''
+    root = os.path.splitext(path)[0]
+    if any(root.endswith(f"_{size}px") for size in sizes):
+        return True
+    return is_processed(path, sizes)
+
+
+def process_profile_image(path, sizes, max_size):
+    '''
+    Decode the image once, scale it down in place to fit max_size x
+    max_size and write a thumbnail for every size. Its name is the hash of
+    the upload, which still identifies the result. Images already
+    processed, e.g. uploaded before by another user, are skipped.
+    '''
+    if sizes and is_processed(path, sizes):
+        return
+
+    with Image.open(path) as img:
+        img.load()
+        image_format = img.format
+
+    if img.width > max_size or img.height > max_size:
+        img.thumbnail((max_size, max_size))
+        _save_atomically(img, path, image_format)
+
+    variant = img
+    for size in sorted(sizes, reverse=True):
+        # Each thumbnail is scaled down from the previous, larger one
+        variant = variant.copy()
+        variant.thumbnail((size, size))
+        _save_atomically(variant, variant_path(path, size), image_format)
+
+
+def schedule_profile_image(path, sizes, max_size, workers):
+    '''
+    Process the image in the worker pool, or inline when workers is 0
+    '''
+    global _executor
+
+    if workers <= 0:
+        process_profile_image(path, sizes, max_size)
+        return None
+
+    if _executor is None:
+        # Spawned workers only import this module, not the Django project
+        _executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    future = _executor.submit(process_profile_image, path, sizes, max_size)
+    future.add_done_callback(_report_failure)
+    return future
+
+
+def _report_failure(future):
+    exception = future.exception()
+    if exception is not None:
+        logger.error(
+            "Profile image processing failed",
+            exc_info=(type(exception), exception, exception.__traceback__),
+        )
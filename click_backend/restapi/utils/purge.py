@@ -0,0 +1,270 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from knox.models import AuthToken
+
+from ..models import (
+    Chat,
+    FriendRequest,
+    Message,
+    MessageSegment,
+    Profile,
+    PurgeJob,
+    SyncTombstone,
+    User,
+)
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def delete_user(user):
+    '''
+    Delete the account at once: deactivate the user, free its username and
+    email and revoke its tokens. Everything else is left to a purge job,
+    which is returned.
+    '''
+    with transaction.atomic():
+        user.is_active = False
+        user.username = f"deleted-{user.pk.hex}"
+        user.email = f"{user.pk.hex}@deleted.invalid"
+        user.set_unusable_password()
+        user.save()
+        AuthToken.objects.filter(user=user).delete()
+        job = PurgeJob.objects.create(kind=PurgeJob.USER, object_id=user.pk)
+        transaction.on_commit(lambda: schedule_purge(job.pk))
+    return job
+
+
+def _batches(queryset, batch_size):
+    '''
+    Primary keys of the rows of queryset, batch_size at a time, until it
+    is empty. The caller must remove each batch from the queryset.
+    '''
+    while True:
+        pks = list(queryset.values_list("pk", flat=True)[:batch_size])
+        if not pks:
+            return
+        yield pks
+
+
+def _delete(queryset, batch_size):
+    for pks in _batches(queryset, batch_size):
+        with transaction.atomic():
+            queryset.model.objects.filter(pk__in=pks).delete()
+        yield len(pks)
+
+
+def purge_user(user_id, batch_size):
+    '''
+    Delete a user marked deleted, one batch of dependent rows per
+    transaction, yielding the stage and the size of every batch. Related
+    managers are used where signals keep other rows in line, e.g. chat
+    participants keys, read states and cached responses.
+    '''
+    user = User.objects.filter(pk=user_id).first()
+    if user is None:
+        return
+
+    for count in _delete(
+        FriendRequest.objects.filter(Q(sent_from=user) | Q(received_from=user)),
+        batch_size,
+    ):
+        yield "friend_requests", count
+
+    # The user in the contacts of others, then the user's own contacts
+    for pks in _batches(Profile.objects.filter(contacts=user), batch_size):
+        with transaction.atomic():
+            user.contact.remove(*pks)
+        yield "contacts", len(pks)
+    profile = Profile.objects.filter(user=user).first()
+    if profile is not None:
+        for pks in _batches(User.objects.filter(contact=profile), batch_size):
+            with transaction.atomic():
+                profile.contacts.remove(*pks)
+            yield "contacts", len(pks)
+
+    left_chats = []
+    for pks in _batches(Chat.objects.filter(participants=user), batch_size):
+        with transaction.atomic():
+            user.chat.remove(*pks)
+        left_chats.extend(pks)
+        yield "chats", len(pks)
+
+    # Including the ones left for the chats above
+    for count in _delete(SyncTombstone.objects.filter(user_id=user_id), batch_size):
+        yield "tombstones", count
+
+    # Only the profile and a few rows remain
+    with transaction.atomic():
+        user.delete()
+    yield "user", 1
+
+    # Chats nobody is left in
+    for i in range(0, len(left_chats), batch_size):
+        orphaned = list(Chat.objects.filter(
+            pk__in=left_chats[i:i + batch_size],
+            participants__isnull=True,
+        ).values_list("pk", flat=True))
+        for chat_id in orphaned:
+            for _, count in purge_chat(chat_id, batch_size):
+                yield "orphaned_chats", count
+
+
+def purge_chat(chat_id, batch_size):
+    '''
+    Delete a chat, its messages and its archive a batch at a time,
+    yielding the stage and the size of every batch
+    '''
+    for count in _delete(Message.objects.filter(chat_id=chat_id), batch_size):
+        yield "messages", count
+    for count in _delete(MessageSegment.objects.filter(chat_id=chat_id), batch_size):
+        yield "segments", count
+
+    with transaction.atomic():
+        deleted, _ = Chat.objects.filter(pk=chat_id).delete()
+    if deleted:
+        yield "chat", 1
+
+
+def claim_job(job_id):
+    '''
+    Start an unfinished job, unless another worker is running it. A job
+    without progress for STALE_JOB_SECONDS is taken over.
+    '''
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.PURGE["STALE_JOB_SECONDS"])
+    return PurgeJob.objects.filter(
+        Q(started__isnull=True) | Q(updated__lt=stale),
+        pk=job_id,
+        finished__isnull=True,
+    ).update(started=now, updated=now) == 1
+
+
+def run_purge_job(job, batch_size, pause=0, report=None):
+    '''
+    Run a claimed job to completion, recording the progress after every
+    batch and passing it to report
+    '''
+    purge = purge_user if job.kind == PurgeJob.USER else purge_chat
+    for stage, count in purge(job.object_id, batch_size):
+        job.stage = stage
+        job.purged += count
+        PurgeJob.objects.filter(pk=job.pk).update(
+            stage=job.stage,
+            purged=job.purged,
+            updated=timezone.now(),
+        )
+        if report is not None:
+            report(job)
+        if pause:
+            time.sleep(pause)
+
+    job.finished = timezone.now()
+    PurgeJob.objects.filter(pk=job.pk).update(
+        finished=job.finished,
+        updated=job.finished,
+    )
+    return job
+
+
+def pending_jobs():
+    return PurgeJob.objects.filter(finished__isnull=True).order_by("created")
+
+
+def queue_orphaned_chats():
+    '''
+    Queue the deletion of chats without participants, returns how many
+    '''
+    queued = PurgeJob.objects.filter(
+        kind=PurgeJob.CHAT,
+        finished__isnull=True,
+    ).values_list("object_id", flat=True)
+    orphaned = Chat.objects.filter(
+        participants__isnull=True,
+    ).exclude(pk__in=queued).values_list("pk", flat=True)
+
+    jobs = PurgeJob.objects.bulk_create([
+        PurgeJob(kind=PurgeJob.CHAT, object_id=chat_id)
+        for chat_id in orphaned
+    ])
+    return len(jobs)
+
+
+def delete_stale_requests(days, batch_size, pause=0):
+    '''
+    Delete friend requests older than days, returns how many
+    '''
+    stale = FriendRequest.objects.filter(
+        created__lt=timezone.now() - timedelta(days=days),
+    )
+    deleted = 0
+    for count in _delete(stale, batch_size):
+        deleted += count
+        if pause:
+            time.sleep(pause)
+    return deleted
+
+
+def delete_old_tombstones(days, batch_size, pause=0):
+    '''
+    Delete sync tombstones older than days, returns how many
+    '''
+    old = SyncTombstone.objects.filter(
+        deleted__lt=timezone.now() - timedelta(days=days),
+    )
+    deleted = 0
+    for count in _delete(old, batch_size):
+        deleted += count
+        if pause:
+            time.sleep(pause)
+    return deleted
+
+
+def schedule_purge(job_id):
+    '''
+    Run the job in the background thread of the process when IN_PROCESS
+    is set, otherwise leave it to manage.py purge_deleted
+    '''
+    global _executor
+
+    if not settings.PURGE["IN_PROCESS"]:
+        return None
+
+    if _executor is None:
+        # One thread, jobs compete for the same write lock anyway
+        _executor = ThreadPoolExecutor(max_workers=1)
+    future = _executor.submit(_run_in_background, job_id)
+    future.add_done_callback(partial(_report_failure, job_id))
+    return future
+
+
+def _run_in_background(job_id):
+    try:
+        if claim_job(job_id):
+            run_purge_job(
+                PurgeJob.objects.get(pk=job_id),
+                settings.PURGE["BATCH_SIZE"],
+                settings.PURGE["PAUSE"],
+            )
+    finally:
+        connections.close_all()
+
+
+def _report_failure(job_id, future):
+    exception = future.exception()
+    if exception is not None:
+        # The job stays unfinished, purge_deleted takes it over once stale
+        logger.error(
+            "Purge job %s failed",
+            job_id,
+            exc_info=(type(exception), exception, exception.__traceback__),
+        )
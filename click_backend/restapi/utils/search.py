@@ -0,0 +1,131 @@
+import re
+
+from django.db import connections
+
+from ..models import Message
+
+INDEX_TABLE = "restapi_message_fts"
+
+_TRIGGERS = (
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {INDEX_TABLE}_insert
+    AFTER INSERT ON {{messages}} BEGIN
+        INSERT INTO {INDEX_TABLE} (rowid, text, chat_id)
+        VALUES (new.rowid, new.text, new.chat_id);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {INDEX_TABLE}_delete
+    AFTER DELETE ON {{messages}} BEGIN
+        INSERT INTO {INDEX_TABLE} ({INDEX_TABLE}, rowid, text, chat_id)
+        VALUES ('delete', old.rowid, old.text, old.chat_id);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {INDEX_TABLE}_update
+    AFTER UPDATE OF text, chat_id ON {{messages}} BEGIN
+        INSERT INTO {INDEX_TABLE} ({INDEX_TABLE}, rowid, text, chat_id)
+        VALUES ('delete', old.rowid, old.text, old.chat_id);
+        INSERT INTO {INDEX_TABLE} (rowid, text, chat_id)
+        VALUES (new.rowid, new.text, new.chat_id);
+    END
+    """,
+)
+
+
+def search_supported(using="default"):
+    return connections[using].vendor == "sqlite"
+
+
+def create_message_index(using="default"):
+    '''
+    Create the FTS5 index over Message.text and the triggers keeping it in
+    sync. Existing messages are indexed when the index is first created.
+    '''
+    if not search_supported(using):
+        return
+
+    messages = Message._meta.db_table
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s",
+            [INDEX_TABLE],
+        )
+        created = cursor.fetchone() is None
+        if created:
+            # External content index: the text is read back from the
+            # messages table, only the inverted index is stored
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE {INDEX_TABLE} USING fts5("
+                f"text, chat_id, content='{messages}', content_rowid='rowid')"
+            )
+            # Only the text is ranked, chat_id is only used to filter
+            cursor.execute(
+                f"INSERT INTO {INDEX_TABLE} ({INDEX_TABLE}, rank) "
+                "VALUES ('rank', 'bm25(1.0, 0.0)')"
+            )
+        for trigger in _TRIGGERS:
+            cursor.execute(trigger.format(messages=messages))
+    if created:
+        rebuild_message_index(using)
+
+
+def rebuild_message_index(using="default"):
+    '''
+    Reindex every message. Needed after a VACUUM, which may renumber the
+    rowids of the messages table.
+    '''
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {INDEX_TABLE} ({INDEX_TABLE}) VALUES ('rebuild')"
+        )
+
+
+def build_match_query(text, chat_ids):
+    '''
+    Turn user input into an FTS5 query matching every word, the last one
+    as a prefix, restricted to the given chats. Returns None if there is
+    nothing to search for.
+    '''
+    words = re.findall(r"\w+", text)
+    chat_ids = [chat_id.hex for chat_id in chat_ids]
+    if not words or not chat_ids:
+        return None
+
+    terms = " ".join(f'"{word}"' for word in words)
+    chats = " OR ".join(f'"{chat_id}"' for chat_id in chat_ids)
+    return f"text : ({terms}*) AND chat_id : ({chats})"
+
+
+def search_messages(match, limit, after=None, highlight=("\x02", "\x03"),
+                    snippet_words=12):
+    '''
+    Return up to limit messages matching an FTS5 query, best match first.
+    Every message gets the rank, fts_rowid and snippet attributes; after is
+    the (rank, fts_rowid) of the last message of the previous page.
+    '''
+    messages = Message._meta.db_table
+    params = [highlight[0], highlight[1], snippet_words, match]
+    keyset = ""
+    if after is not None:
+        keyset = (
+            f"AND ({INDEX_TABLE}.rank > %s OR "
+            f"({INDEX_TABLE}.rank = %s AND {INDEX_TABLE}.rowid > %s))"
+        )
+        params.extend([after[0], after[0], after[1]])
+    params.append(limit)
+
+    return list(Message.objects.raw(
+        f"""
+        SELECT {messages}.*,
+            {INDEX_TABLE}.rank AS rank,
+            {INDEX_TABLE}.rowid AS fts_rowid,
+            snippet({INDEX_TABLE}, 0, %s, %s, '…', %s) AS snippet
+        FROM {INDEX_TABLE}
+        JOIN {messages} ON {messages}.rowid = {INDEX_TABLE}.rowid
+        WHERE {INDEX_TABLE} MATCH %s {keyset}
+        ORDER BY {INDEX_TABLE}.rank, {INDEX_TABLE}.rowid
+        LIMIT %s
+        """,
+        params,
+    ))
@@ -1,51 +1,23 @@
 import uuid
+from collections import Counter
 from email import charset
+from django.db import IntegrityError, router, transaction
+from django.db.models import Count, F, Q, Subquery
+from django.db.models.signals import m2m_changed
+from django.db.models.functions import Coalesce
 from django.http import QueryDict
-from knox.models import AuthToken
+from django.utils import timezone
+from .. import response_cache
 from ..models import (
+    ChatReadState,
     FriendRequest,
+    Profile,
     User,
     Chat,
+    Message,
 )
 
 
-def get_token(headers, *args, **kwargs):
-    '''
-    Function to retrieve valid token from request headers
-    '''
-
-    if "Authorization" not in headers:
-        err_msg = {
-            "Error": 'Token should be provided in header as follows: "Authorization: Token <digest>"'
-        }
-        return None, err_msg
-
-    if not headers["Authorization"].startswith("Token "):
-        err_msg = {
-            "Error": 'Token should be provided in header as follows: "Authorization: Token <digest>"'
-        }
-        return None, err_msg
-
-    token = headers["Authorization"].split(" ")[1]
-    knox_object = AuthToken.objects.filter(
-        token_key__startswith=token[:8]).first()
-
-    if knox_object is None:
-        err_msg = {
-            "Error": "Invalid token"
-        }
-        return None, err_msg
-
-    return knox_object, None
-
-
-def get_user_from_token(headers, *args, **kwargs):
-    token, err = get_token(headers, *args, **kwargs)
-    if (err is not None):
-        return None, err
-    return token.user, None
-
-
 def validate_contact(data, *args, **kwargs):
     '''
     Function to validate contact from data dict
@@ -69,11 +41,11 @@ def validate_contact(data, *args, **kwargs):
         return err_msg
 
     try:
-        data = data.getlist("contacts") if (
-            isinstance(data, QueryDict)) else data["contacts"]
+        contacts = parse_contacts(data)
 
-        for contact in data:
-            User.objects.all().get(id=contact)
+        # One query for the whole list
+        if User.objects.filter(id__in=contacts).count() != len(contacts):
+            raise User.DoesNotExist()
         return None
     except:
         err_msg = {
@@ -82,6 +54,63 @@ def validate_contact(data, *args, **kwargs):
         return err_msg
 
 
+def parse_contacts(data):
+    '''
+    Return the distinct user ids of the contacts field of data
+    '''
+    contacts = data.getlist("contacts") if (
+        isinstance(data, QueryDict)) else data["contacts"]
+    return list(dict.fromkeys(uuid.UUID(str(contact)) for contact in contacts))
+
+
+def add_contacts(profile, user_ids):
+    '''
+    Add the users who aren't contacts of profile yet, with one bulk insert.
+    Returns the ids of the added users.
+    '''
+    through = Profile.contacts.through
+    existing = set(through.objects.filter(
+        profile=profile,
+        user_id__in=user_ids,
+    ).values_list("user_id", flat=True))
+    added = [pk for pk in user_ids if pk not in existing]
+    if not added:
+        return added
+
+    # contacts.add() would look the existing rows up again, the signals
+    # it sends keep contacts_updated and the response cache current
+    signal = dict(
+        sender=through,
+        instance=profile,
+        reverse=False,
+        model=User,
+        pk_set=set(added),
+        using=router.db_for_write(through, instance=profile),
+    )
+    with transaction.atomic(using=signal["using"]):
+        m2m_changed.send(action="pre_add", **signal)
+        through.objects.using(signal["using"]).bulk_create(
+            [through(profile=profile, user_id=pk) for pk in added],
+            ignore_conflicts=True,
+        )
+        m2m_changed.send(action="post_add", **signal)
+    return added
+
+
+def remove_contacts(profile, user_ids):
+    '''
+    Remove the given users from the contacts of profile with one delete.
+    Returns the ids of the removed users.
+    '''
+    removed = list(Profile.contacts.through.objects.filter(
+        profile=profile,
+        user_id__in=user_ids,
+    ).values_list("user_id", flat=True))
+    if removed:
+        profile.contacts.remove(*removed)
+    return removed
+
+
 def request_exists(sent_from, received_from):
     try:
         requests = FriendRequest.objects.filter(
@@ -97,17 +126,206 @@ def request_exists(sent_from, received_from):
 
 def chat_exists(participants: list):
     try:
-        if (not isinstance(participants[0], uuid.UUID)):
-            participants = list([uuid.UUID(p) for p in participants])
-
-        participants = set(participants)
-        chats = Chat.objects.all()
-        for chat in chats:
-            chat_participants = set(list(
-                [user.id for user in chat.participants.all()]
-            ))
-            if (chat_participants == participants):
-                return True
-        return False
+        return Chat.objects.filter(
+            participants_key=Chat.participants_signature(participants)
+        ).exists()
     except Exception as e:
         return False
+
+
+def bulk_save_messages(messages):
+    '''
+    Insert unsaved messages with one bulk insert, then update once per
+    affected chat its last message preview and its participants' unread
+    counters
+    '''
+    with transaction.atomic():
+        Message.objects.bulk_create(messages)
+
+        latest_messages = {}
+        sender_counts = Counter()
+        for message in messages:
+            latest = latest_messages.get(message.chat_id)
+            if latest is None or message.created > latest.created:
+                latest_messages[message.chat_id] = message
+            sender_counts[(message.chat_id, message.sent_from)] += 1
+
+        for chat_id, message in latest_messages.items():
+            Chat.objects.filter(
+                pk=chat_id,
+                last_message__lt=message.created,
+            ).update(
+                last_message=message.created,
+                last_message_text=message.text[:100],
+                last_message_sender=message.sent_from,
+                updated=timezone.now(),
+            )
+
+        for (chat_id, sent_from), count in sender_counts.items():
+            ChatReadState.objects.filter(
+                chat_id=chat_id,
+            ).exclude(
+                user__username=sent_from,
+            ).update(unread_count=F("unread_count") + count)
+
+        # Bulk inserts and updates don't send model signals
+        response_cache.invalidate_chats(list(latest_messages))
+
+    return messages
+
+
+def mark_chat_read(chat, user):
+    '''
+    Move the read mark of user in chat to the chat's last message, unless
+    it is already past it, and count as unread the messages of others
+    saved since. Returns the read state.
+    '''
+    last_read = chat.last_message
+    unread = Message.objects.filter(
+        chat=chat,
+        created__gt=last_read,
+    ).exclude(
+        sent_from=user.username,
+    ).order_by().values("chat").annotate(count=Count("id")).values("count")
+
+    with transaction.atomic():
+        state, _ = ChatReadState.objects.get_or_create(user=user, chat=chat)
+        # Counted in the update itself, so a message saved after
+        # last_message was read stays unread
+        ChatReadState.objects.filter(
+            Q(last_read__isnull=True) | Q(last_read__lt=last_read),
+            pk=state.pk,
+        ).update(
+            last_read=last_read,
+            unread_count=Coalesce(Subquery(unread), 0),
+        )
+        state.refresh_from_db()
+    return state
+
+
+def accept_friend_request(friend_request):
+    '''
+    In one transaction: create the chat of the two users if there is none,
+    make them mutual contacts and delete the request. Returns the chat and
+    whether it was created.
+    '''
+    users = [friend_request.sent_from_id, friend_request.received_from_id]
+    key = Chat.participants_signature(users)
+
+    with transaction.atomic():
+        chat = Chat.objects.filter(participants_key=key).first()
+        created = chat is None
+        if created:
+            try:
+                # A racing accept may create the same chat first
+                with transaction.atomic():
+                    chat = Chat.objects.create(
+                        room_name=str(uuid.uuid4()),
+                        last_message=timezone.now(),
+                        participants_key=key,
+                    )
+                    chat.participants.set(users)
+            except IntegrityError:
+                chat = Chat.objects.get(participants_key=key)
+                created = False
+
+        for profile in Profile.objects.filter(user__in=users):
+            add_contacts(
+                profile,
+                [pk for pk in users if pk != profile.user_id],
+            )
+
+        friend_request.delete()
+
+    return chat, created
+
+
+def chats_by_participants(chat_ids=None):
+    '''
+    Map the participants key of every chat, or of the given ones, to the
+    ids of the chats having these participants, oldest first
+    '''
+    participants = {}
+    rows = Chat.participants.through.objects.order_by(
+        "chat__created", "chat_id",
+    )
+    if chat_ids is not None:
+        rows = rows.filter(chat_id__in=chat_ids)
+    for chat_id, user_id in rows.values_list("chat_id", "user_id").iterator():
+        participants.setdefault(chat_id, []).append(user_id)
+
+    chats = {}
+    for chat_id, user_ids in participants.items():
+        key = Chat.participants_signature(user_ids)
+        chats.setdefault(key, []).append(chat_id)
+    return chats
+
+
+def merge_chats(chat, duplicates):
+    '''
+    Move the messages and unread counters of duplicates, chats with the
+    participants of chat, into chat and delete them. A duplicate holding
+    archived messages, or messages older than the archive of chat, can't
+    be merged without rewriting segments and is left alone.
+    Returns the ids of the merged chats.
+    '''
+    last_segment = chat.segments.order_by("-sequence").first()
+    merged = []
+    with transaction.atomic():
+        for duplicate in Chat.objects.filter(pk__in=duplicates).exclude(pk=chat.pk):
+            if duplicate.segments.exists():
+                continue
+            if last_segment is not None and Message.objects.filter(
+                chat=duplicate,
+                created__lte=last_segment.last_created,
+            ).exists():
+                continue
+
+            Message.objects.filter(chat=duplicate).update(chat=chat)
+            for state in ChatReadState.objects.filter(chat=duplicate):
+                ChatReadState.objects.filter(
+                    chat=chat,
+                    user_id=state.user_id,
+                ).update(unread_count=F("unread_count") + state.unread_count)
+            if duplicate.last_message > chat.last_message:
+                chat.last_message = duplicate.last_message
+                chat.last_message_text = duplicate.last_message_text
+                chat.last_message_sender = duplicate.last_message_sender
+            # Leaves a tombstone, so clients drop the duplicate
+            duplicate.delete()
+            merged.append(duplicate.pk)
+
+        if merged:
+            chat.save(update_fields=[
+                "last_message",
+                "last_message_text",
+                "last_message_sender",
+                "updated",
+            ])
+        # Message updates don't send model signals
+        response_cache.invalidate_chats([chat.pk])
+    return merged
+
+
+def backfill_participants_keys():
+    '''
+    Set the participants key of chats created before it existed, merging
+    the chats with the same participants into the oldest one. Returns the
+    number of chats given a key, of merged chats and of chats left
+    without a key because they couldn't be merged.
+    '''
+    missing = Chat.objects.filter(
+        participants_key__isnull=True,
+    ).values_list("id", flat=True)
+    keyed = merged = unmerged = 0
+    for key, chat_ids in chats_by_participants(list(missing)).items():
+        chat = Chat.objects.filter(participants_key=key).first()
+        if chat is None:
+            chat = Chat.objects.get(pk=chat_ids[0])
+            Chat.objects.filter(pk=chat.pk).update(participants_key=key)
+            keyed += 1
+
+        done = merge_chats(chat, chat_ids)
+        merged += len(done)
+        unmerged += len(chat_ids) - len(done) - (chat.pk in chat_ids)
+    return keyed, merged, unmerged
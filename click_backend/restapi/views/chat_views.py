@@ -1,30 +1,99 @@
+import uuid
+from collections import defaultdict
 from email.policy import HTTP
 from functools import partial
 from os import stat
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError
+from django.db.models import Count, F, Max, OuterRef, Prefetch, Q, Subquery
+from django.db.models.functions import Coalesce
 from rest_framework.parsers import JSONParser
 from rest_framework import status, permissions, generics
 from rest_framework.response import Response
 
 from ..models import (
     Chat,
+    ChatReadState,
     FriendRequest,
     Message,
     User,
 )
 from ..serializers import (
     ChatSerializer,
+    ListChatSerializer,
+    InboxChatSerializer,
     MessageSerializer,
     ChatLastMessageSerializer,
     FriendRequestSerializer,
     ListRequestSerializer,
 )
 
+from ..asyncviews import AsyncGenericAPIView, AsyncListAPIView
+from ..conditional import AsyncConditionalGetMixin, ConditionalGetMixin
+from ..fastpath import AsyncValuesListMixin, ValuesListMixin
+from ..response_cache import AsyncCachedResponseMixin, CachedResponseMixin
+from ..pagination import (
+    MessageCursorPagination,
+    OptionalPageNumberPagination,
+)
 from ..utils.utils import (
+    accept_friend_request,
     chat_exists,
-    get_user_from_token,
+    mark_chat_read,
     request_exists
 )
 
+CHAT_VALUES_FIELDS = (
+    "id",
+    "created",
+    "updated",
+    "room_name",
+    "last_message",
+    "last_message_text",
+    "last_message_sender",
+)
+
+
+def participant_usernames(rows):
+    return Chat.participants.through.objects.filter(
+        chat_id__in=[row["id"] for row in rows],
+    ).values_list("chat_id", "user__username")
+
+
+def set_participants(rows, usernames):
+    participants = defaultdict(list)
+    for chat_id, username in usernames:
+        participants[str(chat_id)].append(username)
+    for row in rows:
+        row["participants"] = participants[str(row["id"])]
+
+
+class ChatValuesListMixin(ValuesListMixin):
+    '''
+    Values fast path for chat lists, with participants as usernames
+    '''
+    values_fields = CHAT_VALUES_FIELDS
+    values_extra_fields = ("participants",)
+    values_required = ("id",)
+
+    def add_values_extras(self, rows, fields):
+        set_participants(rows, participant_usernames(rows))
+
+
+class AsyncChatValuesListMixin(AsyncValuesListMixin):
+    '''
+    ChatValuesListMixin for async views
+    '''
+    values_fields = CHAT_VALUES_FIELDS
+    values_extra_fields = ("participants",)
+    values_required = ("id",)
+
+    async def add_values_extras(self, rows, fields):
+        set_participants(rows, [
+            usernames async for usernames in participant_usernames(rows)
+        ])
+
+
 # Chat views
 
 
@@ -77,12 +146,20 @@ class CreateChatView(generics.CreateAPIView):
             self.perform_create(serializer)
             headers = self.get_success_headers(serializer.data)
             return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+        except IntegrityError:
+            return Response(
+                {
+                    "Error":
+                    "Chat already exists"
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
         except Exception as e:
             print(e)
             return Response({}, status=status.HTTP_400_BAD_REQUEST)
 
 
-class RetrieveChatView(generics.RetrieveAPIView):
+class RetrieveChatView(ConditionalGetMixin, CachedResponseMixin, generics.RetrieveAPIView):
     '''
     View called to retrieve information for a chat
     '''
@@ -92,54 +169,128 @@ class RetrieveChatView(generics.RetrieveAPIView):
     queryset = Chat.objects.all()
     serializer_class = ChatSerializer
     lookup_field = ["chat_id"]
+    cache_resource = "chat"
+
+    def get_cache_owner(self):
+        try:
+            return uuid.UUID(self.kwargs["chat_id"])
+        except ValueError:
+            return None
+
+    def get_validator(self):
+        chat_id = self.get_cache_owner()
+        updated = chat_id and Chat.objects.filter(
+            pk=chat_id,
+        ).values_list("updated", flat=True).first()
+        return updated or None
 
     def get_object(self):
         chat_id = self.kwargs["chat_id"]
         return generics.get_object_or_404(Chat, id=chat_id)
 
 
-class ListChatsAPIView(generics.ListAPIView):
+class ListChatsAPIView(AsyncConditionalGetMixin, AsyncCachedResponseMixin, AsyncChatValuesListMixin, AsyncListAPIView):
     '''
     View called to list all chats for a user
     '''
     permission_classes = [
         permissions.IsAuthenticated,
     ]
-    serializer_class = ChatSerializer
+    serializer_class = ListChatSerializer
+    pagination_class = OptionalPageNumberPagination
     lookup_field = ["username"]
-
-    def get(self, request, *args, **kwargs):
+    cache_resource = "chats"
+
+    def get_cache_owner(self):
+        # Only the user's own chat list is cached
+        if self.kwargs["username"] == self.request.user.username:
+            return self.request.user.pk
+        return None
+
+    async def get_validator(self):
+        # Chat.updated changes with every message and participant change
+        # of the chats listed, the count with the chats joined or left
+        chats = await Chat.objects.filter(
+            participants__username=self.kwargs["username"],
+        ).aaggregate(updated=Max("updated"), count=Count("id"))
+        if chats["updated"] is None:
+            return None
+        return chats["updated"], str(chats["count"])
+
+    async def get(self, request, *args, **kwargs):
         try:
-            queryset = self.filter_queryset(self.get_queryset())
-
-            page = self.paginate_queryset(queryset)
-            if page is not None:
-                serializer = self.get_serializer(page, many=True)
-                return self.get_paginated_response(serializer.data)
-
-            serializer = self.get_serializer(queryset, many=True)
-
-            data = list([dict(x) for x in serializer.data])
-            for i, chat in enumerate(serializer.data):
-                participant_usernames = []
-                for participant in dict(chat)["participants"]:
-                    user = User.objects.get(id=participant)
-                    participant_usernames.append(user.username)
-                data[i]["participants"] = participant_usernames
-
-            return Response(data)
+            return await super().get(request, *args, **kwargs)
         except Exception as e:
             print(e)
             return Response({}, status=status.HTTP_400_BAD_REQUEST)
 
     def get_queryset(self):
         username = self.kwargs["username"]
-        chat_ids = []
-        for chat in Chat.objects.all():
-            if username in [x.username for x in chat.participants.all()]:
-                chat_ids.append(chat.id)
+        return Chat.objects.filter(
+            participants__username=username
+        ).prefetch_related(
+            Prefetch(
+                "participants",
+                queryset=User.objects.only("id", "username"),
+            )
+        ).order_by('-last_message')
+
+
+class InboxAPIView(ChatValuesListMixin, generics.ListAPIView):
+    '''
+    View called to list the chats of the requesting user with their unread
+    message count and last message preview
+    '''
+    permission_classes = [
+        permissions.IsAuthenticated,
+    ]
+    serializer_class = InboxChatSerializer
+    pagination_class = OptionalPageNumberPagination
+    values_fields = CHAT_VALUES_FIELDS + ("unread_count", "last_read")
+
+    def get_queryset(self):
+        read_states = ChatReadState.objects.filter(
+            chat=OuterRef("pk"),
+            user=self.request.user,
+        )
+        return Chat.objects.filter(
+            participants=self.request.user,
+        ).annotate(
+            unread_count=Coalesce(
+                Subquery(read_states.values("unread_count")[:1]),
+                0,
+            ),
+            last_read=Subquery(read_states.values("last_read")[:1]),
+        ).prefetch_related(
+            Prefetch(
+                "participants",
+                queryset=User.objects.only("id", "username"),
+            )
+        ).order_by('-last_message')
+
+
+class MarkChatReadView(generics.GenericAPIView):
+    '''
+    View called to mark every message of a chat as read by the requesting user
+    '''
+    permission_classes = [
+        permissions.IsAuthenticated,
+    ]
 
-        return Chat.objects.filter(id__in=chat_ids).order_by('-last_message')
+    def post(self, request, *args, **kwargs):
+        chat = generics.get_object_or_404(
+            Chat,
+            id=kwargs["chat_id"],
+            participants=request.user,
+        )
+        state = mark_chat_read(chat, request.user)
+        return Response(
+            {
+                "last_read": state.last_read,
+                "unread_count": state.unread_count,
+            },
+            status=status.HTTP_200_OK,
+        )
 
 
 class UpdateLastMessageChatView(generics.UpdateAPIView):
@@ -154,9 +305,7 @@ class UpdateLastMessageChatView(generics.UpdateAPIView):
 
     def patch(self, request, *args, **kwargs):
         try:
-            user, err = get_user_from_token(request.headers.copy())
-            if (err is not None):
-                return Response(data=err, status=status.HTTP_400_BAD_REQUEST)
+            user = request.user
             chat = Chat.objects.get(id=kwargs["chat_id"])
             for participant in chat.participants.all():
                 if participant.id == user.id:
@@ -174,9 +323,10 @@ class UpdateLastMessageChatView(generics.UpdateAPIView):
         return generics.get_object_or_404(Chat, id=chat_id)
 
 
-class SaveMessageView(generics.CreateAPIView):
+class SaveMessageView(AsyncGenericAPIView):
     '''
-    View called to save a message in db
+    View called to save a message in db. A list of messages is saved in
+    a single transaction with one bulk insert.
     '''
     parser_classes = (JSONParser,)
     permission_classes = [
@@ -186,31 +336,70 @@ class SaveMessageView(generics.CreateAPIView):
     serializer_class = MessageSerializer
 
     # Delete this method when in production
-    def post(self, request):
+    async def post(self, request):
         try:
-            serializer = self.get_serializer(data=request.data)
-            serializer.is_valid(raise_exception=True)
-            self.perform_create(serializer)
-            headers = self.get_success_headers(serializer.data)
-            return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+            serializer = self.get_serializer(
+                data=request.data,
+                many=isinstance(request.data, list),
+            )
+            data = await sync_to_async(self.save_messages)(serializer)
+            if data is None:
+                # One entry per message of a list, empty for valid ones
+                return Response(
+                    serializer.errors,
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            return Response(data, status=status.HTTP_201_CREATED)
         except Exception as e:
             print(e)
             return Response({}, status=status.HTTP_400_BAD_REQUEST)
 
+    def save_messages(self, serializer):
+        # Validation looks the chats up and the messages are saved in a
+        # transaction, neither of which the async ORM interface supports
+        if not serializer.is_valid():
+            return None
+        serializer.save()
+        return serializer.data
+
 
-class ListMessagesAPIView(generics.ListAPIView):
+class ListMessagesAPIView(AsyncConditionalGetMixin, AsyncValuesListMixin, AsyncListAPIView):
     '''
-    View called to list all messages from a chat
+    View called to list the messages of a chat still in the table. Cursor
+    pages continue into the archived ones.
     '''
     permission_classes = [
         permissions.IsAuthenticated,
     ]
     serializer_class = MessageSerializer
+    pagination_class = MessageCursorPagination
     lookup_field = ["chat_id"]
+    values_fields = ("id", "created", "chat", "sent_from", "text")
+    # Used by the cursors
+    values_required = ("id", "created")
+
+    async def get_validator(self):
+        # New messages change the newest time, merged chats and archival
+        # the count
+        chat_id = self.get_archived_chat()
+        if chat_id is None:
+            return None
+        messages = await Message.objects.filter(
+            chat=chat_id,
+        ).aaggregate(created=Max("created"), count=Count("id"))
+        if messages["created"] is None:
+            return None
+        return messages["created"], str(messages["count"])
 
     def get_queryset(self):
         chat_id = self.kwargs["chat_id"]
-        return Message.objects.filter(chat=chat_id).order_by('created')
+        return Message.objects.filter(chat=chat_id).order_by('created', 'id')
+
+    def get_archived_chat(self):
+        try:
+            return uuid.UUID(self.kwargs["chat_id"])
+        except ValueError:
+            return None
 
 
 class SendRequestView(generics.CreateAPIView):
@@ -226,11 +415,7 @@ class SendRequestView(generics.CreateAPIView):
     def post(self, request, *args, **kwargs):
         try:
             data = request.data.copy()
-            user, err = get_user_from_token(
-                request.headers.copy(), *args, **kwargs
-            )
-            if (err is not None):
-                return Response(data=err, status=status.HTTP_400_BAD_REQUEST)
+            user = request.user
 
             data["received_from"] = User.objects.get(
                 username=data["received_from"]
@@ -261,32 +446,28 @@ class SendRequestView(generics.CreateAPIView):
             return Response(data=err_msg, status=status.HTTP_400_BAD_REQUEST)
 
 
-class ListRequestsView(generics.ListAPIView):
+class ListRequestsView(CachedResponseMixin, ValuesListMixin, generics.ListAPIView):
+    '''
+    View called to list the friend requests received by the requesting user,
+    or the ones they sent when routed with direction="outgoing"
+    '''
     permission_classes = [
         permissions.IsAuthenticated
     ]
     serializer_class = ListRequestSerializer
+    pagination_class = OptionalPageNumberPagination
+    cache_resource = "requests"
+    values_fields = (
+        "id",
+        "sent_from_id",
+        "sent_from_username",
+        "received_from_id",
+        "received_from_username",
+    )
 
     def get(self, request, *args, **kwargs):
         try:
-            self.kwargs["headers"] = request.headers.copy()
-            queryset = self.filter_queryset(self.get_queryset())
-
-            for query in queryset:
-                query.sent_from_username = User.objects.get(
-                    id=query.sent_from.id
-                ).username
-                query.received_from_username = User.objects.get(
-                    id=query.received_from.id
-                ).username
-
-            page = self.paginate_queryset(queryset)
-            if page is not None:
-                serializer = self.get_serializer(page, many=True)
-                return self.get_paginated_response(serializer.data)
-
-            serializer = self.get_serializer(queryset, many=True)
-            return Response(serializer.data)
+            return super().get(request, *args, **kwargs)
         except Exception as e:
             print(e)
             err_msg = {
@@ -295,8 +476,76 @@ class ListRequestsView(generics.ListAPIView):
             return Response(data=err_msg, status=status.HTTP_400_BAD_REQUEST)
 
     def get_queryset(self, *args, **kwargs):
-        user, _ = get_user_from_token(self.kwargs["headers"])
-        return FriendRequest.objects.filter(received_from=user.id).order_by('-created')
+        if self.kwargs.get("direction") == "outgoing":
+            requests = FriendRequest.objects.filter(sent_from=self.request.user.id)
+        else:
+            requests = FriendRequest.objects.filter(received_from=self.request.user.id)
+
+        # Usernames come from the same joined query
+        return requests.annotate(
+            sent_from_username=F("sent_from__username"),
+            received_from_username=F("received_from__username"),
+        ).order_by('-created')
+
+
+class CountRequestsView(CachedResponseMixin, generics.GenericAPIView):
+    '''
+    View called to count the pending friend requests received and sent by
+    the requesting user, e.g. for a badge
+    '''
+    permission_classes = [
+        permissions.IsAuthenticated
+    ]
+    cache_resource = "requests"
+
+    def get(self, request, *args, **kwargs):
+        user = request.user
+        counts = FriendRequest.objects.filter(
+            Q(received_from=user) | Q(sent_from=user)
+        ).aggregate(
+            incoming=Count("id", filter=Q(received_from=user)),
+            outgoing=Count("id", filter=Q(sent_from=user)),
+        )
+        return Response(counts, status=status.HTTP_200_OK)
+
+
+class AcceptRequestView(generics.GenericAPIView):
+    '''
+    View called by the receiver of a friend request to accept it: the chat
+    of both users is created if needed, they become mutual contacts and the
+    request is deleted, all in one transaction
+    '''
+    parser_classes = (JSONParser,)
+    permission_classes = [
+        permissions.IsAuthenticated,
+    ]
+    serializer_class = ListChatSerializer
+
+    def post(self, request, *args, **kwargs):
+        try:
+            friend_request = FriendRequest.objects.get(
+                id=request.data["id"],
+                received_from=request.user,
+            )
+        except Exception as e:
+            print(e)
+            err_msg = {
+                "Error": "Request does not exist"
+            }
+            return Response(data=err_msg, status=status.HTTP_404_NOT_FOUND)
+
+        chat, created = accept_friend_request(friend_request)
+
+        chat = Chat.objects.prefetch_related(
+            Prefetch(
+                "participants",
+                queryset=User.objects.only("id", "username"),
+            )
+        ).get(pk=chat.pk)
+        return Response(
+            self.get_serializer(chat).data,
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK,
+        )
 
 
 class DeleteRequestView(generics.DestroyAPIView):
@@ -324,7 +573,11 @@ saveMessage = SaveMessageView.as_view()
 retrieveChat = RetrieveChatView.as_view()
 listMessages = ListMessagesAPIView.as_view()
 listChats = ListChatsAPIView.as_view()
+inbox = InboxAPIView.as_view()
+markChatRead = MarkChatReadView.as_view()
 updateLastMessageChat = UpdateLastMessageChatView.as_view()
 sendRequest = SendRequestView.as_view()
 listRequests = ListRequestsView.as_view()
+countRequests = CountRequestsView.as_view()
+acceptRequest = AcceptRequestView.as_view()
 deleteRequest = DeleteRequestView.as_view()
@@ -0,0 +1,67 @@
+import mimetypes
+import os
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+
+from ..storage import is_content_addressed
+from ..utils.images import is_final
+
+
+@require_safe
+def serve_media(request, path):
+    '''
+    View serving uploaded files from MEDIA_ROOT. The file is streamed by
+    the server, with sendfile where available, or by the front proxy when
+    MEDIA_SENDFILE_HEADER is set, never read into memory here. Content
+    addressed files are cached by clients for a year, once the image
+    workers are done with them.
+    '''
+    try:
+        fullpath = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(fullpath)
+    except (SuspiciousFileOperation, ValueError, OSError):
+        raise Http404("File not found")
+    if not os.path.isfile(fullpath):
+        raise Http404("File not found")
+
+    last_modified = int(stat.st_mtime)
+    response = get_conditional_response(request, last_modified=last_modified)
+    if response is None:
+        if settings.MEDIA_SENDFILE_HEADER:
+            content_type, encoding = mimetypes.guess_type(fullpath)
+            response = HttpResponse(
+                content_type=content_type or "application/octet-stream",
+            )
+            response[settings.MEDIA_SENDFILE_HEADER] = (
+                settings.MEDIA_SENDFILE_PREFIX + path.lstrip("/")
+            )
+        else:
+            response = FileResponse(open(fullpath, "rb"))
+        response["Last-Modified"] = http_date(last_modified)
+
+    immutable = is_content_addressed(path) and is_final(
+        fullpath, settings.PROFILE_IMAGE_SIZES
+    )
+    if immutable:
+        patch_cache_control(
+            response,
+            public=True,
+            immutable=True,
+            max_age=settings.MEDIA_CACHE_MAX_AGE["IMMUTABLE"],
+        )
+    else:
+        patch_cache_control(
+            response,
+            public=True,
+            max_age=settings.MEDIA_CACHE_MAX_AGE["DEFAULT"],
+        )
+    return response
+
+
+serveMedia = serve_media
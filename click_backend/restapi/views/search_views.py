@@ -0,0 +1,67 @@
+from functools import partial
+
+from django.db.models import Max
+from rest_framework import status, permissions, generics
+from rest_framework.response import Response
+
+from ..models import Chat, MessageSegment
+from ..pagination import MessageSearchPagination
+from ..serializers import SearchMessageSerializer
+from ..utils.search import (
+    build_match_query,
+    search_messages,
+    search_supported,
+)
+
+
+class SearchMessagesAPIView(generics.GenericAPIView):
+    '''
+    View called to search the messages of one chat, or of every chat of the
+    requesting user, with ?q=<words>. Results are ranked, carry a snippet
+    with the matching words highlighted and are cursor paginated.
+
+    Archived messages are not indexed, so they are never found. The response
+    carries archived_until, the creation time of the newest archived message
+    of the searched chats (null when none are archived): older messages may
+    be missing from the results.
+    '''
+    permission_classes = [
+        permissions.IsAuthenticated,
+    ]
+    serializer_class = SearchMessageSerializer
+    pagination_class = MessageSearchPagination
+
+    def get(self, request, *args, **kwargs):
+        if not search_supported():
+            err_msg = {
+                "Error": "Search is not available"
+            }
+            return Response(data=err_msg, status=status.HTTP_400_BAD_REQUEST)
+
+        chat_ids = self.get_chat_ids()
+        archived_until = MessageSegment.objects.filter(
+            chat_id__in=chat_ids,
+        ).aggregate(last=Max("last_created"))["last"]
+
+        match = build_match_query(request.query_params.get("q", ""), chat_ids)
+        if match is None:
+            return Response(
+                {"cursor": None, "results": [], "archived_until": archived_until},
+                status=status.HTTP_200_OK,
+            )
+
+        page = self.paginate_queryset(partial(search_messages, match))
+        serializer = self.get_serializer(page, many=True)
+        response = self.get_paginated_response(serializer.data)
+        response.data["archived_until"] = archived_until
+        return response
+
+    def get_chat_ids(self):
+        chats = Chat.objects.filter(participants=self.request.user)
+        if "chat_id" in self.kwargs:
+            chat = generics.get_object_or_404(chats, id=self.kwargs["chat_id"])
+            return [chat.id]
+        return list(chats.values_list("id", flat=True))
+
+
+searchMessages = SearchMessagesAPIView.as_view()
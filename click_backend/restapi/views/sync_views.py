@@ -0,0 +1,190 @@
+import uuid
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import F, Prefetch, Q
+from django.utils import timezone
+from rest_framework import status, permissions, generics
+from rest_framework.response import Response
+
+from ..models import (
+    Chat,
+    FriendRequest,
+    Message,
+    Profile,
+    SyncTombstone,
+    User,
+)
+from ..serializers import (
+    ListChatSerializer,
+    ListRequestSerializer,
+    MessageSerializer,
+)
+
+
+class SyncAPIView(generics.GenericAPIView):
+    '''
+    View called to fetch what changed for the requesting user since a sync
+    token: new messages, new or updated chats, friend requests, deletions
+    and contacts. Every response carries the token for the next call.
+
+    Consecutive windows overlap slightly so that writes committed late are
+    not missed; clients should upsert results by id. Without a token the
+    current chats, friend requests and contacts are returned, and messages
+    are left to the paginated message list. This full sync is also returned,
+    flagged with full_sync, for tokens older than the tombstones, which are
+    kept PURGE["TOMBSTONE_DAYS"] days.
+
+    When has_more is set, the token also holds the (created, id) position
+    of the last message returned, where the next call continues.
+    '''
+    permission_classes = [
+        permissions.IsAuthenticated,
+    ]
+    overlap = timedelta(seconds=1)
+    max_messages = 1000
+
+    def get(self, request, *args, **kwargs):
+        try:
+            since, position = self.decode_token(request.query_params.get("token"))
+        except ValueError:
+            err_msg = {
+                "Error": "Invalid sync token"
+            }
+            return Response(data=err_msg, status=status.HTTP_400_BAD_REQUEST)
+
+        user = request.user
+        now = timezone.now()
+        next_sync, next_position = now - self.overlap, None
+
+        # Deletions older than the tombstones are unknown
+        expired = now - timedelta(days=settings.PURGE["TOMBSTONE_DAYS"])
+        if since is not None and since < expired:
+            since, position = None, None
+
+        messages, has_more = self.get_messages(user, since, position)
+        if has_more:
+            # Continue right after the last message returned, messages
+            # sharing its timestamp included
+            next_sync = messages[-1].created
+            next_position = messages[-1].created, messages[-1].id
+
+        data = {
+            "token": self.encode_token(next_sync, next_position),
+            "has_more": has_more,
+            "full_sync": since is None,
+            "messages": MessageSerializer(messages, many=True).data,
+            "chats": ListChatSerializer(
+                self.get_chats(user, since), many=True
+            ).data,
+            "friend_requests": ListRequestSerializer(
+                self.get_friend_requests(user, since), many=True
+            ).data,
+            "contacts": self.get_contacts(user, since),
+        }
+        data.update(self.get_deletions(user, since))
+        return Response(data, status=status.HTTP_200_OK)
+
+    def get_messages(self, user, since, position=None):
+        if since is None:
+            return [], False
+
+        messages = Message.objects.filter(
+            chat__in=Chat.objects.filter(participants=user).values("id"),
+        )
+        if position is None:
+            messages = messages.filter(created__gt=since)
+        else:
+            created, pk = position
+            messages = messages.filter(
+                Q(created__gt=created) | Q(created=created, id__gt=pk)
+            )
+        messages = list(messages.order_by("created", "id")[:self.max_messages + 1])
+        return messages[:self.max_messages], len(messages) > self.max_messages
+
+    def get_chats(self, user, since):
+        chats = Chat.objects.filter(participants=user)
+        if since is not None:
+            chats = chats.filter(updated__gt=since)
+        return chats.prefetch_related(
+            Prefetch(
+                "participants",
+                queryset=User.objects.only("id", "username"),
+            )
+        ).order_by("-last_message")
+
+    def get_friend_requests(self, user, since):
+        requests = FriendRequest.objects.filter(
+            Q(sent_from=user) | Q(received_from=user)
+        )
+        if since is not None:
+            requests = requests.filter(created__gt=since)
+        return requests.annotate(
+            sent_from_username=F("sent_from__username"),
+            received_from_username=F("received_from__username"),
+        ).order_by("-created")
+
+    def get_contacts(self, user, since):
+        '''
+        Return the full contact list if it changed, None otherwise
+        '''
+        if since is not None and not Profile.objects.filter(
+            user=user,
+            contacts_updated__gt=since,
+        ).exists():
+            return None
+
+        return list(Profile.contacts.through.objects.filter(
+            profile__user=user,
+        ).values_list("user_id", flat=True))
+
+    def get_deletions(self, user, since):
+        deletions = {
+            "deleted_chats": [],
+            "deleted_friend_requests": [],
+        }
+        if since is None:
+            return deletions
+
+        tombstones = SyncTombstone.objects.filter(
+            user_id=user.pk,
+            deleted__gt=since,
+        ).values_list("kind", "object_id")
+        for kind, object_id in tombstones:
+            if kind == SyncTombstone.CHAT:
+                deletions["deleted_chats"].append(object_id)
+            else:
+                deletions["deleted_friend_requests"].append(object_id)
+        return deletions
+
+    def encode_token(self, moment, position=None):
+        token = moment.isoformat()
+        if position is not None:
+            token += f"|{position[0].isoformat()}|{position[1]}"
+        return urlsafe_b64encode(token.encode()).decode()
+
+    def decode_token(self, token):
+        '''
+        The moment of the token and its message position, or None
+        '''
+        if not token:
+            return None, None
+        try:
+            parts = urlsafe_b64decode(token.encode()).decode().split("|")
+            moment = datetime.fromisoformat(parts[0])
+            position = None
+            if len(parts) == 3:
+                position = datetime.fromisoformat(parts[1]), uuid.UUID(parts[2])
+            elif len(parts) != 1:
+                raise ValueError(token)
+        except (TypeError, UnicodeDecodeError):
+            raise ValueError(token)
+        if timezone.is_naive(moment) or (
+            position is not None and timezone.is_naive(position[0])
+        ):
+            raise ValueError(token)
+        return moment, position
+
+
+sync = SyncAPIView.as_view()
@@ -1,10 +1,18 @@
-from django.http import QueryDict
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from knox.models import AuthToken
 from rest_framework import status, permissions, generics
 from rest_framework.response import Response
 
-from ..utils.utils import get_user_from_token, get_token, validate_contact
+from ..conditional import ConditionalGetMixin
+from ..fastpath import ValuesListMixin
+from ..response_cache import CachedResponseMixin
+from ..utils.purge import delete_user
+from ..utils.utils import (
+    add_contacts,
+    parse_contacts,
+    remove_contacts,
+    validate_contact,
+)
 from ..models import User, Profile
 from ..serializers import (
     CreateUserSerializer,
@@ -104,17 +112,8 @@ class SignOutAPIView(generics.GenericAPIView):
     ]
 
     def post(self, request, *args, **kwargs):
-
-        knox_object, err_msg = get_token(
-            request.headers.copy(), *args, **kwargs,
-        )
-        if not err_msg is None:
-            return Response(
-                data=err_msg,
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
-        knox_object.delete()
+        # Deleting the token also evicts it from the token cache
+        request.auth.delete()
 
         data = {
             "Error": "Token deleted successfuly"
@@ -125,7 +124,7 @@ class SignOutAPIView(generics.GenericAPIView):
         )
 
 
-class ListUsersAPIView(generics.ListAPIView):
+class ListUsersAPIView(ValuesListMixin, generics.ListAPIView):
     '''
     View called to list all existing users
     '''
@@ -135,6 +134,7 @@ class ListUsersAPIView(generics.ListAPIView):
     ]
     serializer_class = UserSerializer
     queryset = User.objects.all()
+    values_fields = UserSerializer.Meta.fields
 
 
 class RetrieveUserAPIView(generics.RetrieveAPIView):
@@ -156,7 +156,8 @@ class RetrieveUserAPIView(generics.RetrieveAPIView):
 
 class DeleteUserAPIView(generics.DestroyAPIView):
     '''
-    View called by a user to delete his account
+    View called by a user to delete his account. The account is disabled
+    at once, the rows depending on it are purged in the background.
     '''
     permission_classes = [
         permissions.IsAuthenticated
@@ -167,21 +168,11 @@ class DeleteUserAPIView(generics.DestroyAPIView):
 
     def delete(self, request, *args, **kwargs):
         user = self.get_object()
-
-        token_user, err = get_user_from_token(
-            request.headers.copy(), *args, **kwargs
-        )
-
-        if not err is None:
-            return Response(
-                data=err,
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        token_user = request.user
 
         # A user is only allowed to delete an account if they have the corresponding token
         if user.username == token_user.username:
-            resp = super().delete(self, request, *args, **kwargs)
-            return resp
+            return super().delete(request, *args, **kwargs)
 
         err_msg = {
             "Error": "Operation not permitted"
@@ -192,51 +183,66 @@ class DeleteUserAPIView(generics.DestroyAPIView):
         username = self.kwargs["username"]
         return generics.get_object_or_404(User, username=username)
 
+    def perform_destroy(self, instance):
+        delete_user(instance)
+
 
-class AddContactView(generics.UpdateAPIView):
+class AddContactView(generics.GenericAPIView):
+    '''
+    View called to add users to the contacts of the requesting user. Only
+    the users who aren't contacts yet are inserted. Returns the ids of the
+    added users, and the contact list with ?include=contacts.
+    '''
     parser_classes = (MultiPartParser, JSONParser)
-    serializer_class = ContactsSerializer
     queryset = Profile.objects.all()
     permission_classes = [
         permissions.IsAuthenticated,
     ]
 
     def put(self, request, *args, **kwargs):
-        user, err = get_user_from_token(
-            request.headers.copy(), *args, **kwargs
-        )
+        err = validate_contact(request.data.copy())
         if (err is not None):
             return Response(data=err, status=status.HTTP_400_BAD_REQUEST)
-        self.kwargs["username"] = user.username
 
+        profile = self.get_object()
+        added = add_contacts(profile, parse_contacts(request.data))
+        return Response(
+            data=self.get_data(profile, added=added),
+            status=status.HTTP_201_CREATED,
+        )
+
+    def get_object(self):
+        return generics.get_object_or_404(Profile, user=self.request.user.id)
+
+    def get_data(self, profile, **changed):
+        # Reading the contact list costs as much as it is long, only done
+        # for the clients asking for it
+        if self.request.query_params.get("include") == "contacts":
+            return dict(ContactsSerializer(profile).data, **changed)
+        return changed
+
+
+class RemoveContactView(AddContactView):
+    '''
+    View called to remove users from the contacts of the requesting user.
+    Returns the ids of the removed users, and the contact list with
+    ?include=contacts.
+    '''
+
+    def put(self, request, *args, **kwargs):
         err = validate_contact(request.data.copy())
         if (err is not None):
             return Response(data=err, status=status.HTTP_400_BAD_REQUEST)
 
-        instance = self.get_object()
-        # Old contacts
-        contacts = list([x.id for x in instance.contacts.all()])
-        # New contacts
-        new_contacts = request.data.getlist('contacts') if isinstance(
-            request.data, QueryDict) else request.data['contacts']
-        contacts.extend(new_contacts)
-
-        data = {
-            "contacts": contacts
-        }
-        serializer = self.get_serializer(
-            instance, data=data)
-        serializer.is_valid(raise_exception=True)
-        self.perform_update(serializer)
-        return Response(data=serializer.data, status=status.HTTP_201_CREATED)
-
-    def get_object(self):
-        username = self.kwargs["username"]
-        user_id = User.objects.all().get(username=username).id
-        return generics.get_object_or_404(Profile, user=user_id)
+        profile = self.get_object()
+        removed = remove_contacts(profile, parse_contacts(request.data))
+        return Response(
+            data=self.get_data(profile, removed=removed),
+            status=status.HTTP_200_OK,
+        )
 
 
-class RetrieveProfileView(generics.RetrieveAPIView):
+class RetrieveProfileView(ConditionalGetMixin, CachedResponseMixin, generics.RetrieveAPIView):
     '''
     View called to retrieve profile for a specific user based on authorization header
     '''
@@ -245,21 +251,21 @@ class RetrieveProfileView(generics.RetrieveAPIView):
     ]
     serializer_class = ProfileSerializer
     queryset = Profile.objects.all()
+    cache_resource = "profile"
 
-    def get(self, request, *args, **kwargs):
-        user, err = get_user_from_token(request.headers.copy())
-        if (err is not None):
-            return Response(data=err, status=status.HTTP_400_BAD_REQUEST)
-
-        self.kwargs["user"] = user
-        return super().get(request, *args, **kwargs)
+    def get_validator(self):
+        # Both only ever move forward, the newest is when the profile or
+        # its contacts last changed
+        updated = Profile.objects.filter(
+            user=self.request.user.id,
+        ).values_list("updated", "contacts_updated").first()
+        return max(updated) if updated else None
 
     def get_object(self):
-        user_id = self.kwargs["user"].id
-        return generics.get_object_or_404(Profile, user=user_id)
+        return generics.get_object_or_404(Profile, user=self.request.user.id)
 
 
-class ListContactsAPIView(generics.RetrieveAPIView):
+class ListContactsAPIView(CachedResponseMixin, generics.RetrieveAPIView):
     '''
     View called to list all contacts of a specific user
     '''
@@ -268,21 +274,10 @@ class ListContactsAPIView(generics.RetrieveAPIView):
     ]
     serializer_class = ContactsSerializer
     queryset = Profile.objects.all()
-
-    def get(self, request, *args, **kwargs):
-        user, err = get_user_from_token(
-            request.headers.copy(), *args, **kwargs
-        )
-        if (err is not None):
-            return Response(data=err, status=status.HTTP_400_BAD_REQUEST)
-        self.kwargs["username"] = user.username
-
-        return super().get(request, *args, **kwargs)
+    cache_resource = "contacts"
 
     def get_object(self):
-        username = self.kwargs["username"]
-        user_id = User.objects.all().get(username=username).id
-        return generics.get_object_or_404(Profile, user=user_id)
+        return generics.get_object_or_404(Profile, user=self.request.user.id)
 
 
 signIn = SignInAPIView.as_view()
@@ -292,5 +287,6 @@ retrieveUser = RetrieveUserAPIView.as_view()
 listUsers = ListUsersAPIView.as_view()
 createUser = CreateUserAPIView.as_view()
 addContact = AddContactView.as_view()
+removeContact = RemoveContactView.as_view()
 listContacts = ListContactsAPIView.as_view()
 retrieveProfile = RetrieveProfileView.as_view()
@@ -7,8 +7,6 @@ import Logout from "./Logout";
 import { v4 as uuidv4 } from "uuid";
 import { useNavigate } from "react-router-dom";
 import {
-  updateLastMessage,
-  saveMessageRoute,
   retrieveChatMessagesRoute,
 } from "../utils/APIRoutes"
 import axios from 'axios';
@@ -40,7 +38,7 @@ export default function ChatContainer({ currentChat, socket }) {
   };
 
   useEffect(() => {
-    arrivalMessage && setMessages((prev) => [...prev, arrivalMessage]);
+    arrivalMessage && setMessages((prev) => [...prev, ...arrivalMessage]);
   }, [arrivalMessage]);
 
   useEffect(async () => {
@@ -75,34 +73,7 @@ export default function ChatContainer({ currentChat, socket }) {
   }, [user]);
 
   const handleSendMsg = async (msg) => {
-    const messageData = {
-      "text": msg,
-      "chat": currentChat?.id,
-      "sent_from": user?.username,
-    };
-
-    await axios.post(`${saveMessageRoute}`, messageData, { headers: headers })
-      .catch((error) => {
-        if (!if401Logout(error.response)) {
-          toast.error(error.response?.data?.Error, toastOptions);
-        }
-      });
-    const m = new Date();
-    const dateString =
-      m.getUTCFullYear() + "-" +
-      ("0" + (m.getUTCMonth() + 1)).slice(-2) + "-" +
-      ("0" + m.getUTCDate()).slice(-2) + "T" +
-      ("0" + m.getUTCHours()).slice(-2) + ":" +
-      ("0" + m.getUTCMinutes()).slice(-2) + ":" +
-      ("0" + m.getUTCSeconds()).slice(-2);
-
-    await axios.patch(`${updateLastMessage}${currentChat?.id}/`, { "last_message": dateString }, { headers: headers })
-      .catch((error) => {
-        if (!if401Logout(error.response)) {
-          toast.error(error.response?.data?.Error, toastOptions);
-        }
-      });
-
+    // The server persists messages received over the socket
     socket.current?.send(JSON.stringify({
       'message': msg,
       'username': user?.username,
@@ -116,9 +87,13 @@ export default function ChatContainer({ currentChat, socket }) {
   useEffect(() => {
     if (socket.current) {
       socket.current.onmessage = (e) => {
+        // Bursts of messages arrive batched in a single array frame
         const data = JSON.parse(e.data);
-        if (!(data?.username === user?.username)) {
-          setArrivalMessage({ fromSelf: false, message: data?.message });
+        const received = (Array.isArray(data) ? data : [data])
+          .filter((m) => !(m?.username === user?.username))
+          .map((m) => ({ fromSelf: false, message: m?.message }));
+        if (received.length > 0) {
+          setArrivalMessage(received);
         }
       }
     }
@@ -9,7 +9,7 @@ import XMARK from "../media/x-lg.svg";
 import CHECK from "../media/check-lg.svg";
 import {
     requestsListRoute,
-    createChat,
+    requestsAcceptRoute,
     listChatsRoute,
     requestsDeleteRoute,
     sendRequestRoute,
@@ -71,7 +71,7 @@ export default function FriendRequests({ changeContacts, requestsSocket }) {
             });
 
         const sendRequestSocket = new WebSocket(
-            `${webSocketRoute}requests${username.replaceAll('-', '')}/`
+            `${webSocketRoute}requests${username.replaceAll('-', '')}/?token=${token}`
         );
 
         sendRequestSocket.addEventListener('open', () => {
@@ -118,28 +118,8 @@ export default function FriendRequests({ changeContacts, requestsSocket }) {
                 newRequests.push(request);
             }
 
-            const m = new Date();
-            const dateString =
-                m.getUTCFullYear() + "-" +
-                ("0" + (m.getUTCMonth() + 1)).slice(-2) + "-" +
-                ("0" + m.getUTCDate()).slice(-2) + "T" +
-                ("0" + m.getUTCHours()).slice(-2) + ":" +
-                ("0" + m.getUTCMinutes()).slice(-2) + ":" +
-                ("0" + m.getUTCSeconds()).slice(-2);
-
-            const data = {
-                "participants": [user.id, r?.sent_from_id],
-                "room_name": uuidv4(),
-                "last_message": dateString,
-            }
-            await axios.post(`${createChat}`, data, { headers: headers })
-                .catch((error) => {
-                    if (!if401Logout(error.response)) {
-                        toast.error(error.response?.data?.Error, toastOptions);
-                    }
-                });
-
-            axios.delete(`${requestsDeleteRoute}`, { headers: headers, data: { id: r?.id } },)
+            // Creates the chat, adds both users as contacts and deletes the request
+            await axios.post(`${requestsAcceptRoute}`, { id: r?.id }, { headers: headers })
                 .catch((error) => {
                     if (!if401Logout(error.response)) {
                         toast.error(error.response?.data?.Error, toastOptions);
@@ -166,7 +146,7 @@ export default function FriendRequests({ changeContacts, requestsSocket }) {
             setRequests(newRequests);
             changeContacts(chats);
 
-            const accptedRequestSocket = new WebSocket(`${webSocketRoute}contacts${r?.sent_from_username.replaceAll('-', '')}/`);
+            const accptedRequestSocket = new WebSocket(`${webSocketRoute}contacts${r?.sent_from_username.replaceAll('-', '')}/?token=${token}`);
 
             accptedRequestSocket.addEventListener('open', () => {
                 accptedRequestSocket.send(JSON.stringify({
@@ -81,11 +81,11 @@ export default function Chat() {
       retrieveContacts(currentUser);
 
       friendRequestsSocket.current = new WebSocket(
-        `${webSocketRoute}requests${currentUser?.username.replaceAll('-', '')}/`
+        `${webSocketRoute}requests${currentUser?.username.replaceAll('-', '')}/?token=${token}`
       );
 
       contactsSocket.current = new WebSocket(
-        `${webSocketRoute}contacts${currentUser?.username.replaceAll('-', '')}/`
+        `${webSocketRoute}contacts${currentUser?.username.replaceAll('-', '')}/?token=${token}`
       );
     }
   }, [currentUser]);
@@ -102,7 +102,7 @@ export default function Chat() {
     if (currentChat) {
       const validID = currentChat.id.replaceAll('-', '');
       socket.current = new WebSocket(
-        `${webSocketRoute}${validID}/`
+        `${webSocketRoute}${validID}/?token=${token}`
       );
     }
   }, [currentChat]);
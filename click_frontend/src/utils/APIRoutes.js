@@ -11,5 +11,6 @@ export const retrieveChatMessagesRoute = `${host}chat/messages/list/`
 export const listChatsRoute = `${host}chat/list/`
 export const sendRequestRoute = `${host}chat/requests/send/`
 export const requestsListRoute = `${host}chat/requests/list/`
+export const requestsAcceptRoute = `${host}chat/requests/accept/`
 export const requestsDeleteRoute = `${host}chat/requests/delete/`
 export const createChat = `${host}chat/create/`